@@ -44,6 +44,13 @@ export interface ApiResponse {
       processedAt: string;
       resultsGenerated: number;
     };
+    pagination: {
+      page: number;
+      pageSize: number;
+      totalPages: number;
+      nextPage: number | null;
+      seed: number;
+    };
   };
   error?: string;
 }
@@ -0,0 +1,681 @@
+"""
+FHIR Query API - shared helpers
+Configuration and response builders used by both the Flask server (fhir_api_server.py)
+and the ASGI server (fhir_asgi_server.py).
+"""
+
+import os
+from datetime import datetime
+import random
+
+from fhir_json import dumps
+from fhir_suggest import Autocomplete
+from fhir_cohort import NUMPY_AVAILABLE, SAMPLE_NAMES, cohort_size, simulate_cohort
+from fhir_metrics import query_sample, record_query, upstream_sample
+
+# Batch processing settings (spaCy nlp.pipe)
+MAX_BATCH_QUERIES = int(os.environ.get('MAX_BATCH_QUERIES', '1000'))
+NLP_BATCH_SIZE = int(os.environ.get('NLP_BATCH_SIZE', '64'))
+NLP_N_PROCESS = int(os.environ.get('NLP_N_PROCESS', '1'))
+
+# Result cache settings (disabled when QUERY_CACHE_SIZE is 0)
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', '0'))
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', '300'))
+
+# Load spaCy/TextBlob in a background warm-up thread instead of at import time
+NLP_LAZY_LOAD = os.environ.get('NLP_LAZY_LOAD', '0').lower() in ('1', 'true', 'yes')
+
+# spaCy pipeline variant: full, trimmed (no lemmatizer) or no_parser
+SPACY_PIPELINE = os.environ.get('SPACY_PIPELINE', 'full')
+
+# Run lexicon/regex rules first and only call spaCy when it could change the outcome
+NLP_TIERED = os.environ.get('NLP_TIERED', '0').lower() in ('1', 'true', 'yes')
+
+# Simulated results: patients per cohort (0: 3-8, chosen by the seed), default and maximum page size.
+# Pages are regenerated from the seed with NumPy, so large cohorts suit load tests and demos.
+SIMULATED_COHORT_SIZE = int(os.environ.get('SIMULATED_COHORT_SIZE', '0'))
+SIMULATED_PAGE_SIZE = int(os.environ.get('SIMULATED_PAGE_SIZE', '50'))
+SIMULATED_MAX_PAGE_SIZE = int(os.environ.get('SIMULATED_MAX_PAGE_SIZE', '1000'))
+
+# Concurrent identical /api/query requests share one computation and upstream fetch
+QUERY_COALESCING = os.environ.get('QUERY_COALESCING', '1').lower() in ('1', 'true', 'yes')
+
+# Autocomplete: suggestions per response, and how many distinct callers must ask a query before
+# it is suggested to everyone (0: history off) for up to SUGGESTION_HISTORY_SIZE popular queries
+SUGGESTION_LIMIT = int(os.environ.get('SUGGESTION_LIMIT', '10'))
+SUGGESTION_HISTORY_MIN_COUNT = int(os.environ.get('SUGGESTION_HISTORY_MIN_COUNT', '3'))
+SUGGESTION_HISTORY_SIZE = int(os.environ.get('SUGGESTION_HISTORY_SIZE', '10000'))
+
+# Header holding the client address set by the reverse proxy (e.g. X-Real-IP from nginx.conf);
+# empty: the peer address. Only set it behind a proxy that overwrites the header.
+CLIENT_IP_HEADER = os.environ.get('CLIENT_IP_HEADER', '')
+
+# Sentiment backend: auto (TextBlob when installed, else lexicon), lexicon (built-in) or textblob
+SENTIMENT_BACKEND = os.environ.get('SENTIMENT_BACKEND', 'auto')
+
+# Aggregate per-stage timing histograms over all requests (reported in /api/health)
+NLP_TIMING_HISTOGRAMS = os.environ.get('NLP_TIMING_HISTOGRAMS', '0').lower() in ('1', 'true', 'yes')
+
+# FHIR server the generated queries point at, and real execution against it (off: simulated results)
+FHIR_SERVER_URL = os.environ.get('FHIR_SERVER_URL', 'https://hapi.fhir.org/baseR4')
+FHIR_EXECUTE = os.environ.get('FHIR_EXECUTE', '0').lower() in ('1', 'true', 'yes')
+FHIR_CONNECT_TIMEOUT = float(os.environ.get('FHIR_CONNECT_TIMEOUT', '3.05'))
+FHIR_READ_TIMEOUT = float(os.environ.get('FHIR_READ_TIMEOUT', '30'))
+FHIR_MAX_CONNECTIONS = int(os.environ.get('FHIR_MAX_CONNECTIONS', '10'))
+FHIR_RETRIES = int(os.environ.get('FHIR_RETRIES', '3'))
+FHIR_BACKOFF_FACTOR = float(os.environ.get('FHIR_BACKOFF_FACTOR', '0.5'))
+
+# Query plan mode: searches run concurrently per request, and Bundle pages read per search
+FHIR_PLAN_CONCURRENCY = int(os.environ.get('FHIR_PLAN_CONCURRENCY', '4'))
+FHIR_PLAN_MAX_PAGES = int(os.environ.get('FHIR_PLAN_MAX_PAGES', '1'))
+
+# Upstream response cache (0 entries: off), default freshness and per-resource-type overrides
+# ("Patient=300,Observation=60"), and an optional SQLite file that survives restarts
+FHIR_CACHE_SIZE = int(os.environ.get('FHIR_CACHE_SIZE', '512'))
+FHIR_CACHE_TTL = float(os.environ.get('FHIR_CACHE_TTL', '60'))
+FHIR_CACHE_TTLS = os.environ.get('FHIR_CACHE_TTLS', '')
+FHIR_CACHE_DISK = os.environ.get('FHIR_CACHE_DISK', '')
+
+def service_config():
+    """Keyword arguments for FHIRQueryService built from the environment settings"""
+    return {
+        "batch_size": NLP_BATCH_SIZE,
+        "n_process": NLP_N_PROCESS,
+        "cache_size": QUERY_CACHE_SIZE,
+        "cache_ttl": QUERY_CACHE_TTL,
+        "lazy_load": NLP_LAZY_LOAD,
+        "spacy_pipeline": SPACY_PIPELINE,
+        "tiered": NLP_TIERED,
+        "sentiment_backend": SENTIMENT_BACKEND,
+        "timing_histograms": NLP_TIMING_HISTOGRAMS,
+        "base_url": FHIR_SERVER_URL
+    }
+
+def create_fhir_client():
+    """FHIRClient for FHIR_SERVER_URL, or None when FHIR_EXECUTE is off"""
+    if not FHIR_EXECUTE:
+        return None
+    from fhir_client import DEFAULT_CACHE_TTLS, FHIRClient, FHIRResponseCache
+    cache = None
+    if FHIR_CACHE_SIZE > 0:
+        ttls = dict(DEFAULT_CACHE_TTLS)
+        for item in filter(None, FHIR_CACHE_TTLS.split(',')):
+            resource_type, ttl = item.split('=')
+            ttls[resource_type.strip()] = float(ttl)
+        cache = FHIRResponseCache(max_entries=FHIR_CACHE_SIZE, default_ttl=FHIR_CACHE_TTL,
+                                  ttls=ttls, disk_path=FHIR_CACHE_DISK or None)
+    return FHIRClient(
+        FHIR_SERVER_URL,
+        connect_timeout=FHIR_CONNECT_TIMEOUT,
+        read_timeout=FHIR_READ_TIMEOUT,
+        max_connections=FHIR_MAX_CONNECTIONS,
+        retries=FHIR_RETRIES,
+        backoff_factor=FHIR_BACKOFF_FACTOR,
+        cache=cache
+    )
+
+SUGGESTIONS = [
+    "Show me all diabetic patients over 50",
+    "Find blood pressure observations for recent patients",
+    "Get active diabetes conditions",
+    "List all female patients with hypertension",
+    "Show heart rate measurements from last month",
+    "Find patients with chest pain symptoms",
+    "Get medication list for diabetes patients",
+    "Show recent emergency room visits",
+    "Find patients with abnormal lab results",
+    "List hypertensive patients on ACE inhibitors",
+    "Show pediatric patients with asthma",
+    "Get cardiac patients over 65",
+    "Find patients with depression diagnosis",
+    "Show pregnant patients due this month",
+    "Get patients with chronic kidney disease"
+]
+
+def process_query_request(service, query, timings=False, collect_metrics=False, fhir_client=None, plan=False,
+                          simulation=None):
+    """
+    Process one query and format it for the frontend.
+    With a fhir_client the generated FHIR query is also executed against the FHIR server.
+    With plan, one search per resource type the query refers to is added as the query plan;
+    with a fhir_client those searches run concurrently and are joined by patient instead.
+    simulation selects the page of simulated results (see parse_simulation_params).
+    Returns (response, metrics sample); stage timings are always collected when metrics are
+    on, but only returned to the client when requested.
+    """
+    result, sample = analyze_query_request(service, query, timings, collect_metrics, plan)
+    if fhir_client is not None:
+        sample['upstream'] = execute_query_request(result, fhir_client)
+    return format_query_response(query, result, simulation), sample
+
+def analyze_query_request(service, query, timings=False, collect_metrics=False, plan=False):
+    """NLP analysis, FHIR query and (with plan) query plan of one query; returns (result, metrics sample)"""
+    result = service.process_patient_query(query, timings=timings or collect_metrics)
+    if plan:
+        result['query_plan'] = service.build_query_plan(query, result['nlp_analysis'])
+    sample = query_sample(service, result)
+    if not timings:
+        result['nlp_analysis'].pop('timings', None)
+    return result, sample
+
+def execute_query_request(result, fhir_client):
+    """Run an analyzed query (or its query plan) against the FHIR server; returns the upstream metrics sample"""
+    if 'query_plan' in result:
+        result['query_plan_results'] = fhir_client.execute_plan(
+            result['query_plan'], concurrency=FHIR_PLAN_CONCURRENCY, max_pages=FHIR_PLAN_MAX_PAGES)
+    else:
+        result['fhir_execution'] = fhir_client.execute(result['fhir_query'])
+    return upstream_sample(result)
+
+NDJSON = 'application/x-ndjson'
+
+def wants_ndjson(headers):
+    """Whether the client asked for a streamed NDJSON response (Accept: application/x-ndjson)"""
+    return NDJSON in headers.get('Accept', '')
+
+def ndjson_frame(frame_type, **data):
+    return dumps(dict(type=frame_type, **data)) + b"\n"
+
+def stream_query_response(query, result, sample, simulation=None, fhir_client=None):
+    """
+    Yield an analyzed query's response as NDJSON frames, cheapest first, so clients can render
+    before the slow parts exist: nlp_analysis, fhir_query, clinical_interpretation, then
+    fhir_results (after executing against the FHIR server, with a fhir_client), one patient
+    frame per simulated patient, aggregates and end. Apart from "type" (and "patient"), each
+    frame's keys are those of the JSON response. A failure ends the stream with an error frame.
+    The metrics sample is recorded once the stream finishes.
+    """
+    try:
+        yield ndjson_frame("nlp_analysis", success=True, query=query, nlp_analysis=format_nlp_analysis(result))
+        fhir_query = {"fhir_query": result.get('fhir_query', {}), "formatted_url": result.get('formatted_url', '')}
+        if 'query_plan' in result:
+            fhir_query["query_plan"] = result['query_plan']
+        yield ndjson_frame("fhir_query", **fhir_query)
+        yield ndjson_frame("clinical_interpretation", clinical_interpretation=format_clinical_interpretation(query, result))
+        if fhir_client is not None:
+            sample['upstream'] = execute_query_request(result, fhir_client)
+            yield ndjson_frame("fhir_results", **format_fhir_results(result))
+        
+        cohort, patient_count, pagination = simulated_cohort(result, **(simulation or {}))
+        for patient in cohort['patients']:
+            yield ndjson_frame("patient", patient=patient)
+        simulated_results = build_simulated_results(cohort, patient_count, query)
+        del simulated_results['patients']
+        simulated_results["pagination"] = pagination
+        yield ndjson_frame("aggregates", simulated_results=simulated_results)
+        yield ndjson_frame("end")
+    except Exception as e:
+        yield ndjson_frame("error", success=False, error=str(e))
+    finally:
+        record_query(sample)
+
+def coalesce_key(query, timings=False, plan=False, simulation=None):
+    """
+    Key under which concurrent /api/query requests share one computation. Case is ignored
+    unless the service is tiered, where capitalized words route a query to spaCy.
+    """
+    text = query.strip() if NLP_TIERED else query.lower().strip()
+    return (text, timings, plan, tuple(sorted((simulation or {}).items())))
+
+def response_for_query(response, query):
+    """
+    A shared (coalesced) response as returned to one of its requests, whose text may differ
+    from the leader's in case or surrounding whitespace. The shared response is not modified.
+    """
+    if response['query'] == query:
+        return response
+    response = dict(response, query=query)
+    response['clinical_interpretation'] = dict(response['clinical_interpretation'],
+                                               summary=interpretation_summary(query))
+    simulated = response.get('simulated_results')
+    if simulated and 'queryInfo' in simulated:
+        response['simulated_results'] = dict(simulated, queryInfo=dict(simulated['queryInfo'],
+                                                                        originalQuery=query))
+    return response
+
+def process_batch_request(service, queries, fhir_client=None):
+    """Process a batch of queries and format each result; returns (responses, metrics samples)"""
+    results = service.process_patient_queries(queries)
+    if fhir_client is not None:
+        for result in results:
+            result['fhir_execution'] = fhir_client.execute(result['fhir_query'])
+    return (
+        [format_query_response(query, result) for query, result in zip(queries, results)],
+        [query_sample(service, result) for result in results]
+    )
+
+# Upper bound on pages followed for one streamed search (0: unlimited)
+FHIR_STREAM_MAX_PAGES = int(os.environ.get('FHIR_STREAM_MAX_PAGES', '0'))
+
+def stream_fhir_resources(fhir_client, fhir_query, page_size=None):
+    """
+    Yield every resource matched by a FHIR search as NDJSON lines, following Bundle paging
+    lazily (one page in memory plus one prefetched). An upstream failure ends the stream
+    with an OperationOutcome line.
+    """
+    from fhir_client import FHIRClientError
+
+    resources = fhir_client.iter_resources(fhir_query, page_size=page_size,
+                                           max_pages=FHIR_STREAM_MAX_PAGES or None)
+    try:
+        for resource in resources:
+            yield dumps(resource) + b"\n"
+    except FHIRClientError as e:
+        yield dumps({
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "exception", "diagnostics": str(e)}]
+        }) + b"\n"
+    finally:
+        resources.close()
+
+def parse_page_size(value):
+    """Validate an optional positive page size, returning None when absent"""
+    if value is None:
+        return None
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError("'page_size' must be a positive integer")
+    return page_size
+
+# Seeds stay below 2**53 so JavaScript clients can send them back unchanged
+MAX_SEED = 1 << 53
+
+def parse_simulation_params(data):
+    """
+    Validate the optional page (1-based), page_size and seed of simulated results in a
+    /api/query body; returns the keyword arguments for generate_simulated_results.
+    """
+    limits = {
+        'page': (1, None, "'page' must be a positive integer"),
+        'page_size': (1, SIMULATED_MAX_PAGE_SIZE, f"'page_size' must be between 1 and {SIMULATED_MAX_PAGE_SIZE}"),
+        'seed': (0, MAX_SEED - 1, f"'seed' must be an integer between 0 and {MAX_SEED - 1}")
+    }
+    simulation = {}
+    for name, (low, high, message) in limits.items():
+        if data.get(name) is None:
+            continue
+        try:
+            value = int(data[name])
+        except (TypeError, ValueError):
+            raise ValueError(message)
+        if value < low or (high is not None and value > high):
+            raise ValueError(message)
+        simulation[name] = value
+    return simulation
+
+def wants_timings(args):
+    """Whether the request asked for per-stage timings (?debug=timings)"""
+    return 'timings' in args.get('debug', '').split(',')
+
+def interpretation_summary(query):
+    return f"Query analysis for: {query}"
+
+def format_query_response(query, result, simulation=None):
+    """Format a processed query result for frontend compatibility"""
+    response = {
+        "success": True,
+        "query": query,
+        "nlp_analysis": format_nlp_analysis(result),
+        "fhir_query": result.get('fhir_query', {}),
+        "formatted_url": result.get('formatted_url', ''),
+        "clinical_interpretation": format_clinical_interpretation(query, result),
+        "simulated_results": generate_simulated_results(result, query, **(simulation or {}))
+    }
+    response.update(format_fhir_results(result))
+    if 'query_plan' in result:
+        response["query_plan"] = result['query_plan']
+    return response
+
+def format_nlp_analysis(result):
+    """The nlp_analysis block of a query response"""
+    nlp_analysis = {
+        "intent": result.get('nlp_analysis', {}).get('intent', 'unknown'),
+        "entities": result.get('nlp_analysis', {}).get('entities', {}),
+        "confidence": result.get('nlp_analysis', {}).get('confidence', 0.8),
+        "sentiment": {
+            "urgency_score": result.get('nlp_analysis', {}).get('sentiment', {}).get('urgency_score', 0.3),
+            "polarity": result.get('nlp_analysis', {}).get('sentiment', {}).get('polarity', 'neutral')
+        }
+    }
+    if 'timings' in result.get('nlp_analysis', {}):
+        nlp_analysis["timings"] = result['nlp_analysis']['timings']
+    return nlp_analysis
+
+def format_clinical_interpretation(query, result):
+    """The clinical_interpretation block of a query response"""
+    return {
+        "summary": interpretation_summary(query),
+        "urgency_level": determine_urgency_level(result),
+        "priority_level": determine_priority_level(result),
+        "recommendations": generate_recommendations(result)
+    }
+
+def format_fhir_results(result):
+    """Real FHIR search results of an executed query or query plan (empty when not executed)"""
+    fhir_results = {}
+    if 'fhir_execution' in result:
+        # The Bundle from the server, or the error that prevented it
+        execution = result['fhir_execution']
+        fhir_results["fhir_bundle"] = execution.get('bundle')
+        fhir_results["fhir_execution"] = {key: value for key, value in execution.items() if key != 'bundle'}
+    if 'query_plan_results' in result:
+        fhir_results["query_plan_results"] = result['query_plan_results']
+    return fhir_results
+
+def determine_urgency_level(fhir_result):
+    """Determine urgency level based on NLP analysis"""
+    urgency_keywords = ['emergency', 'urgent', 'critical', 'severe']
+    nlp_analysis = fhir_result.get('nlp_analysis', {})
+    entities = nlp_analysis.get('entities', {})
+    
+    # Check for urgency keywords in entities
+    for entity_type, entity_list in entities.items():
+        if isinstance(entity_list, list):
+            for entity in entity_list:
+                if any(keyword in str(entity).lower() for keyword in urgency_keywords):
+                    return 'high'
+    
+    return 'medium'
+
+def determine_priority_level(fhir_result):
+    """Determine priority level based on query complexity"""
+    fhir_query = fhir_result.get('fhir_query', {})
+    
+    # More complex queries get higher priority
+    if len(fhir_query) > 3:
+        return 'high'
+    elif len(fhir_query) > 1:
+        return 'medium'
+    else:
+        return 'low'
+
+def generate_recommendations(fhir_result):
+    """Generate clinical recommendations based on query analysis"""
+    recommendations = []
+    nlp_analysis = fhir_result.get('nlp_analysis', {})
+    entities = nlp_analysis.get('entities', {})
+    
+    # Generate recommendations based on entities
+    if 'conditions' in entities:
+        recommendations.append("Consider reviewing recent lab results and vital signs")
+        recommendations.append("Monitor patient for symptom progression")
+    
+    if 'medications' in entities:
+        recommendations.append("Check for drug interactions and allergies")
+        recommendations.append("Verify medication dosage and administration schedule")
+    
+    if 'observations' in entities:
+        recommendations.append("Compare with historical trends and normal ranges")
+        recommendations.append("Consider additional diagnostic tests if abnormal")
+    
+    # Default recommendations if none generated
+    if not recommendations:
+        recommendations = [
+            "Review complete patient history",
+            "Consider consultation with specialist if needed",
+            "Follow up with patient within appropriate timeframe"
+        ]
+    
+    return recommendations
+
+def generate_simulated_results(fhir_result, original_query, page=1, page_size=None, seed=None):
+    """
+    Generate simulated FHIR results based on the query analysis.
+    Results are one page of a seeded cohort: the same seed always gives the same patients,
+    so any page can be requested later (the seed is returned under "pagination").
+    """
+    cohort, patient_count, pagination = simulated_cohort(fhir_result, page, page_size, seed)
+    results = build_simulated_results(cohort, patient_count, original_query)
+    results["pagination"] = pagination
+    return results
+
+def simulated_cohort(fhir_result, page=1, page_size=None, seed=None):
+    """One page of the seeded simulated cohort for a query; returns (cohort, patient count, pagination)"""
+    nlp_analysis = fhir_result.get('nlp_analysis', {})
+    entities = nlp_analysis.get('entities', {})
+    page_size = page_size or SIMULATED_PAGE_SIZE
+    if seed is None:
+        seed = random.randrange(MAX_SEED)
+    
+    if NUMPY_AVAILABLE:
+        # Regenerates only the requested page; aggregates are cached per seed
+        patient_count = cohort_size(seed, SIMULATED_COHORT_SIZE)
+        cohort = simulate_cohort(entities, patient_count, seed, page, page_size)
+    else:
+        patient_count, cohort = simulate_cohort_per_patient(entities, seed, page, page_size)
+    
+    total_pages = -(-patient_count // page_size)
+    pagination = {
+        "page": page,
+        "pageSize": page_size,
+        "totalPages": total_pages,
+        "seed": seed,
+        "nextPage": page + 1 if page < total_pages else None
+    }
+    return cohort, patient_count, pagination
+
+def simulate_cohort_per_patient(entities, seed, page, page_size):
+    """Seeded cohort generated one patient at a time (without NumPy); returns (patient count, cohort)"""
+    rng = random.Random(seed)
+    
+    # Extract relevant information
+    conditions = entities.get('conditions', [])
+    ages = entities.get('ages', [])
+    genders = entities.get('genders', [])
+    medications = entities.get('medications', [])
+    
+    # Generate mock patients
+    patients = []
+    patient_count = SIMULATED_COHORT_SIZE or rng.randint(3, 8)
+    
+    for i in range(patient_count):
+        patient_id = f"patient-{rng.getrandbits(32):08x}"
+        
+        # Determine patient characteristics
+        patient_age = ages[0] + rng.randint(-10, 10) if ages else rng.randint(25, 75)
+        patient_gender = rng.choice(genders) if genders else rng.choice(['male', 'female'])
+        patient_conditions = conditions if conditions else ['hypertension', 'diabetes']
+        
+        patient = {
+            "id": patient_id,
+            "name": rng.choice(SAMPLE_NAMES),
+            "age": max(18, patient_age),
+            "gender": patient_gender,
+            "birthDate": f"{2024 - patient_age}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "conditions": patient_conditions[:2],  # Limit to 2 conditions
+            "medications": medications[:3] if medications else ["aspirin", "lisinopril"],
+            "lastVisit": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "mrn": f"MRN{rng.randint(100000, 999999)}",
+            "status": rng.choice(["active", "inactive"]),
+            "contactInfo": {
+                "phone": f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(1000, 9999)}",
+                "email": f"patient{i+1}@example.com"
+            }
+        }
+        patients.append(patient)
+    
+    # Age distribution
+    age_groups = {'18-30': 0, '31-45': 0, '46-60': 0, '61-75': 0, '75+': 0}
+    for patient in patients:
+        age = patient['age']
+        if age <= 30:
+            age_groups['18-30'] += 1
+        elif age <= 45:
+            age_groups['31-45'] += 1
+        elif age <= 60:
+            age_groups['46-60'] += 1
+        elif age <= 75:
+            age_groups['61-75'] += 1
+        else:
+            age_groups['75+'] += 1
+    
+    # Gender distribution
+    gender_counts = {}
+    for patient in patients:
+        gender_counts[patient['gender']] = gender_counts.get(patient['gender'], 0) + 1
+    
+    # Condition distribution
+    condition_counts = {}
+    for patient in patients:
+        for condition in patient['conditions']:
+            condition_counts[condition] = condition_counts.get(condition, 0) + 1
+    
+    start = (page - 1) * page_size
+    cohort = {
+        "patients": patients[start:start + page_size],
+        "age_groups": age_groups,
+        "gender_counts": gender_counts,
+        "condition_counts": condition_counts,
+        "avg_age": sum(p["age"] for p in patients) / len(patients) if patients else 0,
+        "active": len([p for p in patients if p["status"] == "active"])
+    }
+    return patient_count, cohort
+
+def build_simulated_results(cohort, total_count, original_query):
+    """Build the simulated_results response (patients, chart data, summary) from a simulated cohort"""
+    # Generate chart data for visualizations
+    chart_data = []
+    for age_group, count in cohort['age_groups'].items():
+        if count > 0:
+            chart_data.append({
+                "name": age_group,
+                "value": count,
+                "color": f"#{''.join([hex(hash(age_group + str(i)))[-1] for i in range(6)])}"
+            })
+    
+    gender_counts = dict({'male': 0, 'female': 0}, **cohort['gender_counts'])
+    gender_chart_data = []
+    for gender, count in gender_counts.items():
+        if count > 0:
+            gender_chart_data.append({
+                "name": gender.title(),
+                "value": count,
+                "color": "#3B82F6" if gender == 'male' else "#EF4444"
+            })
+    
+    condition_chart_data = []
+    colors = ['#10B981', '#F59E0B', '#8B5CF6', '#06B6D4', '#F97316', '#84CC16']
+    for i, (condition, count) in enumerate(cohort['condition_counts'].items()):
+        condition_chart_data.append({
+            "name": condition.title(),
+            "value": count,
+            "color": colors[i % len(colors)]
+        })
+    
+    patients = cohort['patients']
+    return {
+        "patients": patients,
+        "totalCount": total_count,
+        "chartData": {
+            "ageDistribution": chart_data,
+            "genderDistribution": gender_chart_data,
+            "conditionDistribution": condition_chart_data
+        },
+        "summary": {
+            "avgAge": cohort['avg_age'],
+            "genderDistribution": gender_counts,
+            "totalConditions": len(cohort['condition_counts']),
+            "activePatients": cohort['active']
+        },
+        "queryInfo": {
+            "originalQuery": original_query,
+            "processedAt": datetime.now().isoformat(),
+            "resultsGenerated": len(patients)
+        }
+    }
+
+# Prefix/typo-tolerant suggestion index, ranked by how often each query is asked
+autocomplete = Autocomplete(SUGGESTIONS, history_min_count=SUGGESTION_HISTORY_MIN_COUNT,
+                            history_size=SUGGESTION_HISTORY_SIZE, limit=SUGGESTION_LIMIT)
+
+def lexicon_suggestions(service):
+    """Suggestion phrases for the service's condition and observation lexicon (one per code)"""
+    phrases, codes = [], set()
+    for template, lexicon in (("Find patients with {}", service.condition_codes),
+                              ("Show recent {} observations", service.observation_codes)):
+        for term, coding in lexicon.items():
+            if coding["code"] not in codes:
+                codes.add(coding["code"])
+                phrases.append(template.format(term))
+    return phrases
+
+def client_address(headers, peer_address):
+    """Address identifying the caller of a request, for counting distinct callers"""
+    if CLIENT_IP_HEADER:
+        return headers.get(CLIENT_IP_HEADER) or peer_address
+    return peer_address
+
+def remember_query(query, result, caller):
+    """
+    Count a successfully parsed query from ``caller`` towards its suggestion weight. Queries
+    naming a patient or a patient ID are never recorded, so they cannot become suggestions.
+    """
+    if 'error' in result.get('fhir_query', {}):
+        return
+    entities = result.get('nlp_analysis', {}).get('entities', {})
+    if entities.get('names') or entities.get('patient_ids'):
+        return
+    autocomplete.record(query, caller)
+
+def filter_suggestions(query):
+    """Return autocomplete suggestions, optionally filtered by a query fragment"""
+    if query:
+        return autocomplete.suggest(query)
+    return SUGGESTIONS
+
+# The unfiltered /api/suggestions response never changes, so it is serialized once
+SUGGESTIONS_BODY = dumps({"suggestions": SUGGESTIONS})
+
+def suggestions_body(query):
+    """Serialized /api/suggestions response for a query fragment ('' for all suggestions)"""
+    if not query:
+        return SUGGESTIONS_BODY
+    return dumps({"suggestions": filter_suggestions(query)})
+
+def build_patient_details(patient_id):
+    """Build detailed (mock) information for a specific patient"""
+    # This would typically query a real database
+    # For now, return mock detailed patient data
+    
+    patient_details = {
+        "id": patient_id,
+        "name": "John Doe",
+        "age": 45,
+        "gender": "male",
+        "birthDate": "1979-03-15",
+        "mrn": f"MRN{random.randint(100000, 999999)}",
+        "conditions": ["Type 2 Diabetes", "Hypertension"],
+        "medications": [
+            {"name": "Metformin", "dosage": "500mg", "frequency": "twice daily"},
+            {"name": "Lisinopril", "dosage": "10mg", "frequency": "once daily"}
+        ],
+        "vitalSigns": {
+            "bloodPressure": "140/90 mmHg",
+            "heartRate": "72 bpm",
+            "temperature": "98.6°F",
+            "weight": "180 lbs",
+            "height": "5'10\""
+        },
+        "recentVisits": [
+            {
+                "date": "2024-05-15",
+                "type": "Regular Checkup",
+                "provider": "Dr. Smith",
+                "notes": "Blood pressure elevated, medication adjusted"
+            },
+            {
+                "date": "2024-03-10",
+                "type": "Lab Work",
+                "provider": "Dr. Johnson",
+                "notes": "HbA1c levels within target range"
+            }
+        ],
+        "allergies": ["Penicillin", "Shellfish"],
+        "emergencyContact": {
+            "name": "Jane Doe",
+            "relationship": "Spouse",
+            "phone": "(555) 123-4567"
+        }
+    }
+    
+    return patient_details
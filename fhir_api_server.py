@@ -5,28 +5,77 @@ Flask-based REST API server that wraps the FHIR Query Service
 for communication with the React frontend.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import json
 import logging
 import traceback
 from datetime import datetime
-import uuid
-import random
 
 # Import our FHIR Query Service
 from fhir_query_service import FHIRQueryService
+from fhir_coalesce import SingleFlight
+from fhir_json import SERIALIZER_NAME, compress, compressible, dumps, loads
+from fhir_api_common import (
+    MAX_BATCH_QUERIES,
+    NDJSON,
+    QUERY_COALESCING,
+    service_config,
+    create_fhir_client,
+    wants_timings,
+    wants_ndjson,
+    parse_simulation_params,
+    coalesce_key,
+    response_for_query,
+    process_query_request,
+    analyze_query_request,
+    stream_query_response,
+    process_batch_request,
+    stream_fhir_resources,
+    parse_page_size,
+    autocomplete,
+    lexicon_suggestions,
+    client_address,
+    remember_query,
+    suggestions_body,
+    build_patient_details
+)
+from fhir_metrics import METRICS_ENABLED, track_request, record_query, record_coalesced, metrics_payload
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() and request.get_json() through fhir_json (orjson when installed)"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        # Skips the bytes -> str -> bytes round trip of DefaultJSONProvider.response; arguments
+        # are interpreted as jsonify() does (none: null, one: itself, several: a list)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)  # Enable CORS for React frontend
 
 # Initialize the FHIR service
-fhir_service = FHIRQueryService()
+fhir_service = FHIRQueryService(**service_config())
+autocomplete.add_suggestions(lexicon_suggestions(fhir_service))
+
+# Pooled client for executing queries against FHIR_SERVER_URL (None unless FHIR_EXECUTE=1)
+fhir_client = create_fhir_client()
+
+# Shares one computation between concurrent identical queries (None when QUERY_COALESCING=0)
+query_flight = SingleFlight() if QUERY_COALESCING else None
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -35,317 +84,175 @@ def health_check():
         "status": "healthy",
         "service": "FHIR Query API",
         "timestamp": datetime.now().isoformat(),
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "model_ready": fhir_service.model_ready,
+        "nlp_method": "spaCy Enhanced" if fhir_service.nlp else "regex",
+        "fhir_server": fhir_service.base_url,
+        "fhir_execution": fhir_client is not None,
+        "fhir_cache": fhir_client.cache.stats() if fhir_client and fhir_client.cache else {"enabled": False},
+        "cache": fhir_service.cache_stats(),
+        "timings": fhir_service.timing_stats(),
+        "serializer": SERIALIZER_NAME,
+        "suggestions": autocomplete.stats(),
+        "coalescing": {
+            "queries": query_flight.stats() if query_flight else {"enabled": False},
+            "upstream": fhir_client.coalescing_stats() if fhir_client else {"enabled": False}
+        }
     })
 
 @app.route('/api/query', methods=['POST'])
 def process_query():
     """Process natural language query and return FHIR results"""
-    try:
-        data = request.get_json()
-        
-        if not data or 'query' not in data:
-            return jsonify({"error": "Missing 'query' parameter"}), 400
-        
-        query = data['query']
-        logger.info(f"Processing query: {query}")
-        
-        # Process the query using our FHIR service
-        result = fhir_service.process_patient_query(query)
-        
-        # Format response for frontend compatibility
-        response = {
-            "success": True,
-            "query": query,
-            "nlp_analysis": {
-                "intent": result.get('nlp_analysis', {}).get('intent', 'unknown'),
-                "entities": result.get('nlp_analysis', {}).get('entities', {}),
-                "confidence": result.get('nlp_analysis', {}).get('confidence', 0.8),
-                "sentiment": {
-                    "urgency_score": result.get('nlp_analysis', {}).get('sentiment', {}).get('urgency_score', 0.3),
-                    "polarity": result.get('nlp_analysis', {}).get('sentiment', {}).get('polarity', 'neutral')
-                }
-            },
-            "fhir_query": result.get('fhir_query', {}),
-            "formatted_url": result.get('formatted_url', ''),
-            "clinical_interpretation": {
-                "summary": f"Query analysis for: {query}",
-                "urgency_level": determine_urgency_level(result),
-                "priority_level": determine_priority_level(result),
-                "recommendations": generate_recommendations(result)
-            },
-            "simulated_results": generate_simulated_results(result, query)
-        }
-        
-        logger.info(f"Query processed successfully: {query}")
-        return jsonify(response)
-        
-    except Exception as e:
-        logger.error(f"Error processing query: {str(e)}")
-        logger.error(traceback.format_exc())
-        return jsonify({
-            "success": False,
-            "error": str(e),
-            "timestamp": datetime.now().isoformat()
-        }), 500
-
-def determine_urgency_level(fhir_result):
-    """Determine urgency level based on NLP analysis"""
-    urgency_keywords = ['emergency', 'urgent', 'critical', 'severe']
-    nlp_analysis = fhir_result.get('nlp_analysis', {})
-    entities = nlp_analysis.get('entities', {})
-    
-    # Check for urgency keywords in entities
-    for entity_type, entity_list in entities.items():
-        if isinstance(entity_list, list):
-            for entity in entity_list:
-                if any(keyword in str(entity).lower() for keyword in urgency_keywords):
-                    return 'high'
-    
-    return 'medium'
+    with track_request('/api/query') as tracked:
+        try:
+            data = request.get_json()
+            
+            if not data or 'query' not in data:
+                tracked["status"] = 400
+                return jsonify({"error": "Missing 'query' parameter"}), 400
+            
+            query = data['query']
+            logger.debug(f"Processing query: {query}")
+            try:
+                simulation = parse_simulation_params(data)
+            except ValueError as e:
+                tracked["status"] = 400
+                return jsonify({"error": str(e)}), 400
+            
+            # Process the query and format the response for frontend compatibility
+            # (?debug=timings adds per-stage timings, "plan": true the multi-resource query plan,
+            # page / page_size / seed select a page of the simulated results)
+            timings, plan = wants_timings(request.args), bool(data.get('plan'))
+            caller = client_address(request.headers, request.remote_addr)
+            if wants_ndjson(request.headers):
+                # Streamed response: the NLP frame goes out before execution and simulated results
+                result, sample = analyze_query_request(fhir_service, query, timings, METRICS_ENABLED, plan)
+                remember_query(query, result, caller)
+                return Response(stream_with_context(stream_query_response(query, result, sample, simulation,
+                                                                          fhir_client)),
+                                mimetype=NDJSON)
+            
+            options = dict(timings=timings, collect_metrics=METRICS_ENABLED, fhir_client=fhir_client, plan=plan,
+                           simulation=simulation)
+            if query_flight is not None:
+                # Identical queries already in flight are answered by that computation
+                (response, sample), shared = query_flight.do(coalesce_key(query, timings, plan, simulation),
+                                                             process_query_request, fhir_service, query, **options)
+                response = response_for_query(response, query)
+            else:
+                (response, sample), shared = process_query_request(fhir_service, query, **options), False
+            if shared:
+                record_coalesced('/api/query')
+            else:
+                record_query(sample)
+            remember_query(query, response, caller)
+            
+            logger.debug(f"Query processed successfully: {query}")
+            return jsonify(response)
+            
+        except Exception as e:
+            tracked["status"] = 500
+            logger.error(f"Error processing query: {str(e)}")
+            logger.error(traceback.format_exc())
+            return jsonify({
+                "success": False,
+                "error": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 500
 
-def determine_priority_level(fhir_result):
-    """Determine priority level based on query complexity"""
-    fhir_query = fhir_result.get('fhir_query', {})
-    
-    # More complex queries get higher priority
-    if len(fhir_query) > 3:
-        return 'high'
-    elif len(fhir_query) > 1:
-        return 'medium'
-    else:
-        return 'low'
+@app.route('/api/query/batch', methods=['POST'])
+def process_query_batch():
+    """Process a batch of natural language queries, returning results in input order"""
+    with track_request('/api/query/batch') as tracked:
+        try:
+            data = request.get_json()
+            
+            if not data or 'queries' not in data:
+                tracked["status"] = 400
+                return jsonify({"error": "Missing 'queries' parameter"}), 400
+            
+            queries = data['queries']
+            if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+                tracked["status"] = 400
+                return jsonify({"error": "'queries' must be a list of strings"}), 400
+            if len(queries) > MAX_BATCH_QUERIES:
+                tracked["status"] = 400
+                return jsonify({"error": f"Batch exceeds maximum of {MAX_BATCH_QUERIES} queries"}), 400
+            
+            logger.debug(f"Processing query batch of {len(queries)}")
+            
+            results, samples = process_batch_request(fhir_service, queries, fhir_client=fhir_client)
+            for sample in samples:
+                record_query(sample)
+            
+            return jsonify({
+                "success": True,
+                "count": len(results),
+                "results": results
+            })
+            
+        except Exception as e:
+            tracked["status"] = 500
+            logger.error(f"Error processing query batch: {str(e)}")
+            logger.error(traceback.format_exc())
+            return jsonify({
+                "success": False,
+                "error": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 500
 
-def generate_recommendations(fhir_result):
-    """Generate clinical recommendations based on query analysis"""
-    recommendations = []
-    nlp_analysis = fhir_result.get('nlp_analysis', {})
-    entities = nlp_analysis.get('entities', {})
-    
-    # Generate recommendations based on entities
-    if 'conditions' in entities:
-        recommendations.append("Consider reviewing recent lab results and vital signs")
-        recommendations.append("Monitor patient for symptom progression")
-    
-    if 'medications' in entities:
-        recommendations.append("Check for drug interactions and allergies")
-        recommendations.append("Verify medication dosage and administration schedule")
-    
-    if 'observations' in entities:
-        recommendations.append("Compare with historical trends and normal ranges")
-        recommendations.append("Consider additional diagnostic tests if abnormal")
+@app.route('/api/query/resources', methods=['POST'])
+def stream_query_resources():
+    """Execute the query's FHIR search and stream every matching resource as NDJSON"""
+    data = request.get_json(silent=True)
+    if not data or 'query' not in data:
+        return jsonify({"error": "Missing 'query' parameter"}), 400
+    if fhir_client is None:
+        return jsonify({"error": "FHIR execution is disabled (set FHIR_EXECUTE=1)"}), 503
+    try:
+        page_size = parse_page_size(data.get('page_size'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'page_size' must be a positive integer"}), 400
     
-    # Default recommendations if none generated
-    if not recommendations:
-        recommendations = [
-            "Review complete patient history",
-            "Consider consultation with specialist if needed",
-            "Follow up with patient within appropriate timeframe"
-        ]
+    fhir_query = fhir_service.process_patient_query(data['query'])['fhir_query']
+    if 'error' in fhir_query:
+        return jsonify({"error": fhir_query['error']}), 400
     
-    return recommendations
+    # Resources are written as they arrive, page by page, instead of buffering the cohort
+    return Response(stream_with_context(stream_fhir_resources(fhir_client, fhir_query, page_size)),
+                    mimetype=NDJSON)
 
-def generate_simulated_results(fhir_result, original_query):
-    """Generate simulated FHIR results based on the query analysis"""
-    nlp_analysis = fhir_result.get('nlp_analysis', {})
-    entities = nlp_analysis.get('entities', {})
-    
-    # Extract relevant information
-    conditions = entities.get('conditions', [])
-    ages = entities.get('ages', [])
-    genders = entities.get('genders', [])
-    medications = entities.get('medications', [])
-    
-    # Generate mock patients
-    patients = []
-    patient_count = random.randint(3, 8)
-    
-    # Sample names for mock patients
-    sample_names = [
-        "John Smith", "Sarah Johnson", "Michael Brown", "Emily Davis",
-        "David Wilson", "Jessica Garcia", "Robert Miller", "Ashley Rodriguez",
-        "Christopher Martinez", "Amanda Anderson", "Matthew Taylor", "Jennifer Thomas"
-    ]
-    
-    for i in range(patient_count):
-        patient_id = f"patient-{uuid.uuid4().hex[:8]}"
-        
-        # Determine patient characteristics
-        patient_age = ages[0] + random.randint(-10, 10) if ages else random.randint(25, 75)
-        patient_gender = random.choice(genders) if genders else random.choice(['male', 'female'])
-        patient_conditions = conditions if conditions else ['hypertension', 'diabetes']
-        
-        patient = {
-            "id": patient_id,
-            "name": random.choice(sample_names),
-            "age": max(18, patient_age),
-            "gender": patient_gender,
-            "birthDate": f"{2024 - patient_age}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
-            "conditions": patient_conditions[:2],  # Limit to 2 conditions
-            "medications": medications[:3] if medications else ["aspirin", "lisinopril"],
-            "lastVisit": f"2024-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
-            "mrn": f"MRN{random.randint(100000, 999999)}",
-            "status": random.choice(["active", "inactive"]),
-            "contactInfo": {
-                "phone": f"({random.randint(200, 999)}) {random.randint(200, 999)}-{random.randint(1000, 9999)}",
-                "email": f"patient{i+1}@example.com"
-            }
-        }
-        patients.append(patient)
-    
-    # Generate chart data for visualizations
-    chart_data = []
-    
-    # Age distribution
-    age_groups = {'18-30': 0, '31-45': 0, '46-60': 0, '61-75': 0, '75+': 0}
-    for patient in patients:
-        age = patient['age']
-        if age <= 30:
-            age_groups['18-30'] += 1
-        elif age <= 45:
-            age_groups['31-45'] += 1
-        elif age <= 60:
-            age_groups['46-60'] += 1
-        elif age <= 75:
-            age_groups['61-75'] += 1
-        else:
-            age_groups['75+'] += 1
-    
-    for age_group, count in age_groups.items():
-        if count > 0:
-            chart_data.append({
-                "name": age_group,
-                "value": count,
-                "color": f"#{''.join([hex(hash(age_group + str(i)))[-1] for i in range(6)])}"
-            })
-    
-    # Gender distribution
-    gender_counts = {'male': 0, 'female': 0}
-    for patient in patients:
-        gender_counts[patient['gender']] += 1
-    
-    gender_chart_data = []
-    for gender, count in gender_counts.items():
-        if count > 0:
-            gender_chart_data.append({
-                "name": gender.title(),
-                "value": count,
-                "color": "#3B82F6" if gender == 'male' else "#EF4444"
-            })
-    
-    # Condition distribution
-    condition_counts = {}
-    for patient in patients:
-        for condition in patient['conditions']:
-            condition_counts[condition] = condition_counts.get(condition, 0) + 1
-    
-    condition_chart_data = []
-    colors = ['#10B981', '#F59E0B', '#8B5CF6', '#06B6D4', '#F97316', '#84CC16']
-    for i, (condition, count) in enumerate(condition_counts.items()):
-        condition_chart_data.append({
-            "name": condition.title(),
-            "value": count,
-            "color": colors[i % len(colors)]
-        })
-    
-    return {
-        "patients": patients,
-        "totalCount": len(patients),
-        "chartData": {
-            "ageDistribution": chart_data,
-            "genderDistribution": gender_chart_data,
-            "conditionDistribution": condition_chart_data
-        },
-        "summary": {
-            "avgAge": sum(p["age"] for p in patients) / len(patients) if patients else 0,
-            "genderDistribution": gender_counts,
-            "totalConditions": len(condition_counts),
-            "activePatients": len([p for p in patients if p["status"] == "active"])
-        },
-        "queryInfo": {
-            "originalQuery": original_query,
-            "processedAt": datetime.now().isoformat(),
-            "resultsGenerated": len(patients)
-        }
-    }
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics (aggregated across worker processes in multi-process mode)"""
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    body, content_type = metrics_payload()
+    return Response(body, content_type=content_type)
 
 @app.route('/api/suggestions', methods=['GET'])
 def get_suggestions():
     """Get autocomplete suggestions for queries"""
-    suggestions = [
-        "Show me all diabetic patients over 50",
-        "Find blood pressure observations for recent patients",
-        "Get active diabetes conditions",
-        "List all female patients with hypertension",
-        "Show heart rate measurements from last month",
-        "Find patients with chest pain symptoms",
-        "Get medication list for diabetes patients",
-        "Show recent emergency room visits",
-        "Find patients with abnormal lab results",
-        "List hypertensive patients on ACE inhibitors",
-        "Show pediatric patients with asthma",
-        "Get cardiac patients over 65",
-        "Find patients with depression diagnosis",
-        "Show pregnant patients due this month",
-        "Get patients with chronic kidney disease"
-    ]
-    
     # Optional: filter suggestions based on query parameter
-    query = request.args.get('q', '').lower()
-    if query:
-        filtered_suggestions = [s for s in suggestions if query in s.lower()]
-        return jsonify({"suggestions": filtered_suggestions[:10]})
-    
-    return jsonify({"suggestions": suggestions})
+    return Response(suggestions_body(request.args.get('q', '')), mimetype='application/json')
 
 @app.route('/api/patients/<patient_id>', methods=['GET'])
 def get_patient_details(patient_id):
     """Get detailed information for a specific patient"""
-    # This would typically query a real database
-    # For now, return mock detailed patient data
-    
-    patient_details = {
-        "id": patient_id,
-        "name": "John Doe",
-        "age": 45,
-        "gender": "male",
-        "birthDate": "1979-03-15",
-        "mrn": f"MRN{random.randint(100000, 999999)}",
-        "conditions": ["Type 2 Diabetes", "Hypertension"],
-        "medications": [
-            {"name": "Metformin", "dosage": "500mg", "frequency": "twice daily"},
-            {"name": "Lisinopril", "dosage": "10mg", "frequency": "once daily"}
-        ],
-        "vitalSigns": {
-            "bloodPressure": "140/90 mmHg",
-            "heartRate": "72 bpm",
-            "temperature": "98.6°F",
-            "weight": "180 lbs",
-            "height": "5'10\""
-        },
-        "recentVisits": [
-            {
-                "date": "2024-05-15",
-                "type": "Regular Checkup",
-                "provider": "Dr. Smith",
-                "notes": "Blood pressure elevated, medication adjusted"
-            },
-            {
-                "date": "2024-03-10",
-                "type": "Lab Work",
-                "provider": "Dr. Johnson",
-                "notes": "HbA1c levels within target range"
-            }
-        ],
-        "allergies": ["Penicillin", "Shellfish"],
-        "emergencyContact": {
-            "name": "Jane Doe",
-            "relationship": "Spouse",
-            "phone": "(555) 123-4567"
-        }
-    }
-    
-    return jsonify(patient_details)
+    return jsonify(build_patient_details(patient_id))
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-encode complete JSON and text bodies above COMPRESSION_MIN_BYTES"""
+    if response.direct_passthrough or response.is_streamed or not compressible(response.mimetype):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' not in response.headers:
+        body, encoding = compress(response.get_data(), request.headers.get('Accept-Encoding', ''))
+        if encoding:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = encoding
+    return response
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -361,8 +268,11 @@ if __name__ == '__main__':
     print("🔍 Available endpoints:")
     print("   - GET  /api/health")
     print("   - POST /api/query")
+    print("   - POST /api/query/batch")
+    print("   - POST /api/query/resources (NDJSON)")
     print("   - GET  /api/suggestions")
     print("   - GET  /api/patients/<patient_id>")
+    print("   - GET  /metrics")
     print("🚀 Server starting...")
     
     app.run(debug=True, host='0.0.0.0', port=5001)
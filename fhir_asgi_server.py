@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+FHIR Query API Server (ASGI)
+Async variant of fhir_api_server.py with the same REST contract. CPU-bound NLP work runs
+in a bounded process pool, so the event loop keeps serving I/O while queries are processed.
+
+Run with:  uvicorn fhir_asgi_server:app --host 0.0.0.0 --port 5002
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import iterate_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from fhir_coalesce import AsyncSingleFlight
+from fhir_json import SERIALIZER_NAME, compress, compressible, dumps, loads
+from fhir_api_common import (
+    MAX_BATCH_QUERIES,
+    NDJSON,
+    QUERY_COALESCING,
+    service_config,
+    create_fhir_client,
+    wants_timings,
+    wants_ndjson,
+    parse_simulation_params,
+    coalesce_key,
+    response_for_query,
+    process_query_request,
+    analyze_query_request,
+    stream_query_response,
+    process_batch_request,
+    stream_fhir_resources,
+    parse_page_size,
+    autocomplete,
+    lexicon_suggestions,
+    client_address,
+    remember_query,
+    suggestions_body,
+    build_patient_details
+)
+from fhir_metrics import METRICS_ENABLED, track_request, record_query, record_coalesced, metrics_payload
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Process pool settings
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', str(os.cpu_count() or 1)))
+ASGI_MAX_PENDING = int(os.environ.get('ASGI_MAX_PENDING', str(ASGI_WORKERS * 4)))
+ASGI_QUEUE_TIMEOUT = float(os.environ.get('ASGI_QUEUE_TIMEOUT', '30'))
+ASGI_START_METHOD = os.environ.get('ASGI_START_METHOD', 'spawn')
+
+# Seconds a pool worker waits at start-up for the others to load their models
+WORKER_READY_TIMEOUT = 300
+
+# --- Process pool workers -------------------------------------------------
+# Each worker process holds its own FHIRQueryService, created once by the initializer.
+
+_worker_service = None
+_worker_fhir_client = None
+
+def _init_worker(config, ready=None):
+    """
+    Load the FHIR service (and the FHIR client, when executing queries) in a pool worker,
+    then wait at the ``ready`` barrier until every worker has done the same. Workers blocked
+    there are busy, so the pool starts a new process for each warm-up submission and no
+    worker is left to load its model on a real request.
+    """
+    global _worker_service, _worker_fhir_client
+    from fhir_query_service import FHIRQueryService
+    # Workers are already separate processes, so load eagerly and keep nlp.pipe in-process
+    _worker_service = FHIRQueryService(**dict(config, lazy_load=False, n_process=1))
+    _worker_fhir_client = create_fhir_client()
+    if ready is not None:
+        try:
+            ready.wait(WORKER_READY_TIMEOUT)
+        except threading.BrokenBarrierError:
+            logger.warning(f"Worker {os.getpid()} started without the rest of the pool")
+
+def _worker_status():
+    """Report whether the worker's NLP model is loaded"""
+    return {
+        "model_ready": _worker_service.model_ready,
+        "nlp_method": "spaCy Enhanced" if _worker_service.nlp else "regex",
+        "fhir_server": _worker_service.base_url,
+        "fhir_execution": _worker_fhir_client is not None,
+        "lexicon_suggestions": lexicon_suggestions(_worker_service)
+    }
+
+def _process_query(query, timings=False, plan=False, simulation=None):
+    """Process one query and format it for the frontend; returns (response, metrics sample)"""
+    return process_query_request(_worker_service, query, timings=timings, collect_metrics=METRICS_ENABLED,
+                                 fhir_client=_worker_fhir_client, plan=plan, simulation=simulation)
+
+def _analyze_query(query, timings=False, plan=False):
+    """NLP analysis of one query for a streamed response; returns (result, metrics sample)"""
+    return analyze_query_request(_worker_service, query, timings, METRICS_ENABLED, plan)
+
+def _build_fhir_query(query):
+    """Process one query and return only its FHIR query"""
+    return _worker_service.process_patient_query(query)['fhir_query']
+
+def _process_query_batch(queries):
+    """Process a batch of queries and format each result; returns (responses, metrics samples)"""
+    return process_batch_request(_worker_service, queries, fhir_client=_worker_fhir_client)
+
+# --- Application ----------------------------------------------------------
+
+class WorkerPool:
+    """Process pool with a bound on in-flight submissions"""
+
+    def __init__(self, workers, max_pending, queue_timeout, start_method):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        context = multiprocessing.get_context(start_method)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(service_config(), context.Barrier(workers))
+        )
+        self.semaphore = asyncio.Semaphore(max_pending)
+        self.in_flight = 0
+        self.status = {"model_ready": False, "nlp_method": "unknown"}
+
+    async def run(self, func, *args):
+        """
+        Run func in the pool, waiting at most queue_timeout for a free slot. The slot is held
+        until the job finishes in its worker, even when the awaiting task is cancelled first.
+        """
+        await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self._release()
+            raise
+        # Done callbacks run in the executor's management thread
+        future.add_done_callback(lambda _: self._release_threadsafe(loop))
+        return await asyncio.wrap_future(future)
+
+    def _release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def _release_threadsafe(self, loop):
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # The event loop is closed (shutdown): nothing is left to release the slot for
+            pass
+
+    async def warm_up(self):
+        """Start every worker so models are loaded before traffic arrives"""
+        try:
+            statuses = await asyncio.gather(*(self.run(_worker_status) for _ in range(self.workers)))
+            # Every worker passed the start-up barrier, so all of them have loaded their models
+            self.status = dict(statuses[0], model_ready=all(status["model_ready"] for status in statuses))
+            logger.info(f"Worker pool ready: {self.workers} workers ({self.status['nlp_method']})")
+        except Exception as e:
+            logger.error(f"Worker pool warm-up failed: {str(e)}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+async def start_up(pool):
+    """Warm up the worker pool, then index the lexicon suggestions reported by its workers"""
+    await pool.warm_up()
+    autocomplete.add_suggestions(pool.status.get("lexicon_suggestions", []))
+
+@asynccontextmanager
+async def lifespan(app):
+    pool = WorkerPool(ASGI_WORKERS, ASGI_MAX_PENDING, ASGI_QUEUE_TIMEOUT, ASGI_START_METHOD)
+    app.state.pool = pool
+    # Streamed searches page through the FHIR server from this process, off the event loop
+    app.state.fhir_client = create_fhir_client()
+    # Identical queries in flight share one pool submission (None when QUERY_COALESCING=0)
+    app.state.query_flight = AsyncSingleFlight() if QUERY_COALESCING else None
+    warm_up = asyncio.create_task(start_up(pool))
+    try:
+        yield
+    finally:
+        warm_up.cancel()
+        pool.shutdown()
+        if app.state.fhir_client is not None:
+            app.state.fhir_client.close()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered by fhir_json (orjson when installed)"""
+
+    def render(self, content):
+        return dumps(content)
+
+class CompressionMiddleware:
+    """
+    gzip/brotli-encode complete JSON and text bodies above COMPRESSION_MIN_BYTES. Streamed
+    responses (NDJSON) pass through untouched so frames are not held back.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        accept_encoding = Headers(scope=scope).get('accept-encoding', '') if scope['type'] == 'http' else ''
+        if not accept_encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                # Held back until the first body message shows whether the response is streamed
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            headers = MutableHeaders(scope=start)
+            if compressible(headers.get('content-type')) and 'content-encoding' not in headers:
+                headers.add_vary_header('Accept-Encoding')
+                if not message.get('more_body', False):
+                    body, encoding = compress(message.get('body', b''), accept_encoding)
+                    if encoding:
+                        headers['Content-Encoding'] = encoding
+                        headers['Content-Length'] = str(len(body))
+                        message = dict(message, body=body)
+            await send(start)
+            start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+def error_response(message, status_code):
+    return FastJSONResponse({
+        "success": False,
+        "error": message,
+        "timestamp": datetime.now().isoformat()
+    }, status_code=status_code)
+
+async def read_json(request):
+    """Parse the JSON body, returning None when it is missing or invalid"""
+    try:
+        return loads(await request.body())
+    except ValueError:
+        return None
+
+async def health_check(request):
+    """Health check endpoint"""
+    pool = request.app.state.pool
+    return FastJSONResponse({
+        "status": "healthy",
+        "service": "FHIR Query API",
+        "timestamp": datetime.now().isoformat(),
+        "version": "1.0.0",
+        "model_ready": pool.status["model_ready"],
+        "nlp_method": pool.status["nlp_method"],
+        "fhir_server": pool.status.get("fhir_server"),
+        "fhir_execution": pool.status.get("fhir_execution", False),
+        "workers": pool.workers,
+        "in_flight": pool.in_flight,
+        "serializer": SERIALIZER_NAME,
+        "suggestions": autocomplete.stats(),
+        "coalescing": {
+            "queries": request.app.state.query_flight.stats() if request.app.state.query_flight else {"enabled": False}
+        }
+    })
+
+async def process_query(request):
+    """Process natural language query and return FHIR results"""
+    with track_request('/api/query') as tracked:
+        data = await read_json(request)
+        if not data or 'query' not in data:
+            tracked["status"] = 400
+            return FastJSONResponse({"error": "Missing 'query' parameter"}, status_code=400)
+
+        query = data['query']
+        logger.debug(f"Processing query: {query}")
+        try:
+            simulation = parse_simulation_params(data)
+        except ValueError as e:
+            tracked["status"] = 400
+            return FastJSONResponse({"error": str(e)}, status_code=400)
+
+        timings, plan = wants_timings(request.query_params), bool(data.get('plan'))
+        caller = client_address(request.headers, request.client.host if request.client else None)
+        args = (_process_query, query, timings, plan, simulation)
+        flight = request.app.state.query_flight
+        try:
+            if wants_ndjson(request.headers):
+                # Streamed response: NLP in the pool, then execution and simulated results from
+                # this process's FHIR client in the thread pool, frame by frame
+                result, sample = await request.app.state.pool.run(_analyze_query, query, timings, plan)
+                remember_query(query, result, caller)
+                frames = stream_query_response(query, result, sample, simulation, request.app.state.fhir_client)
+                return StreamingResponse(iterate_in_threadpool(frames), media_type=NDJSON)
+            if flight is not None:
+                # Identical queries already in flight are answered by that pool submission
+                (response, sample), shared = await flight.do(coalesce_key(query, timings, plan, simulation),
+                                                             request.app.state.pool.run, *args)
+                response = response_for_query(response, query)
+            else:
+                (response, sample), shared = await request.app.state.pool.run(*args), False
+        except asyncio.TimeoutError:
+            tracked["status"] = 503
+            return error_response("Server busy, please retry", 503)
+        except Exception as e:
+            tracked["status"] = 500
+            logger.error(f"Error processing query: {str(e)}")
+            logger.error(traceback.format_exc())
+            return error_response(str(e), 500)
+
+        if shared:
+            record_coalesced('/api/query')
+        else:
+            record_query(sample)
+        remember_query(query, response, caller)
+        logger.debug(f"Query processed successfully: {query}")
+        return FastJSONResponse(response)
+
+async def process_query_batch(request):
+    """Process a batch of natural language queries, returning results in input order"""
+    with track_request('/api/query/batch') as tracked:
+        data = await read_json(request)
+        if not data or 'queries' not in data:
+            tracked["status"] = 400
+            return FastJSONResponse({"error": "Missing 'queries' parameter"}, status_code=400)
+
+        queries = data['queries']
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            tracked["status"] = 400
+            return FastJSONResponse({"error": "'queries' must be a list of strings"}, status_code=400)
+        if len(queries) > MAX_BATCH_QUERIES:
+            tracked["status"] = 400
+            return FastJSONResponse({"error": f"Batch exceeds maximum of {MAX_BATCH_QUERIES} queries"}, status_code=400)
+
+        logger.debug(f"Processing query batch of {len(queries)}")
+        try:
+            results, samples = await request.app.state.pool.run(_process_query_batch, queries)
+        except asyncio.TimeoutError:
+            tracked["status"] = 503
+            return error_response("Server busy, please retry", 503)
+        except Exception as e:
+            tracked["status"] = 500
+            logger.error(f"Error processing query batch: {str(e)}")
+            logger.error(traceback.format_exc())
+            return error_response(str(e), 500)
+
+        for sample in samples:
+            record_query(sample)
+        return FastJSONResponse({"success": True, "count": len(results), "results": results})
+
+async def stream_query_resources(request):
+    """Execute the query's FHIR search and stream every matching resource as NDJSON"""
+    data = await read_json(request)
+    if not data or 'query' not in data:
+        return FastJSONResponse({"error": "Missing 'query' parameter"}, status_code=400)
+    fhir_client = request.app.state.fhir_client
+    if fhir_client is None:
+        return FastJSONResponse({"error": "FHIR execution is disabled (set FHIR_EXECUTE=1)"}, status_code=503)
+    try:
+        page_size = parse_page_size(data.get('page_size'))
+    except (TypeError, ValueError):
+        return FastJSONResponse({"error": "'page_size' must be a positive integer"}, status_code=400)
+
+    try:
+        fhir_query = await request.app.state.pool.run(_build_fhir_query, data['query'])
+    except asyncio.TimeoutError:
+        return error_response("Server busy, please retry", 503)
+    if 'error' in fhir_query:
+        return FastJSONResponse({"error": fhir_query['error']}, status_code=400)
+
+    lines = stream_fhir_resources(fhir_client, fhir_query, page_size)
+    return StreamingResponse(iterate_in_threadpool(lines), media_type=NDJSON)
+
+async def metrics(request):
+    """Prometheus metrics (aggregated across worker processes in multi-process mode)"""
+    if not METRICS_ENABLED:
+        return FastJSONResponse({"error": "Metrics are disabled"}, status_code=404)
+    body, content_type = metrics_payload()
+    return Response(body, media_type=content_type)
+
+async def get_suggestions(request):
+    """Get autocomplete suggestions for queries"""
+    return Response(suggestions_body(request.query_params.get('q', '')), media_type='application/json')
+
+async def get_patient_details(request):
+    """Get detailed information for a specific patient"""
+    return FastJSONResponse(build_patient_details(request.path_params['patient_id']))
+
+async def not_found_error(request, exc):
+    return FastJSONResponse({"error": "Endpoint not found"}, status_code=404)
+
+async def internal_error(request, exc):
+    return FastJSONResponse({"error": "Internal server error"}, status_code=500)
+
+app = Starlette(
+    routes=[
+        Route('/api/health', health_check, methods=['GET']),
+        Route('/api/query', process_query, methods=['POST']),
+        Route('/api/query/batch', process_query_batch, methods=['POST']),
+        Route('/api/query/resources', stream_query_resources, methods=['POST']),
+        Route('/api/suggestions', get_suggestions, methods=['GET']),
+        Route('/api/patients/{patient_id}', get_patient_details, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET'])
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(CompressionMiddleware)
+    ],
+    exception_handlers={404: not_found_error, 500: internal_error},
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.environ.get('PORT', '5002'))
+    print("🏥 Starting FHIR Query API Server (ASGI)...")
+    print(f"📡 Frontend can connect to: http://localhost:{port}")
+    print(f"⚙️  NLP worker processes: {ASGI_WORKERS}")
+    print("🚀 Server starting...")
+
+    uvicorn.run(app, host='0.0.0.0', port=port)
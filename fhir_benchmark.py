@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+"""
+FHIR Query Service Benchmarks
+Command-line benchmarks for the NLP-to-FHIR pipeline using a fixed query corpus.
+"""
+
+import argparse
+import contextlib
+import json
+import platform
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from fhir_query_service import scan_entity_patterns
+
+# Fixed query corpus so results are comparable across runs and versions
+BENCHMARK_QUERIES = [
+    "I'm experiencing severe chest pain and difficulty breathing - this is urgent!",
+    "Show me all diabetic patients over 50 with recent glucose measurements",
+    "Find blood pressure observations for patient John Smith from last 30 days",
+    "I have persistent headaches and feel dizzy, what should I do?",
+    "Schedule an appointment for medication review - I'm taking insulin",
+    "Get active diabetes conditions with moderate severity",
+    "List all female patients named Sarah with heart disease",
+    "My elderly father has been having trouble breathing lately",
+    "Show recent cholesterol and glucose lab results for patient 123",
+    "I need information about my hypertension medication dosage",
+    "Show me all diabetic patients over 50",
+    "Find blood pressure observations for patient 123 from last 30 days",
+    "Get active diabetes conditions for patient 456",
+    "List all female patients named Sarah",
+    "Show heart rate measurements for patient 789",
+    "Find all patients named John Smith",
+    "List all medications for patient 789",
+    "Find scheduled appointments for patient 101 today",
+    "Get cardiac patients over 65",
+    "Find patients with depression diagnosis"
+]
+
+# Sentiment-bearing texts for the backend agreement check only; no lexicon value was set from
+# them (or from BENCHMARK_QUERIES), so agreement on them measures the lexicon on unseen text
+SENTIMENT_HELDOUT_QUERIES = [
+    "List unhappy patients",
+    "Urgent: patient feels ill and scared",
+    "My mother is worried because her wound still hurts",
+    "The patient is improving and feels well today",
+    "Severe allergic reaction, this is an emergency",
+    "Blood sugar has been stable and normal for weeks",
+    "I feel awful, tired and dizzy after the new medication",
+    "Thank you, the results look good",
+    "He had a terrible night with unbearable back pain",
+    "Show patients who recovered quickly after surgery",
+    "She is afraid the treatment failed",
+    "Great news, his cholesterol is much better",
+    "Find patients with abnormal and unstable heart rhythms",
+    "I'm not happy with how slow my recovery is",
+    "Very painful swelling in the left knee",
+    "Patient reports feeling comfortable and relieved"
+]
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def latency_summary(samples_ms: List[float]) -> Dict:
+    """Summarize latency samples (milliseconds) as mean and p50/p95/p99."""
+    if not samples_ms:
+        return {"count": 0}
+    ordered = sorted(samples_ms)
+
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1]
+    }
+
+
+def _in_quiet_process(func: Callable, *args):
+    """Run func with the service's model-loading messages sent to stderr, keeping stdout clean for --json."""
+    with contextlib.redirect_stdout(sys.stderr):
+        return func(*args)
+
+
+def _measure_pipeline_variant(variant: str, iterations: int) -> Dict:
+    """Load the service with one spaCy pipeline variant and time extract_entities_and_intent."""
+    from fhir_query_service import FHIRQueryService
+
+    baseline_rss = current_rss_mb()
+    load_start = time.perf_counter()
+    service = FHIRQueryService(spacy_pipeline=variant)
+    load_seconds = time.perf_counter() - load_start
+    loaded_rss = current_rss_mb()
+
+    # Warm up once so the first call does not skew latencies
+    for query in BENCHMARK_QUERIES:
+        service.extract_entities_and_intent(query)
+
+    samples = []
+    for _ in range(iterations):
+        for query in BENCHMARK_QUERIES:
+            start = time.perf_counter()
+            service.extract_entities_and_intent(query)
+            samples.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "variant": variant,
+        "components": list(service.nlp.pipe_names) if service.nlp else [],
+        "nlp_method": "spaCy Enhanced" if service.nlp else "regex",
+        "load_seconds": load_seconds,
+        "model_rss_mb": loaded_rss - baseline_rss,
+        "rss_mb": current_rss_mb(),
+        "latency": latency_summary(samples)
+    }
+
+
+def benchmark_pipelines(variants: List[str], iterations: int) -> List[Dict]:
+    """Benchmark each spaCy pipeline variant in a fresh process so RSS figures are independent."""
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for variant in variants:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_in_quiet_process, (_measure_pipeline_variant, variant, iterations)))
+    return results
+
+
+def _sentiment_stage(service, query):
+    # Clear the precomputed polarity so the backend is called every time
+    query.polarity = None
+    return service.analyze_sentiment(query)
+
+
+# Pipeline stages of process_patient_query, each timed in isolation on prepared inputs:
+# name -> stage(service, normalized query, nlp_analysis)
+PIPELINE_STAGES: Dict[str, Callable] = {
+    "spacy": lambda service, query, analysis: service.nlp(query.lower),
+    "lexicon_scan": lambda service, query, analysis: service.lexicon_matcher.group_terms(
+        service.lexicon_matcher.find_all(query.lower)),
+    "regex": lambda service, query, analysis: scan_entity_patterns(query.lower),
+    "sentiment": lambda service, query, analysis: _sentiment_stage(service, query),
+    "intent": lambda service, query, analysis: service._determine_intent_advanced(query),
+    "fhir_build": lambda service, query, analysis: service._convert_nlp_to_fhir(query, analysis),
+    "clinical_interpretation": lambda service, query, analysis: service._generate_clinical_interpretation(analysis),
+    "end_to_end": lambda service, query, analysis: service.process_patient_query(query.text)
+}
+
+
+def _measure_stage(stage: Callable, service, prepared: List[Tuple], iterations: int) -> Dict:
+    """Time one stage over the corpus, then measure its allocations in a separate tracemalloc pass."""
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for query, analysis in prepared:
+            call_start = time.perf_counter()
+            stage(service, query, analysis)
+            samples.append((time.perf_counter() - call_start) * 1000)
+    elapsed = time.perf_counter() - start
+
+    # tracemalloc slows every allocation down, so it never runs during the timed pass
+    peak_bytes = []
+    retained_bytes = []
+    tracemalloc.start()
+    try:
+        for query, analysis in prepared:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            result = stage(service, query, analysis)
+            after, peak = tracemalloc.get_traced_memory()
+            peak_bytes.append(peak - before)
+            retained_bytes.append(after - before)
+            del result
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "queries_per_second": len(samples) / elapsed if elapsed else 0.0,
+        "latency": latency_summary(samples),
+        "allocations": {
+            "mean_peak_bytes": statistics.fmean(peak_bytes),
+            "max_peak_bytes": max(peak_bytes),
+            "mean_retained_bytes": statistics.fmean(retained_bytes)
+        }
+    }
+
+
+def _measure_stages(mode: str, iterations: int) -> Dict:
+    """Benchmark every pipeline stage with spaCy on ("spacy") or off ("regex")."""
+    from fhir_query_service import FHIRQueryService
+
+    service = FHIRQueryService()
+    if mode == "regex":
+        service.nlp = None
+
+    # Prepare the inputs each stage receives inside process_patient_query
+    prepared = []
+    for text in BENCHMARK_QUERIES:
+        query = service.normalize_query(text)
+        prepared.append((query, service.extract_entities_and_intent(query)))
+
+    stages = {}
+    for name, stage in PIPELINE_STAGES.items():
+        if name == "spacy" and service.nlp is None:
+            continue
+        # Warm up once so the first call does not skew latencies
+        for query, analysis in prepared:
+            stage(service, query, analysis)
+        stages[name] = _measure_stage(stage, service, prepared, iterations)
+
+    return {
+        "mode": mode,
+        "nlp_method": "spaCy Enhanced" if service.nlp else "regex",
+        "spacy_pipeline": list(service.nlp.pipe_names) if service.nlp else [],
+        "sentiment_backend": service.sentiment_scorer.name,
+        "rss_mb": current_rss_mb(),
+        "stages": stages
+    }
+
+
+def benchmark_stages(modes: List[str], iterations: int) -> Dict:
+    """Benchmark the pipeline stages for each mode, each in a fresh process."""
+    context = multiprocessing.get_context("spawn")
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus_size": len(BENCHMARK_QUERIES),
+        "iterations": iterations,
+        "modes": {}
+    }
+    for mode in modes:
+        with context.Pool(1) as pool:
+            results["modes"][mode] = pool.apply(_in_quiet_process, (_measure_stages, mode, iterations))
+    return results
+
+
+def _polarity_label(polarity: float, neutral_band: float = 0.05) -> str:
+    if polarity > neutral_band:
+        return "positive"
+    if polarity < -neutral_band:
+        return "negative"
+    return "neutral"
+
+
+def _sentiment_agreement(backends: Dict, texts: List[str]) -> Dict:
+    """Label agreement, mean absolute difference and correlation of lexicon and TextBlob scores."""
+    lexicon_scores = backends["lexicon"].score_batch(texts)
+    textblob_scores = backends["textblob"].score_batch(texts)
+    label_matches = sum(_polarity_label(a) == _polarity_label(b) for a, b in zip(lexicon_scores, textblob_scores))
+    agreement = {
+        "texts": len(texts),
+        "label_agreement": label_matches / len(texts),
+        "mean_absolute_difference": statistics.fmean(abs(a - b) for a, b in zip(lexicon_scores, textblob_scores))
+    }
+    try:
+        agreement["pearson_r"] = statistics.correlation(lexicon_scores, textblob_scores)
+    except statistics.StatisticsError:
+        agreement["pearson_r"] = None
+    return agreement
+
+
+def benchmark_sentiment(iterations: int) -> Dict:
+    """Compare sentiment backends for latency and, when TextBlob is installed, agreement."""
+    from fhir_query_service import TEXTBLOB_AVAILABLE
+    from fhir_sentiment import LexiconSentimentScorer, TextBlobSentimentScorer
+
+    backends = {"lexicon": LexiconSentimentScorer()}
+    if TEXTBLOB_AVAILABLE:
+        from textblob import TextBlob
+        # cache_size=0 disables memoization so the raw TextBlob cost is measured
+        backends["textblob"] = TextBlobSentimentScorer(TextBlob, cache_size=0)
+
+    results = {"backends": {}}
+    for name, scorer in backends.items():
+        samples = []
+        for _ in range(iterations):
+            for query in BENCHMARK_QUERIES:
+                start = time.perf_counter()
+                scorer.score(query)
+                samples.append((time.perf_counter() - start) * 1000)
+
+        batch_start = time.perf_counter()
+        for _ in range(iterations):
+            scorer.score_batch(BENCHMARK_QUERIES)
+        batch_seconds = time.perf_counter() - batch_start
+
+        results["backends"][name] = {
+            "latency": latency_summary(samples),
+            "batch_queries_per_second": iterations * len(BENCHMARK_QUERIES) / batch_seconds if batch_seconds else 0.0
+        }
+
+    if "textblob" in backends:
+        results["agreement"] = {
+            "benchmark": _sentiment_agreement(backends, BENCHMARK_QUERIES),
+            "held_out": _sentiment_agreement(backends, SENTIMENT_HELDOUT_QUERIES)
+        }
+    else:
+        results["agreement"] = None
+
+    return results
+
+
+def print_sentiment_results(results: Dict):
+    """Print sentiment backend results."""
+    for name, backend in results["backends"].items():
+        latency = backend["latency"]
+        print(f"{name:<10} p50 {latency['p50_ms']:.4f} ms  p99 {latency['p99_ms']:.4f} ms  "
+              f"batch {backend['batch_queries_per_second']:,.0f} queries/s")
+    if results["agreement"] is None:
+        print("TextBlob not installed; agreement not measured")
+        return
+    for corpus, agreement in results["agreement"].items():
+        r = "n/a" if agreement["pearson_r"] is None else f"{agreement['pearson_r']:.3f}"
+        print(f"agreement ({corpus}, {agreement['texts']} texts): labels {agreement['label_agreement']:.0%}, "
+              f"mean |diff| {agreement['mean_absolute_difference']:.3f}, r = {r}")
+
+
+def _query_response(patients: int) -> Dict:
+    """A full /api/query response with a ``patients``-patient page of simulated results."""
+    from fhir_api_common import build_simulated_results, format_query_response
+    from fhir_cohort import simulate_cohort
+    from fhir_query_service import FHIRQueryService
+
+    query = BENCHMARK_QUERIES[1]
+    result = FHIRQueryService().process_patient_query(query)
+    response = format_query_response(query, result)
+    entities = result.get('nlp_analysis', {}).get('entities', {})
+    cohort = simulate_cohort(entities, patients, seed=1, page=1, page_size=patients)
+    response["simulated_results"] = build_simulated_results(cohort, patients, query)
+    return response
+
+
+def benchmark_serialization(patients: int, iterations: int) -> Dict:
+    """
+    Serialize one /api/query response with each available encoder: "jsonify" reproduces
+    Flask's previous default (stdlib, sorted keys, ASCII-escaped), "json" and "orjson" are the
+    fhir_json backends. Also reports the size and cost of gzip (and brotli when installed).
+    """
+    import gzip
+    from fhir_json import BROTLI_AVAILABLE, BROTLI_QUALITY, GZIP_LEVEL, ORJSON_AVAILABLE
+
+    response = _in_quiet_process(_query_response, patients)
+    encoders = {
+        "jsonify": lambda obj: json.dumps(obj, ensure_ascii=True, sort_keys=True, separators=(",", ":")).encode(),
+        "json": lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    }
+    if ORJSON_AVAILABLE:
+        import orjson
+        encoders["orjson"] = orjson.dumps
+
+    results = {"patients": patients, "python": sys.version.split()[0], "encoders": {}, "compression": {}}
+    for name, encode in encoders.items():
+        body = encode(response)
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            encode(response)
+            samples.append((time.perf_counter() - start) * 1000)
+        median_ms = statistics.median(samples)
+        results["encoders"][name] = {
+            "bytes": len(body),
+            "latency": latency_summary(samples),
+            "mb_per_second": len(body) / median_ms / 1000 if median_ms else 0.0
+        }
+    baseline = results["encoders"]["jsonify"]["latency"]["p50_ms"]
+    for encoder in results["encoders"].values():
+        encoder["speedup"] = baseline / encoder["latency"]["p50_ms"] if encoder["latency"]["p50_ms"] else 0.0
+
+    body = encoders["orjson" if ORJSON_AVAILABLE else "json"](response)
+    codecs = {f"gzip-{GZIP_LEVEL}": lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)}
+    if BROTLI_AVAILABLE:
+        import brotli
+        codecs[f"br-{BROTLI_QUALITY}"] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+    for name, codec in codecs.items():
+        samples = []
+        for _ in range(max(1, iterations // 10)):
+            start = time.perf_counter()
+            compressed = codec(body)
+            samples.append((time.perf_counter() - start) * 1000)
+        results["compression"][name] = {
+            "bytes": len(compressed),
+            "ratio": len(body) / len(compressed),
+            "p50_ms": statistics.median(samples)
+        }
+    return results
+
+
+def print_serialization_results(results: Dict):
+    """Print encoder and compression results."""
+    print(f"{results['patients']:,}-patient /api/query response")
+    print(f"{'encoder':<10}{'KB':>9}{'p50 ms':>10}{'p99 ms':>10}{'MB/s':>9}{'speedup':>9}")
+    for name, encoder in results["encoders"].items():
+        latency = encoder["latency"]
+        print(f"{name:<10}{encoder['bytes'] / 1024:>9.1f}{latency['p50_ms']:>10.3f}{latency['p99_ms']:>10.3f}"
+              f"{encoder['mb_per_second']:>9.0f}{encoder['speedup']:>8.1f}x")
+    for name, codec in results["compression"].items():
+        print(f"{name:<10}{codec['bytes'] / 1024:>9.1f}{codec['p50_ms']:>10.3f}  ratio {codec['ratio']:.1f}x")
+
+
+def _synthetic_suggestions(size: int) -> Dict[str, int]:
+    """``size`` distinct query-like suggestions with Zipf-like weights (fixed seed)."""
+    import random
+    from fhir_api_common import SUGGESTIONS
+
+    rng = random.Random(7)
+    verbs = ["Show", "Find", "List", "Get", "Count", "Compare", "Review", "Chart"]
+    subjects = ["patients", "female patients", "male patients", "elderly patients", "pediatric patients",
+                "outpatients", "inpatients", "veterans", "smokers", "pregnant patients"]
+    topics = ["diabetes", "hypertension", "asthma", "heart disease", "cancer", "depression", "anxiety",
+              "migraine", "arthritis", "pneumonia", "blood pressure", "glucose", "cholesterol",
+              "hemoglobin", "oxygen saturation", "heart rate", "body weight", "bmi", "insulin", "metformin"]
+    qualifiers = ["over {}", "under {}", "seen in the last {} days", "in ward {}", "with {} visits",
+                  "from clinic {}", "admitted {} days ago"]
+    suggestions = {text: 5 for text in SUGGESTIONS}
+    while len(suggestions) < size:
+        text = (f"{rng.choice(verbs)} {rng.choice(subjects)} with {rng.choice(topics)} "
+                f"{rng.choice(qualifiers).format(rng.randint(1, 99))}")
+        suggestions[text] = max(1, int(1000 / rng.randint(1, 1000)))
+    return suggestions
+
+
+def benchmark_suggestions(size: int, iterations: int) -> Dict:
+    """
+    Build a suggestion index of ``size`` entries and time /api/suggestions lookups (index
+    search plus serialization) for prefixes, multi-word prefixes and misspellings, against
+    the linear substring scan it replaced.
+    """
+    from fhir_json import dumps
+    from fhir_suggest import SuggestionIndex
+
+    suggestions = _synthetic_suggestions(size)
+    # Memory in a separate, untimed build (tracemalloc slows allocation down)
+    tracemalloc.start()
+    index = SuggestionIndex(suggestions)
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del index
+    start = time.perf_counter()
+    index = SuggestionIndex(suggestions)
+    build_seconds = time.perf_counter() - start
+    fragments = {
+        "short_prefix": ["s", "pa", "di", "gl"],
+        "prefix": ["diab", "hyper", "blood pr", "chole", "pedia"],
+        "multi_word": ["female patients with di", "show elderly", "with asthma over"],
+        "misspelled": ["diabtes", "hypertensoin", "cholestrol", "pnuemonia"]
+    }
+    texts = list(suggestions)
+
+    results = {"suggestions": len(index), "build_seconds": build_seconds,
+               "index_mb": retained_bytes / 1e6, "build_peak_mb": peak_bytes / 1e6, "kinds": {}}
+    for kind, queries in fragments.items():
+        samples = []
+        for _ in range(iterations):
+            for fragment in queries:
+                begin = time.perf_counter()
+                dumps({"suggestions": [text for text, _ in index.search(fragment, 10)]})
+                samples.append((time.perf_counter() - begin) * 1000)
+        linear = []
+        for fragment in queries:
+            begin = time.perf_counter()
+            [text for text in texts if fragment in text.lower()][:10]
+            linear.append((time.perf_counter() - begin) * 1000)
+        results["kinds"][kind] = {
+            "latency": latency_summary(samples),
+            "linear_scan_ms": statistics.median(linear),
+            "example": {queries[0]: [text for text, _ in index.search(queries[0], 3)]}
+        }
+    return results
+
+
+def print_suggestion_results(results: Dict):
+    """Print suggestion lookup latencies per fragment kind."""
+    print(f"{results['suggestions']:,} suggestions, built in {results['build_seconds']:.2f} s, "
+          f"{results['index_mb']:.0f} MB ({results['build_peak_mb']:.0f} MB peak while building)")
+    print(f"{'fragment':<14}{'p50 ms':>10}{'p99 ms':>10}{'linear ms':>11}")
+    for kind, result in results["kinds"].items():
+        latency = result["latency"]
+        print(f"{kind:<14}{latency['p50_ms']:>10.3f}{latency['p99_ms']:>10.3f}{result['linear_scan_ms']:>11.2f}")
+
+
+def _timed_post(url: str, query: str, timeout: float) -> Tuple[float, bool]:
+    """POST one query and return (latency in ms, success)."""
+    body = json.dumps({"query": query}).encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return (time.perf_counter() - start) * 1000, ok
+
+
+def load_test(base_url: str, requests_total: int, concurrency: int, timeout: float) -> Dict:
+    """Send requests_total POST /api/query requests with a fixed concurrency and summarize latency."""
+    url = base_url.rstrip("/") + "/api/query"
+    queries = [BENCHMARK_QUERIES[i % len(BENCHMARK_QUERIES)] for i in range(requests_total)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(lambda query: _timed_post(url, query, timeout), queries))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "url": base_url,
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "errors": sum(1 for _, ok in outcomes if not ok),
+        "requests_per_second": requests_total / elapsed if elapsed else 0.0,
+        "latency": latency_summary([latency for latency, ok in outcomes if ok])
+    }
+
+
+def print_load_test_results(results: Dict[str, Dict]):
+    """Print load test results per target."""
+    print(f"{'target':<10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, result in results.items():
+        latency = result["latency"]
+        print(f"{name:<10}{result['requests_per_second']:>10.1f}{latency.get('p50_ms', 0):>10.1f}"
+              f"{latency.get('p95_ms', 0):>10.1f}{latency.get('p99_ms', 0):>10.1f}{result['errors']:>8}")
+
+
+def print_stage_results(results: Dict):
+    """Print per-stage results for each mode as a table."""
+    for mode, result in results["modes"].items():
+        print(f"{mode} mode ({result['nlp_method']}, sentiment: {result['sentiment_backend']})")
+        print(f"  {'stage':<25}{'queries/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KB':>10}")
+        for name, stage in result["stages"].items():
+            latency = stage["latency"]
+            print(f"  {name:<25}{stage['queries_per_second']:>12,.0f}{latency['p50_ms']:>10.3f}"
+                  f"{latency['p95_ms']:>10.3f}{latency['p99_ms']:>10.3f}"
+                  f"{stage['allocations']['mean_peak_bytes'] / 1024:>10.1f}")
+
+
+def print_pipeline_results(results: List[Dict]):
+    """Print pipeline variant results as a table."""
+    print(f"{'variant':<12}{'components':<52}{'load s':>8}{'RSS MB':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for result in results:
+        latency = result["latency"]
+        print(f"{result['variant']:<12}{','.join(result['components']) or '(regex only)':<52}"
+              f"{result['load_seconds']:>8.2f}{result['rss_mb']:>9.1f}"
+              f"{latency.get('p50_ms', 0):>9.3f}{latency.get('p99_ms', 0):>9.3f}")
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    from fhir_query_service import SPACY_PIPELINE_PRESETS
+
+    parser = argparse.ArgumentParser(description="Benchmark the FHIR Query Service NLP pipeline")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    pipelines = subcommands.add_parser("pipelines", help="Latency and RSS for each spaCy pipeline variant")
+    pipelines.add_argument("--variants", nargs="+", default=list(SPACY_PIPELINE_PRESETS),
+                           choices=list(SPACY_PIPELINE_PRESETS))
+    pipelines.add_argument("--iterations", type=int, default=20, help="Passes over the query corpus")
+    pipelines.add_argument("--json", action="store_true", help="Emit JSON instead of a table")
+
+    stages = subcommands.add_parser("stages", help="Throughput, latency and allocations per pipeline stage")
+    stages.add_argument("--modes", nargs="+", default=["spacy", "regex"], choices=["spacy", "regex"],
+                        help="Run with spaCy on (spacy) and/or off (regex)")
+    stages.add_argument("--iterations", type=int, default=20, help="Passes over the query corpus")
+    stages.add_argument("--json", action="store_true", help="Emit JSON instead of a table")
+
+    sentiment = subcommands.add_parser("sentiment", help="Latency and agreement of the sentiment backends")
+    sentiment.add_argument("--iterations", type=int, default=50, help="Passes over the query corpus")
+    sentiment.add_argument("--json", action="store_true", help="Emit JSON instead of a table")
+
+    serialization = subcommands.add_parser("serialization", help="JSON encoder throughput and compression on a large response")
+    serialization.add_argument("--patients", type=int, default=1000, help="Simulated patients in the response")
+    serialization.add_argument("--iterations", type=int, default=200, help="Encodes per encoder")
+    serialization.add_argument("--json", action="store_true", help="Emit JSON instead of a table")
+
+    suggestions = subcommands.add_parser("suggestions", help="Autocomplete latency on a large suggestion index")
+    suggestions.add_argument("--size", type=int, default=100000, help="Suggestions in the index")
+    suggestions.add_argument("--iterations", type=int, default=200, help="Passes over the fragments")
+    suggestions.add_argument("--json", action="store_true", help="Emit JSON instead of a table")
+
+    loadtest = subcommands.add_parser("loadtest", help="p50/p99 latency of running API servers under concurrent load")
+    loadtest.add_argument("--target", action="append", required=True, metavar="NAME=URL",
+                          help="Server to test, e.g. flask=http://localhost:5001 (repeatable)")
+    loadtest.add_argument("--requests", type=int, default=500, help="Requests per target")
+    loadtest.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    loadtest.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout in seconds")
+    loadtest.add_argument("--json", action="store_true", help="Emit JSON instead of a table")
+
+    args = parser.parse_args()
+
+    if args.command == "pipelines":
+        results = benchmark_pipelines(args.variants, args.iterations)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_pipeline_results(results)
+    elif args.command == "stages":
+        results = benchmark_stages(args.modes, args.iterations)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_stage_results(results)
+    elif args.command == "sentiment":
+        results = benchmark_sentiment(args.iterations)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_sentiment_results(results)
+    elif args.command == "serialization":
+        results = benchmark_serialization(args.patients, args.iterations)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_serialization_results(results)
+    elif args.command == "suggestions":
+        results = benchmark_suggestions(args.size, args.iterations)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_suggestion_results(results)
+    elif args.command == "loadtest":
+        results = {}
+        for target in args.target:
+            name, _, url = target.partition("=")
+            results[name] = load_test(url or name, args.requests, args.concurrency, args.timeout)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_load_test_results(results)
+
+
+if __name__ == "__main__":
+    main()
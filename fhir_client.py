@@ -0,0 +1,522 @@
+"""
+FHIR execution layer for the FHIR Query Service.
+Sends the queries built by FHIRQueryService to a FHIR server over a pooled keep-alive
+session, with per-host connection limits, timeouts and retries with exponential backoff.
+Responses can be cached (FHIRResponseCache) and revalidated with ETag / If-None-Match.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from fhir_coalesce import SingleFlight
+from fhir_request import FHIRRequest, Parameters, canonical_url
+
+FHIR_JSON = "application/fhir+json"
+
+# Transient upstream statuses worth retrying (idempotent GETs only)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def next_link(bundle: Dict) -> Optional[str]:
+    """Return the URL of the Bundle's link[rel=next], if any."""
+    for link in bundle.get("link", []):
+        if link.get("relation") == "next":
+            return link.get("url")
+    return None
+
+
+def patient_reference(resource: Dict) -> Optional[str]:
+    """Return the "Patient/<id>" reference a resource belongs to, if any."""
+    if resource.get("resourceType") == "Patient":
+        return f"Patient/{resource['id']}" if resource.get("id") else None
+    for field in ("subject", "patient"):
+        reference = (resource.get(field) or {}).get("reference", "")
+        if reference.startswith("Patient/"):
+            return reference
+    for participant in resource.get("participant", []):
+        reference = (participant.get("actor") or {}).get("reference", "")
+        if reference.startswith("Patient/"):
+            return reference
+    return None
+
+
+def join_by_patient(results: List[Tuple[str, List[Dict]]], inner: bool = True) -> List[Dict]:
+    """
+    Join the resources of several searches on their patient reference.
+    ``results`` holds (resource type, resources) per search. Each joined row is
+    {"reference": "Patient/<id>", "Patient": resource or None, "<Type>": [resources], ...}.
+    With ``inner`` only patients found by every search are kept.
+    """
+    rows: Dict[str, Dict] = {}
+    found_by: Dict[str, int] = {}
+    resource_types = [resource_type for resource_type, _ in results]
+    for search_index, (resource_type, resources) in enumerate(results):
+        for resource in resources:
+            reference = patient_reference(resource)
+            if reference is None:
+                continue
+            row = rows.get(reference)
+            if row is None:
+                row = rows[reference] = {"reference": reference, "Patient": None}
+                row.update({other: [] for other in resource_types if other != "Patient"})
+            if resource_type == "Patient":
+                row["Patient"] = resource
+            else:
+                row[resource_type].append(resource)
+            # Bitmask of the searches that returned this patient
+            found_by[reference] = found_by.get(reference, 0) | (1 << search_index)
+
+    if inner:
+        everywhere = (1 << len(results)) - 1
+        return [row for reference, row in rows.items() if found_by[reference] == everywhere]
+    return list(rows.values())
+
+
+# Default freshness per resource type (seconds): demographics change rarely, scheduling often
+DEFAULT_CACHE_TTLS = {
+    "Patient": 300.0,
+    "Condition": 300.0,
+    "MedicationRequest": 120.0,
+    "Observation": 60.0,
+    "Appointment": 30.0
+}
+
+
+def resource_type_of(url: str) -> str:
+    """Resource type addressed by a FHIR URL (the last path segment naming a type)."""
+    for segment in reversed(urlsplit(url).path.split("/")):
+        if segment[:1].isupper():
+            return segment
+    return ""
+
+
+class FHIRResponseCache:
+    """
+    Thread-safe LRU cache of FHIR GET responses keyed on the canonical request URL.
+
+    Entries are fresh for the TTL of their resource type. Stale entries that carry an ETag
+    are kept for conditional revalidation (If-None-Match); a 304 refreshes them without
+    transferring the body again. With ``disk_path`` entries are also written to an SQLite
+    file, which survives restarts and is shared by the worker processes of one host. Each
+    process opens its own connection on first use, so a cache created before gunicorn forks
+    its workers never hands one connection to several processes.
+    Bodies are stored as the raw JSON bytes and parsed on every hit, so callers get their
+    own copy.
+    """
+
+    def __init__(self, max_entries: int = 512, default_ttl: float = 60.0,
+                 ttls: Optional[Dict[str, float]] = None, disk_path: Optional[str] = None,
+                 max_disk_entries: int = 10000):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.ttls = dict(DEFAULT_CACHE_TTLS if ttls is None else ttls)
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        # Wall-clock timestamps, so ages stay meaningful for entries loaded from disk
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str], bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_pid: Optional[int] = None
+        self._inherited_disk: Optional[sqlite3.Connection] = None
+        self._disk_writes = 0
+
+    def ttl_for(self, key: str) -> float:
+        return self.ttls.get(resource_type_of(key), self.default_ttl)
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        """This process's connection to the disk tier (None without one). Caller holds the lock."""
+        if not self.disk_path:
+            return None
+        if self._disk is None or self._disk_pid != os.getpid():
+            # A connection inherited through fork() must not be used or closed by the child, so
+            # it is kept referenced (garbage collection would close it) and left alone
+            if self._disk is not None:
+                self._inherited_disk = self._disk
+            self._disk = sqlite3.connect(self.disk_path, timeout=5.0, check_same_thread=False)
+            self._disk_pid = os.getpid()
+            self._disk.execute("CREATE TABLE IF NOT EXISTS responses "
+                               "(key TEXT PRIMARY KEY, stored_at REAL, etag TEXT, body BLOB)")
+            self._disk.commit()
+        return self._disk
+
+    def _remember(self, key: str, entry: Tuple[float, Optional[str], bytes]):
+        """Store an entry in memory, evicting the least recently used. Caller holds the lock."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _write_disk(self, key: str, entry: Tuple[float, Optional[str], bytes]):
+        """Write an entry to the disk tier, pruning the oldest ones now and then. Caller holds the lock."""
+        disk = self._connection()
+        disk.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, *entry))
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            disk.execute("DELETE FROM responses WHERE key NOT IN "
+                         "(SELECT key FROM responses ORDER BY stored_at DESC LIMIT ?)",
+                         (self.max_disk_entries,))
+        disk.commit()
+
+    def lookup(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Look up a response: (body, None) when fresh, (None, etag) when stale but revalidatable,
+        (None, None) on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.disk_path:
+                row = self._connection().execute("SELECT stored_at, etag, body FROM responses WHERE key = ?",
+                                                 (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1], bytes(row[2]))
+                    self._remember(key, entry)
+                    self.disk_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None, None
+            stored_at, etag, body = entry
+            if time.time() - stored_at <= self.ttl_for(key):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body, None
+            if etag is None:
+                del self._entries[key]
+                self.misses += 1
+                return None, None
+            self.stale += 1
+            return None, etag
+
+    def store(self, key: str, body: bytes, etag: Optional[str] = None):
+        """Store a 200 response body with its ETag, if any."""
+        entry = (time.time(), etag, body)
+        with self._lock:
+            self._remember(key, entry)
+            if self.disk_path:
+                self._write_disk(key, entry)
+
+    def refresh(self, key: str) -> Optional[bytes]:
+        """Mark a stale entry fresh again after a 304 Not Modified, returning its body."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry = (time.time(), entry[1], entry[2])
+            self._remember(key, entry)
+            if self.disk_path:
+                self._write_disk(key, entry)
+            self.revalidated += 1
+            return entry[2]
+
+    def clear(self):
+        """Drop all entries (including the disk tier) and reset counters."""
+        with self._lock:
+            self._entries.clear()
+            if self.disk_path:
+                disk = self._connection()
+                disk.execute("DELETE FROM responses")
+                disk.commit()
+            self.hits = self.misses = self.stale = self.revalidated = self.disk_hits = self.evictions = 0
+
+    def close(self):
+        with self._lock:
+            # Only close a connection this process opened
+            if self._disk is not None and self._disk_pid == os.getpid():
+                self._disk.close()
+            self._disk = None
+
+    def stats(self) -> Dict:
+        """Return size and hit/miss/revalidation counters."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                "enabled": True,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk": self.disk_path,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "revalidated": self.revalidated,
+                "disk_hits": self.disk_hits,
+                "hit_ratio": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
+
+
+class FHIRClientError(Exception):
+    """A FHIR request failed after retries (connection error, timeout or error status)."""
+
+    def __init__(self, message: str, url: str, status_code: Optional[int] = None,
+                 outcome: Optional[Dict] = None):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
+        self.outcome = outcome
+
+
+class FHIRClient:
+    """
+    Thread-safe FHIR REST client.
+
+    One requests Session is shared by all threads. Each host gets a connection pool of at
+    most ``max_connections`` keep-alive connections; when all are busy, callers wait for a
+    free one instead of opening more (pool_block), which bounds the load on the upstream.
+    With a ``cache``, GET responses are served from it while fresh and revalidated once stale.
+    """
+
+    def __init__(self, base_url: str, connect_timeout: float = 3.05, read_timeout: float = 30.0,
+                 max_connections: int = 10, max_hosts: int = 4, retries: int = 3,
+                 backoff_factor: float = 0.5, headers: Optional[Dict[str, str]] = None,
+                 cache: Optional[FHIRResponseCache] = None):
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_connections = max_connections
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_connections,
+                              pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": FHIR_JSON})
+        if headers:
+            self.session.headers.update(headers)
+
+        # Concurrent identical GETs share one upstream request
+        self._flight = SingleFlight()
+
+        # Background threads prefetching the next Bundle page, created on first use
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        self._prefetch_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """Close all pooled connections and stop the prefetch threads."""
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown(wait=False, cancel_futures=True)
+        if self.cache is not None:
+            self.cache.close()
+        self.session.close()
+
+    def _prefetch(self, url: str) -> Future:
+        """Start fetching a page in the background."""
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                                             thread_name_prefix="fhir-prefetch")
+        return self._prefetch_executor.submit(self.get, url)
+
+    def search_request(self, fhir_query: Dict, page_size: Optional[int] = None) -> FHIRRequest:
+        """Return the canonical request on this client's server for a query built by FHIRQueryService."""
+        request = FHIRRequest.from_query(fhir_query, self.base_url)
+        return request.with_params(_count=page_size) if page_size else request
+
+    def get(self, url: str, params: Optional[Parameters] = None) -> Dict:
+        """
+        GET a FHIR resource or Bundle. Relative URLs are resolved against base_url; the URL
+        and params are sent in canonical form (sorted, encoded once), which is also the cache key.
+        Concurrent GETs of the same URL share one upstream request; each caller still gets
+        its own decoded copy.
+        """
+        if not url.startswith(("http://", "https://")):
+            url = urljoin(self.base_url + "/", url.lstrip("/"))
+        url = canonical_url(url, params)
+        (body, result), shared = self._flight.do(url, self._load, url)
+        return json.loads(body) if shared or result is None else result
+
+    def _load(self, url: str) -> Tuple[bytes, Optional[Dict]]:
+        """
+        Fetch a URL through the cache: (body, decoded body), where the decoded body is None
+        when it was not decoded yet (cache hits).
+        """
+        if self.cache is None:
+            return self._decode(self._request(url))
+
+        body, etag = self.cache.lookup(url)
+        if body is not None:
+            return body, None
+        response = self._request(url, {"If-None-Match": etag} if etag else None)
+        if response.status_code == 304:
+            body = self.cache.refresh(url)
+            if body is not None:
+                return body, None
+            # Evicted meanwhile: fetch the full response again
+            response = self._request(url)
+        body, result = self._decode(response)
+        if "no-store" not in response.headers.get("Cache-Control", ""):
+            self.cache.store(url, body, response.headers.get("ETag"))
+        return body, result
+
+    def _request(self, url: str, headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        try:
+            return self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise FHIRClientError(f"FHIR request failed: {e}", url) from e
+
+    def _decode(self, response: requests.Response) -> Tuple[bytes, Dict]:
+        """Decode a response, raising FHIRClientError for error statuses and invalid JSON."""
+        if response.status_code >= 400:
+            outcome = None
+            try:
+                outcome = response.json()
+            except ValueError:
+                pass
+            raise FHIRClientError(f"FHIR server returned {response.status_code} for {response.url}",
+                                  response.url, response.status_code, outcome)
+        try:
+            return response.content, response.json()
+        except ValueError as e:
+            raise FHIRClientError(f"FHIR server returned invalid JSON for {response.url}",
+                                  response.url, response.status_code) from e
+
+    def coalescing_stats(self) -> Dict:
+        """Counters of upstream GETs executed and coalesced into an identical in-flight GET."""
+        return self._flight.stats()
+
+    def search(self, fhir_query: Dict) -> Dict:
+        """Execute a search built by FHIRQueryService and return the first Bundle page."""
+        return self.get(self.search_request(fhir_query).url)
+
+    def iter_pages(self, fhir_query: Dict, page_size: Optional[int] = None, max_pages: Optional[int] = None,
+                   prefetch: bool = True) -> Iterator[Dict]:
+        """
+        Lazily iterate over every Bundle page of a search, following link[rel=next].
+        With prefetch, the next page is requested in the background while the caller
+        consumes the current one. Closing the iterator early cancels a pending prefetch.
+        """
+        return self._iter_pages(self.search_request(fhir_query, page_size).url, max_pages, prefetch)
+
+    def _iter_pages(self, url: str, max_pages: Optional[int], prefetch: bool) -> Iterator[Dict]:
+        pending: Optional[Future] = None
+        try:
+            page = self.get(url)
+            pages = 1
+            while True:
+                url = next_link(page)
+                if max_pages is not None and pages >= max_pages:
+                    url = None
+                if url and prefetch:
+                    pending = self._prefetch(url)
+                yield page
+                if not url:
+                    return
+                if pending is not None:
+                    page, pending = pending.result(), None
+                else:
+                    page = self.get(url)
+                pages += 1
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def iter_resources(self, fhir_query: Dict, page_size: Optional[int] = None,
+                       max_pages: Optional[int] = None, prefetch: bool = True) -> Iterator[Dict]:
+        """Lazily yield every resource matched by a search, across all Bundle pages."""
+        pages = self.iter_pages(fhir_query, page_size, max_pages, prefetch)
+        try:
+            for page in pages:
+                for entry in page.get("entry", []):
+                    resource = entry.get("resource")
+                    if resource is not None:
+                        yield resource
+        finally:
+            pages.close()
+
+    async def execute_plan_async(self, plan: List[Dict], concurrency: int = 4, max_pages: int = 1,
+                                 inner_join: bool = True) -> Dict:
+        """
+        Run every search of a query plan (FHIRQueryService.build_query_plan) concurrently,
+        at most ``concurrency`` at a time, and join the results by patient reference.
+        Each search reads up to ``max_pages`` Bundle pages. Blocking HTTP calls run in worker
+        threads on the shared pooled session, so total latency is roughly the slowest search.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(fhir_query: Dict) -> Dict:
+            async with semaphore:
+                start = time.perf_counter()
+                outcome = {"resource_type": fhir_query.get("resource_type"),
+                           "parameters": fhir_query.get("parameters", {})}
+                try:
+                    resources = await asyncio.to_thread(
+                        lambda: list(self.iter_resources(fhir_query, max_pages=max_pages, prefetch=False)))
+                    outcome.update(status="ok", count=len(resources))
+                except (FHIRClientError, ValueError) as e:
+                    resources = []
+                    outcome.update(status="error", error=str(e), status_code=getattr(e, "status_code", None))
+                outcome["elapsed_ms"] = (time.perf_counter() - start) * 1000
+                return {"outcome": outcome, "resources": resources}
+
+        start = time.perf_counter()
+        completed = await asyncio.gather(*(run(fhir_query) for fhir_query in plan))
+        # Failed searches are reported but left out of the join, so they do not empty it
+        joinable = [(item["outcome"]["resource_type"], item["resources"])
+                    for item in completed if item["outcome"]["status"] == "ok"]
+        return {
+            "requests": [item["outcome"] for item in completed],
+            "patients": join_by_patient(joinable, inner=inner_join),
+            "join": "inner" if inner_join else "outer",
+            "elapsed_ms": (time.perf_counter() - start) * 1000
+        }
+
+    def execute_plan(self, plan: List[Dict], concurrency: int = 4, max_pages: int = 1,
+                     inner_join: bool = True) -> Dict:
+        """Synchronous wrapper around execute_plan_async for callers without an event loop."""
+        return asyncio.run(self.execute_plan_async(plan, concurrency, max_pages, inner_join))
+
+    def read(self, resource_type: str, resource_id: str) -> Dict:
+        """Read one resource by type and id."""
+        return self.get(f"{self.base_url}/{resource_type}/{resource_id}")
+
+    def execute(self, fhir_query: Dict) -> Dict:
+        """
+        Execute a query and describe the outcome for API responses:
+        {"status": "ok", "bundle": ..., "elapsed_ms": ...} or {"status": "error", "error": ..., ...}.
+        """
+        start = time.perf_counter()
+        execution = {"resource_type": fhir_query.get("resource_type")}
+        try:
+            execution["bundle"] = self.search(fhir_query)
+            execution["status"] = "ok"
+        except (FHIRClientError, ValueError) as e:
+            execution["status"] = "error"
+            execution["error"] = str(e)
+            execution["status_code"] = getattr(e, "status_code", None)
+        execution["elapsed_ms"] = (time.perf_counter() - start) * 1000
+        return execution
@@ -0,0 +1,128 @@
+"""
+Request coalescing ("single flight") for the FHIR Query API.
+Concurrent calls with the same key share one execution: the first caller (the leader)
+runs the function, later callers wait for it and receive the same result or exception.
+Nothing is cached once the call completes, so results are never stale.
+SingleFlight is for threads, AsyncSingleFlight for coroutines on one event loop.
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Thread-safe single flight. Results are shared between all callers of one flight, so
+    they must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """Run func(*args, **kwargs) once per concurrent key; returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            return {
+                "enabled": True,
+                "in_flight": len(self._calls),
+                "executed": self.leaders,
+                "coalesced": self.coalesced,
+                "coalesced_ratio": self.coalesced / calls if calls else 0.0
+            }
+
+
+class _AsyncCall:
+    __slots__ = ("task", "callers")
+
+    def __init__(self):
+        self.task = None
+        self.callers = 1
+
+
+class AsyncSingleFlight:
+    """
+    Single flight for coroutines running on one event loop (no locking needed).
+    The call runs as its own task that every caller awaits through asyncio.shield, so a
+    cancelled caller (the first one included) only stops waiting; the task is cancelled once
+    no caller is left.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _AsyncCall] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def _run(self, key: Hashable, call: _AsyncCall, func: Callable[..., Awaitable], args, kwargs) -> Any:
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs) -> Tuple[Any, bool]:
+        """Await func(*args, **kwargs) once per concurrent key; returns (result, shared)."""
+        call = self._calls.get(key)
+        shared = call is not None
+        if shared:
+            call.callers += 1
+            self.coalesced += 1
+        else:
+            call = self._calls[key] = _AsyncCall()
+            call.task = asyncio.ensure_future(self._run(key, call, func, args, kwargs))
+            self.leaders += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.callers -= 1
+            if not call.callers and not call.task.done():
+                call.task.cancel()
+
+    def stats(self) -> Dict:
+        calls = self.leaders + self.coalesced
+        return {
+            "enabled": True,
+            "in_flight": len(self._calls),
+            "executed": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": self.coalesced / calls if calls else 0.0
+        }
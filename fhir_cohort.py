@@ -0,0 +1,199 @@
+"""
+Seeded, vectorized simulated cohorts for the FHIR Query API.
+
+Every attribute of patient ``i`` in a cohort is a pure function of (seed, i, attribute):
+a SplitMix64 hash computed with NumPy over an index range. Any page can therefore be
+regenerated in O(page_size) without storing the cohort, and identical seeds always give
+identical patients. Chart aggregates need the age, gender and status columns of the whole
+cohort; they are computed in vectorized chunks with np.bincount and cached per seed.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("Warning: NumPy not installed, simulated cohorts use the per-patient generator. Install with: pip install numpy")
+
+SAMPLE_NAMES = [
+    "John Smith", "Sarah Johnson", "Michael Brown", "Emily Davis",
+    "David Wilson", "Jessica Garcia", "Robert Miller", "Ashley Rodriguez",
+    "Christopher Martinez", "Amanda Anderson", "Matthew Taylor", "Jennifer Thomas"
+]
+
+# Upper bounds of the age chart buckets; ages above the last one fall in "75+"
+AGE_GROUPS = ['18-30', '31-45', '46-60', '61-75', '75+']
+AGE_GROUP_LIMITS = [30, 45, 60, 75]
+
+STATUSES = ["active", "inactive"]
+
+# Attribute streams: each attribute hashes a different stream, so values are independent
+(AGE, GENDER, STATUS, NAME, ID, BIRTH_MONTH, BIRTH_DAY, VISIT_MONTH, VISIT_DAY, MRN,
+ PHONE_AREA, PHONE_PREFIX, PHONE_LINE, COHORT_SIZE) = range(14)
+
+# Aggregates are computed over this many patients at a time to bound memory
+AGGREGATE_CHUNK = 1 << 16
+
+MASK64 = (1 << 64) - 1
+
+if NUMPY_AVAILABLE:
+    _GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+    _MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+    _MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _uniform(seed: int, index: "np.ndarray", stream: int) -> "np.ndarray":
+    """Uniform floats in [0, 1) for patients ``index`` of one attribute stream (SplitMix64)."""
+    offset = np.uint64((seed * 0xD1B54A32D192ED03 + stream * 0x8CB92BA72F3D8DD7) & MASK64)
+    with np.errstate(over='ignore'):
+        z = index.astype(np.uint64) * _GOLDEN + offset
+        z = (z ^ (z >> np.uint64(30))) * _MIX1
+        z = (z ^ (z >> np.uint64(27))) * _MIX2
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+def _integers(seed: int, index: "np.ndarray", stream: int, low: int, high: int) -> "np.ndarray":
+    """Integers in [low, high) for patients ``index`` of one attribute stream."""
+    return low + (_uniform(seed, index, stream) * (high - low)).astype(np.int64)
+
+
+def cohort_size(seed: int, default: int = 0) -> int:
+    """Patients in a seeded cohort: ``default`` when set, otherwise 3-8 chosen by the seed."""
+    if default:
+        return default
+    return int(_integers(seed, np.zeros(1, dtype=np.uint64), COHORT_SIZE, 3, 9)[0])
+
+
+def _ages(seed: int, index: "np.ndarray", ages: List[int]) -> "np.ndarray":
+    if ages:
+        return ages[0] + _integers(seed, index, AGE, -10, 11)
+    return _integers(seed, index, AGE, 25, 76)
+
+
+def _genders(entities: Dict) -> List[str]:
+    return list(dict.fromkeys(entities.get('genders', []))) or ['male', 'female']
+
+
+def _conditions(entities: Dict) -> List[str]:
+    return (entities.get('conditions', []) or ['hypertension', 'diabetes'])[:2]
+
+
+def simulate_page(entities: Dict, seed: int, start: int, stop: int) -> List[Dict]:
+    """Build patients start..stop-1 of the seeded cohort as dicts."""
+    index = np.arange(start, max(start, stop), dtype=np.uint64)
+    genders = _genders(entities)
+    conditions = _conditions(entities)
+    medications = entities.get('medications', [])[:3] or ["aspirin", "lisinopril"]
+
+    age = _ages(seed, index, entities.get('ages', []))
+    # .tolist() converts each column to Python ints in one call
+    columns = zip(
+        index.tolist(), age.tolist(), np.maximum(18, age).tolist(),
+        _integers(seed, index, GENDER, 0, len(genders)).tolist(),
+        (_uniform(seed, index, STATUS) < 0.5).tolist(),
+        _integers(seed, index, NAME, 0, len(SAMPLE_NAMES)).tolist(),
+        _integers(seed, index, ID, 0, 1 << 32).tolist(),
+        _integers(seed, index, BIRTH_MONTH, 1, 13).tolist(),
+        _integers(seed, index, BIRTH_DAY, 1, 29).tolist(),
+        _integers(seed, index, VISIT_MONTH, 1, 13).tolist(),
+        _integers(seed, index, VISIT_DAY, 1, 29).tolist(),
+        _integers(seed, index, MRN, 100000, 1000000).tolist(),
+        _integers(seed, index, PHONE_AREA, 200, 1000).tolist(),
+        _integers(seed, index, PHONE_PREFIX, 200, 1000).tolist(),
+        _integers(seed, index, PHONE_LINE, 1000, 10000).tolist()
+    )
+    patients = []
+    for (i, raw_age, patient_age, gender, is_active, name, patient_id, birth_month, birth_day,
+         visit_month, visit_day, mrn, area, prefix, line) in columns:
+        patients.append({
+            "id": f"patient-{patient_id:08x}",
+            "name": SAMPLE_NAMES[name],
+            "age": patient_age,
+            "gender": genders[gender],
+            "birthDate": f"{2024 - raw_age}-{birth_month:02d}-{birth_day:02d}",
+            "conditions": conditions,
+            "medications": medications,
+            "lastVisit": f"2024-{visit_month:02d}-{visit_day:02d}",
+            "mrn": f"MRN{mrn}",
+            "status": STATUSES[0] if is_active else STATUSES[1],
+            "contactInfo": {
+                "phone": f"({area}) {prefix}-{line}",
+                "email": f"patient{i+1}@example.com"
+            }
+        })
+    return patients
+
+
+class CohortAggregateCache:
+    """Thread-safe LRU of whole-cohort aggregates, keyed by seed, size and the entities they depend on."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Tuple, value: Dict):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+aggregate_cache = CohortAggregateCache()
+
+
+def cohort_aggregates(entities: Dict, seed: int, patient_count: int) -> Dict:
+    """
+    Age groups, gender counts, condition counts, mean age and active patients of the whole
+    cohort. Every patient carries the same conditions, so condition counts are exact without
+    generating anything; the rest is computed in chunks and cached per seed.
+    """
+    ages = entities.get('ages', [])
+    genders = _genders(entities)
+    key = (seed, patient_count, ages[0] if ages else None, tuple(genders))
+    cached = aggregate_cache.get(key)
+    if cached is None:
+        age_groups = np.zeros(len(AGE_GROUPS), dtype=np.int64)
+        gender_counts = np.zeros(len(genders), dtype=np.int64)
+        age_sum = active = 0
+        for start in range(0, patient_count, AGGREGATE_CHUNK):
+            index = np.arange(start, min(start + AGGREGATE_CHUNK, patient_count), dtype=np.uint64)
+            age = np.maximum(18, _ages(seed, index, ages))
+            age_groups += np.bincount(np.searchsorted(AGE_GROUP_LIMITS, age, side='left'),
+                                      minlength=len(AGE_GROUPS))
+            gender_counts += np.bincount(_integers(seed, index, GENDER, 0, len(genders)),
+                                         minlength=len(genders))
+            age_sum += int(age.sum())
+            active += int((_uniform(seed, index, STATUS) < 0.5).sum())
+        cached = {
+            "age_groups": dict(zip(AGE_GROUPS, age_groups.tolist())),
+            "gender_counts": dict(zip(genders, gender_counts.tolist())),
+            "avg_age": age_sum / patient_count if patient_count else 0,
+            "active": active
+        }
+        aggregate_cache.put(key, cached)
+    return dict(cached, condition_counts={condition: patient_count for condition in _conditions(entities)})
+
+
+def simulate_cohort(entities: Dict, patient_count: int, seed: int, page: int = 1, page_size: int = 50) -> Dict:
+    """
+    One page (1-based) of a seeded cohort of ``patient_count`` patients, plus whole-cohort
+    aggregates: {"patients", "age_groups", "gender_counts", "condition_counts", "avg_age", "active"}.
+    """
+    start = (page - 1) * page_size
+    cohort = cohort_aggregates(entities, seed, patient_count)
+    cohort["patients"] = simulate_page(entities, seed, start, min(start + page_size, patient_count))
+    return cohort
@@ -0,0 +1,109 @@
+"""
+Response serialization for the FHIR Query API.
+dumps() returns compact UTF-8 JSON bytes, through orjson when it is installed and the stdlib
+encoder otherwise (JSON_SERIALIZER=auto|orjson|json), so constant payloads can be serialized
+once at import and sent as bytes. compress() gzip- or brotli-encodes bodies of at least
+COMPRESSION_MIN_BYTES for clients that accept it.
+"""
+
+import gzip
+import json
+import os
+from typing import Any, Optional, Tuple
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    print("Warning: orjson not installed, responses use the stdlib JSON encoder. Install with: pip install orjson")
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    # gzip covers every client; brotli only makes large bodies smaller still
+    BROTLI_AVAILABLE = False
+
+# Serializer: auto (orjson when installed), orjson or json
+JSON_SERIALIZER = os.environ.get('JSON_SERIALIZER', 'auto').lower()
+
+# Compress responses of at least this many bytes (0: never); gzip level 1-9, brotli quality 0-11
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '5'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '4'))
+
+# Content types worth compressing (prefix match); NDJSON streams are sent as they are produced
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+if JSON_SERIALIZER == 'orjson' and not ORJSON_AVAILABLE:
+    print("Warning: JSON_SERIALIZER=orjson but orjson is not installed, using the stdlib encoder")
+USE_ORJSON = ORJSON_AVAILABLE and JSON_SERIALIZER in ('auto', 'orjson')
+SERIALIZER_NAME = "orjson" if USE_ORJSON else "json"
+
+if USE_ORJSON:
+    # NumPy scalars and arrays serialize natively; non-string keys are stringified like json does
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _default(obj: Any) -> Any:
+    """Fallback for the stdlib encoder: NumPy values, datetimes and dates."""
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact UTF-8 JSON (no spaces, non-ASCII kept as is); keys keep their insertion order."""
+    if USE_ORJSON:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=_default).encode()
+
+
+def loads(data: Any) -> Any:
+    """Parse JSON from bytes or str."""
+    if USE_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Preferred encoding the client accepts: br (when installed), then gzip, else None."""
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip())
+    if BROTLI_AVAILABLE and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, accept_encoding: str) -> Tuple[bytes, Optional[str]]:
+    """
+    Compress ``body`` for a client sending ``accept_encoding``; returns (body, encoding),
+    with encoding None when the body is below COMPRESSION_MIN_BYTES or nothing is accepted.
+    """
+    if not COMPRESSION_MIN_BYTES or len(body) < COMPRESSION_MIN_BYTES or not accept_encoding:
+        return body, None
+    encoding = accepted_encoding(accept_encoding)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), encoding
+    if encoding == "gzip":
+        # mtime=0 keeps the output identical for identical bodies
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), encoding
+    return body, None
@@ -0,0 +1,186 @@
+"""
+FHIR Query API - Prometheus metrics
+Request, NLP stage, cache, fallback and FHIR upstream metrics shared by the Flask and ASGI servers.
+
+Metrics are recorded with prometheus_client (optional). Under a multi-process server
+(gunicorn workers, uvicorn --workers) set PROMETHEUS_MULTIPROC_DIR to an empty, writable
+directory before start-up: each process then writes its values to memory-mapped files in
+that directory and /metrics aggregates them at scrape time. gunicorn.conf.py does this
+automatically.
+"""
+
+import os
+from contextlib import contextmanager, nullcontext
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        CollectorRegistry,
+        Counter,
+        Gauge,
+        Histogram,
+        REGISTRY,
+        generate_latest,
+        multiprocess
+    )
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+    print("Warning: prometheus_client not installed, /metrics is disabled. Install with: pip install prometheus-client")
+
+METRICS_ENABLED = PROMETHEUS_AVAILABLE and os.environ.get('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
+# Request latency buckets (seconds) and NLP stage buckets (seconds, mirrors StageHistograms)
+REQUEST_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+if PROMETHEUS_AVAILABLE:
+    REQUESTS = Counter(
+        'fhir_requests_total', 'API requests by endpoint and HTTP status',
+        ['endpoint', 'status']
+    )
+    REQUEST_LATENCY = Histogram(
+        'fhir_request_latency_seconds', 'API request latency by endpoint',
+        ['endpoint'], buckets=REQUEST_LATENCY_BUCKETS
+    )
+    IN_FLIGHT = Gauge(
+        'fhir_requests_in_flight', 'Requests currently being processed, by endpoint',
+        ['endpoint'], multiprocess_mode='livesum'
+    )
+    QUERIES = Counter(
+        'fhir_queries_total', 'Processed natural language queries by intent and NLP tier',
+        ['intent', 'nlp_tier']
+    )
+    STAGE_LATENCY = Histogram(
+        'fhir_nlp_stage_latency_seconds', 'Wall time of each NLP pipeline stage',
+        ['stage'], buckets=STAGE_LATENCY_BUCKETS
+    )
+    CACHE_LOOKUPS = Counter(
+        'fhir_query_cache_lookups_total', 'Result cache lookups by result (hit or miss)',
+        ['result']
+    )
+    REGEX_FALLBACKS = Counter(
+        'fhir_regex_fallback_total', 'Queries answered without spaCy, by reason',
+        ['reason']
+    )
+    UPSTREAM_REQUESTS = Counter(
+        'fhir_upstream_requests_total', 'FHIR server searches by resource type and outcome',
+        ['resource_type', 'outcome']
+    )
+    COALESCED = Counter(
+        'fhir_coalesced_requests_total', 'Requests answered by sharing an identical in-flight computation',
+        ['endpoint']
+    )
+    UPSTREAM_LATENCY = Histogram(
+        'fhir_upstream_latency_seconds', 'FHIR server search latency, including retries',
+        ['resource_type'], buckets=REQUEST_LATENCY_BUCKETS
+    )
+
+# Labelled children by (metric, label values), so the hot path skips the registry lock in labels()
+_children = {}
+
+def _child(metric, *label_values):
+    key = (metric, label_values)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*label_values)
+    return child
+
+def query_sample(service, result):
+    """
+    Summarize one processed query for the metrics: intent, NLP tier, stage timings, cache
+    result and regex fallback reason. Plain data, so it can cross process boundaries.
+    """
+    nlp_analysis = result.get('nlp_analysis', {})
+    timings = nlp_analysis.get('timings')
+    sample = {
+        "intent": nlp_analysis.get('intent', 'unknown'),
+        "nlp_tier": nlp_analysis.get('nlp_tier', 'rules'),
+        "stages": {},
+        "cache": None,
+        "fallback": None,
+        "upstream": None
+    }
+    if timings:
+        sample["stages"] = {name: stage['wall_ms'] for name, stage in timings['stages'].items()}
+        if service.result_cache:
+            sample["cache"] = "hit" if timings.get('cached') else "miss"
+    if nlp_analysis.get('nlp_method') == 'regex':
+        if service.nlp is not None:
+            sample["fallback"] = "rules_tier"
+        elif not service.model_ready:
+            sample["fallback"] = "warming_up"
+        else:
+            sample["fallback"] = "model_unavailable"
+    sample["upstream"] = upstream_sample(result)
+    return sample
+
+def upstream_sample(result):
+    """Resource type, outcome and latency of an executed FHIR search, or None"""
+    execution = result.get('fhir_execution')
+    if not execution:
+        return None
+    return {
+        "resource_type": execution.get('resource_type') or 'none',
+        "outcome": execution['status'],
+        "elapsed_ms": execution['elapsed_ms']
+    }
+
+def record_query(sample):
+    """Record a query sample produced by query_sample"""
+    if not METRICS_ENABLED:
+        return
+    _child(QUERIES, sample['intent'], sample['nlp_tier']).inc()
+    for stage, wall_ms in sample['stages'].items():
+        _child(STAGE_LATENCY, stage).observe(wall_ms / 1000)
+    if sample['cache']:
+        _child(CACHE_LOOKUPS, sample['cache']).inc()
+    if sample['fallback']:
+        _child(REGEX_FALLBACKS, sample['fallback']).inc()
+    upstream = sample.get('upstream')
+    if upstream:
+        _child(UPSTREAM_REQUESTS, upstream['resource_type'], upstream['outcome']).inc()
+        _child(UPSTREAM_LATENCY, upstream['resource_type']).observe(upstream['elapsed_ms'] / 1000)
+
+def record_coalesced(endpoint):
+    """Count a request that shared another request's computation instead of running its own"""
+    if METRICS_ENABLED:
+        _child(COALESCED, endpoint).inc()
+
+@contextmanager
+def _tracked_request(endpoint):
+    request = {"status": 200}
+    in_flight = _child(IN_FLIGHT, endpoint)
+    in_flight.inc()
+    with _child(REQUEST_LATENCY, endpoint).time():
+        try:
+            yield request
+        except Exception:
+            request["status"] = 500
+            raise
+        finally:
+            in_flight.dec()
+            _child(REQUESTS, endpoint, str(request["status"])).inc()
+
+def track_request(endpoint):
+    """
+    Context manager timing one request and counting it in the in-flight gauge.
+    Set ``["status"]`` on the yielded dict to record a non-200 status.
+    """
+    if not METRICS_ENABLED:
+        return nullcontext({"status": 200})
+    return _tracked_request(endpoint)
+
+def metrics_payload():
+    """Return (body, content type) for a scrape, aggregating all processes in multi-process mode"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+    """Drop the live gauge values of an exited worker (multi-process mode)"""
+    if PROMETHEUS_AVAILABLE and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
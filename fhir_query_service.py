@@ -1,25 +1,433 @@
+import bisect
+import contextlib
+import copy
+import importlib.util
 import json
 import re
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 import uuid
 
+from fhir_request import FHIRRequest
+from fhir_sentiment import LexiconSentimentScorer, TextBlobSentimentScorer
+
 # NLP Library Integration
-try:
-    import spacy
-    from spacy.lang.en.stop_words import STOP_WORDS
-    SPACY_AVAILABLE = True
-except ImportError:
-    SPACY_AVAILABLE = False
+# spaCy and TextBlob are only located here; they are imported when the models are loaded
+# (see FHIRQueryService._load_nlp_models) so importing this module stays fast.
+SPACY_AVAILABLE = importlib.util.find_spec("spacy") is not None
+if not SPACY_AVAILABLE:
     print("Warning: spaCy not installed. Install with: pip install spacy && python -m spacy download en_core_web_sm")
 
-# Additional NLP libraries for sentiment analysis
-try:
-    from textblob import TextBlob
-    TEXTBLOB_AVAILABLE = True
-except ImportError:
-    TEXTBLOB_AVAILABLE = False
-    print("Warning: TextBlob not available for sentiment analysis. Install with: pip install textblob")
+# Optional TextBlob sentiment backend (the built-in lexicon scorer needs no extra packages)
+TEXTBLOB_AVAILABLE = importlib.util.find_spec("textblob") is not None
+
+# spaCy pipeline variants. The service only reads doc.ents (ner), token.pos_ (tagger +
+# attribute_ruler) and token.dep_ (parser), so the lemmatizer is never needed. "no_parser"
+# also drops the dependency parser and switches the symptom rule to a POS-only check.
+SPACY_PIPELINE_PRESETS = {
+    "full": [],
+    "trimmed": ["lemmatizer"],
+    "no_parser": ["lemmatizer", "parser"]
+}
+
+# Body part terms recognised from spaCy tokens
+BODY_PART_TERMS = {"head", "chest", "back", "leg", "arm", "stomach", "heart", "lung", "kidney", "liver"}
+
+# Compiled regex registry for rule-based extraction, built once at import.
+# ENTITY_PATTERN merges the symptom, severity, age, gender, patient ID and name rules into one
+# alternation inside a lookahead, so a single finditer pass fills every regex-derived entity bucket
+# while still reporting matches that overlap each other (e.g. "head pain" and "pain").
+# Group names are <bucket>_<rule index>; the index keeps results in rule order.
+ENTITY_PATTERN = re.compile(r"""(?=
+      \b(?P<symptoms_0>pain|ache|hurt|sore|tender)\b
+    | \b(?P<symptoms_1>fever|temperature|hot|cold)\b
+    | \b(?P<symptoms_2>nausea|dizzy|tired|fatigue)\b
+    | \b(?P<symptoms_3>cough|sneeze|runny\ nose)\b
+    | \b(?P<symptoms_4>headache|migraine|head\ pain)\b
+    | \b(?P<symptoms_5>shortness\ of\ breath|difficulty\ breathing)\b
+    | \b(?P<severity_indicators_0>severe|mild|moderate|chronic|acute)\b
+    | \b(?P<severity_indicators_1>intense|sharp|dull|throbbing)\b
+    | \b(?P<severity_indicators_2>persistent|occasional|frequent)\b
+    | over\s+(?P<ages_0>\d+)
+    | above\s+(?P<ages_1>\d+)
+    | (?<!\d)(?P<ages_2>\d+)\s+years?\s*old
+    | age\s+(?P<ages_3>\d+)
+    | aged\s+(?P<ages_4>\d+)
+    | \b(?P<genders_0>male|female)\b
+    | patient\s+(?P<patient_ids_0>[a-zA-Z0-9-]+)
+    | named?\s+(?P<names_0>[a-zA-Z\s]+)
+)""", re.VERBOSE)
+
+REGEX_PATTERNS = {
+    "entities": ENTITY_PATTERN,
+    "patient_id": re.compile(r'patient\s+([a-zA-Z0-9-]+)'),
+    "name": re.compile(r'named?\s+([a-zA-Z\s]+)'),
+    "age_range": re.compile(r'(\d+)\s*(?:to|-)?\s*(\d+)?\s*years?\s*old'),
+    "last_days": re.compile(r'last\s+(\d+)\s+days?'),
+    "medication_name": re.compile(r'(?:medication|drug)\s+([a-zA-Z]+)')
+}
+
+# Fallback tokenizer used for token spans when no spaCy Doc is available
+TOKEN_PATTERN = re.compile(r"\w+(?:[-']\w+)*|[^\w\s]")
+
+# Cheap cues that spaCy could contribute something the rules cannot: DATE entities,
+# PERSON entities (spaCy runs on lower-cased text, so names need context or capitals in
+# the original query), CARDINAL numbers, ORG/GPE entities (capitalized words and acronyms)
+# and dependency-based symptoms such as "swelling" or "stomachache".
+DATE_CUE_PATTERN = re.compile(
+    r"\b(?:today|tonight|tomorrow|yesterday|days?|weeks?|months?|years?|ago|lately|recent(?:ly)?"
+    r"|last|next|since|during|january|february|march|april|may|june|july|august|september|october"
+    r"|november|december|monday|tuesday|wednesday|thursday|friday|saturday|sunday|\d{4})\b"
+    r"|\d{1,2}/\d{1,2}"
+)
+PERSON_CUE_PATTERN = re.compile(r"\b(?:named?|called|dr|mr|mrs|ms|miss)\b")
+CAPITALIZED_WORD_PATTERN = re.compile(r"(?<=\s)[A-Z][A-Za-z]+")
+# Only spaCy decides which digits are CARDINAL entities ("over 50") and which belong to
+# DATEs ("last 30 days"), so any digit sends the query to spaCy
+NUMBER_CUE_PATTERN = re.compile(r"\d")
+SYMPTOM_STEM_PATTERN = re.compile(r"\w*(?:pain|ache|swelling|rash|fever)\w*")
+
+def scan_entity_patterns(text: str) -> Dict[str, List[str]]:
+    """
+    Run the combined entity pattern over already lower-cased text.
+    Returns raw matches per bucket (symptoms, severity_indicators, ages, genders, patient_ids, names).
+    """
+    found: Dict[str, List[Tuple[int, str]]] = {}
+    rule_ends: Dict[str, int] = {}
+    for match in ENTITY_PATTERN.finditer(text):
+        group = match.lastgroup
+        # Like findall, a rule never reports a match overlapping its own previous one
+        if match.start() < rule_ends.get(group, 0):
+            continue
+        rule_ends[group] = match.end(group)
+        bucket, rule_index = group.rsplit("_", 1)
+        found.setdefault(bucket, []).append((int(rule_index), match.group(group)))
+    
+    # Stable sort keeps text order within each rule
+    return {bucket: [value for _, value in sorted(values, key=lambda item: item[0])]
+            for bucket, values in found.items()}
+
+class LexiconMatcher:
+    """
+    Aho-Corasick automaton over the service lexicons (conditions, observations, medications, urgency terms).
+    Finds every lexicon hit, including overlapping ones, with offsets in a single pass over the text,
+    so matching cost grows with query length rather than lexicon size.
+    """
+    
+    def __init__(self, lexicons: Dict[str, Iterable[str]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, str, int]]] = [[]]
+        
+        # Remember lexicon order so grouped results match dictionary order
+        self._order: Dict[Tuple[str, str], int] = {}
+        
+        for category, terms in lexicons.items():
+            for term in terms:
+                self._add_term(category, term)
+        self._build_failure_links()
+    
+    def _add_term(self, category: str, term: str):
+        """Insert a term into the keyword trie."""
+        key = (category, term)
+        if key in self._order:
+            return
+        self._order[key] = len(self._order)
+        
+        state = 0
+        for char in term.lower():
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((category, term, len(term)))
+    
+    def _build_failure_links(self):
+        """Compute failure links breadth-first and merge outputs along them."""
+        # Depth-one states fail back to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                if state:
+                    self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+    
+    def find_all(self, text: str) -> List[Tuple[int, int, str, str]]:
+        """
+        Scan already lower-cased text once.
+        Returns (start, end, category, term) for every hit, ordered by end offset.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        hits = []
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for category, term, length in output[state]:
+                hits.append((index + 1 - length, index + 1, category, term))
+        return hits
+    
+    def group_terms(self, hits: List[Tuple[int, int, str, str]]) -> Dict[str, List[str]]:
+        """Group hits into unique terms per category, in lexicon order."""
+        grouped: Dict[str, List[str]] = {}
+        for _, _, category, term in sorted(set(hits), key=lambda hit: self._order[(hit[2], hit[3])]):
+            terms = grouped.setdefault(category, [])
+            if term not in terms:
+                terms.append(term)
+        return grouped
+
+class NormalizedQuery:
+    """
+    A query normalized once per request and shared by every pipeline stage.
+    Carries the original text, the lower-cased text, token spans, the spaCy Doc (when parsed)
+    and the lexicon hits, so no stage has to lower-case or rescan the query again.
+    """
+    
+    __slots__ = ("text", "lower", "doc", "lexicon_terms", "polarity", "_token_spans", "_pattern_matches")
+    
+    def __init__(self, text: str, doc=None):
+        self.text = text
+        self.lower = text.lower()
+        self.doc = doc
+        self.lexicon_terms: Dict[str, List[str]] = {}
+        self.polarity: Optional[float] = None
+        self._token_spans: Optional[List[Tuple[int, int]]] = None
+        self._pattern_matches: Optional[Dict[str, List[str]]] = None
+    
+    @property
+    def pattern_matches(self) -> Dict[str, List[str]]:
+        """Regex entity matches (see scan_entity_patterns), computed on first use."""
+        if self._pattern_matches is None:
+            self._pattern_matches = scan_entity_patterns(self.lower)
+        return self._pattern_matches
+    
+    @property
+    def cache_key(self) -> str:
+        """
+        Case-insensitive key of the query text. The result cache adds the NLP tier in tiered
+        mode (FHIRQueryService.result_cache_key), since routing looks at capitalization.
+        """
+        return self.lower.strip()
+    
+    @property
+    def token_spans(self) -> List[Tuple[int, int]]:
+        """(start, end) offsets of each token in the lower-cased text."""
+        if self._token_spans is None:
+            if self.doc is not None:
+                self._token_spans = [(token.idx, token.idx + len(token)) for token in self.doc]
+            else:
+                self._token_spans = [match.span() for match in TOKEN_PATTERN.finditer(self.lower)]
+        return self._token_spans
+    
+    def contains_any(self, terms: Iterable[str]) -> bool:
+        """Check whether any of the terms occurs in the lower-cased text."""
+        lower = self.lower
+        return any(term in lower for term in terms)
+
+class QueryResultCache:
+    """
+    Thread-safe LRU cache for query analysis results with TTL and size-based eviction.
+    Entries are deep-copied on the way in and out so callers can mutate results freely.
+    """
+    
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _live_entry(self, key: str) -> Optional[Dict]:
+        """Return the entry for key if present and not expired. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        return value
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """Look up a result, counting a hit or miss."""
+        with self._lock:
+            value = self._live_entry(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(value)
+    
+    def put(self, key: str, value: Dict):
+        """Store a result, evicting the least recently used entries beyond max_entries."""
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._live_entry(key) is not None
+    
+    def clear(self):
+        """Drop all entries and reset counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+    
+    def stats(self) -> Dict:
+        """Return size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+class _TimedStage:
+    """Context manager adding the wall and CPU time of one stage to a StageTimer."""
+
+    __slots__ = ("timer", "name", "wall_start", "cpu_start")
+
+    def __init__(self, timer: "StageTimer", name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.wall_start, time.thread_time() - self.cpu_start)
+        return False
+
+class StageTimer:
+    """
+    Per-request stage timings: wall time (perf_counter) and CPU time of the calling thread.
+    Use ``with timer.stage("name"):`` around each stage; repeated stages accumulate.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, List[float]] = {}
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+
+    def stage(self, name: str) -> _TimedStage:
+        return _TimedStage(self, name)
+
+    def add(self, name: str, wall_seconds: float, cpu_seconds: float):
+        totals = self.stages.setdefault(name, [0.0, 0.0])
+        totals[0] += wall_seconds
+        totals[1] += cpu_seconds
+
+    def total(self) -> Tuple[float, float]:
+        """(wall, CPU) seconds since the timer was created."""
+        return time.perf_counter() - self._wall_start, time.thread_time() - self._cpu_start
+
+    def report(self) -> Dict:
+        """Timings in milliseconds, per stage and in total."""
+        wall, cpu = self.total()
+        return {
+            "stages": {
+                name: {"wall_ms": round(stage_wall * 1000, 4), "cpu_ms": round(stage_cpu * 1000, 4)}
+                for name, (stage_wall, stage_cpu) in self.stages.items()
+            },
+            "total": {"wall_ms": round(wall * 1000, 4), "cpu_ms": round(cpu * 1000, 4)}
+        }
+
+class _NullStageTimer:
+    """Stand-in used when timing is off; every stage is a shared no-op context."""
+
+    _stage = contextlib.nullcontext()
+
+    def stage(self, name: str):
+        return self._stage
+
+NULL_TIMER = _NullStageTimer()
+
+class StageHistograms:
+    """
+    Thread-safe wall-time histograms per stage, aggregated over requests.
+    Bucket bounds are upper limits in milliseconds (cumulative, Prometheus-style).
+    """
+
+    BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict] = {}
+
+    def _observe(self, name: str, wall_ms: float, cpu_ms: float):
+        """Record one observation. Caller holds the lock."""
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages[name] = {
+                "count": 0, "wall_ms_sum": 0.0, "cpu_ms_sum": 0.0, "buckets": [0] * (len(self.BUCKETS_MS) + 1)
+            }
+        stage["count"] += 1
+        stage["wall_ms_sum"] += wall_ms
+        stage["cpu_ms_sum"] += cpu_ms
+        stage["buckets"][bisect.bisect_left(self.BUCKETS_MS, wall_ms)] += 1
+
+    def observe(self, timer: StageTimer):
+        """Add every stage of a finished request, plus its total."""
+        wall, cpu = timer.total()
+        with self._lock:
+            for name, (stage_wall, stage_cpu) in timer.stages.items():
+                self._observe(name, stage_wall * 1000, stage_cpu * 1000)
+            self._observe("total", wall * 1000, cpu * 1000)
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+
+    def stats(self) -> Dict:
+        """Per stage: count, wall/CPU sums and cumulative bucket counts keyed by upper bound."""
+        with self._lock:
+            stats = {}
+            for name, stage in self._stages.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.BUCKETS_MS + ("+Inf",), stage["buckets"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                stats[name] = {
+                    "count": stage["count"],
+                    "wall_ms_sum": stage["wall_ms_sum"],
+                    "cpu_ms_sum": stage["cpu_ms_sum"],
+                    "mean_wall_ms": stage["wall_ms_sum"] / stage["count"],
+                    "buckets_ms": buckets
+                }
+            return stats
 
 class FHIRQueryService:
     """
@@ -29,17 +437,59 @@ class FHIRQueryService:
     Uses spaCy for advanced NLP processing when available, falls back to regex patterns.
     """
     
-    def __init__(self):
-        self.base_url = "https://hapi.fhir.org/baseR4"
-        
-        # Initialize spaCy if available
+    def __init__(self, batch_size: int = 64, n_process: int = 1,
+                 cache_size: int = 0, cache_ttl: float = 300.0, lazy_load: bool = False,
+                 spacy_pipeline: str = "full", spacy_exclude: Optional[List[str]] = None,
+                 spacy_disable: Optional[List[str]] = None, tiered: bool = False,
+                 sentiment_backend: Union[str, object] = "auto", timing_histograms: bool = False,
+                 base_url: str = "https://hapi.fhir.org/baseR4"):
+        self.base_url = base_url.rstrip("/")
+        
+        # Defaults for batched spaCy processing via nlp.pipe
+        self.batch_size = batch_size
+        self.n_process = n_process
+        
+        # Tiered mode runs the lexicon/regex rules first and only calls spaCy when it could
+        # change the outcome (see _needs_spacy)
+        self.tiered = tiered
+        
+        # Optional result cache for repeated queries (disabled when cache_size is 0)
+        self.result_cache = QueryResultCache(cache_size, cache_ttl) if cache_size > 0 else None
+        
+        # Optional per-stage timing histograms; when enabled every process_patient_query is timed
+        self.stage_histograms = StageHistograms() if timing_histograms else None
+        
+        # Sentiment backend: "auto" (TextBlob when installed, as before backends were pluggable,
+        # otherwise the lexicon), "lexicon" (built-in), "textblob", or any object with
+        # score/score_batch. The lexicon scorer serves requests until a TextBlob backend has been loaded.
+        if sentiment_backend == "auto":
+            sentiment_backend = "textblob" if TEXTBLOB_AVAILABLE else "lexicon"
+        self.sentiment_backend = sentiment_backend
+        self.sentiment_scorer = sentiment_backend if not isinstance(sentiment_backend, str) else LexiconSentimentScorer()
+        if sentiment_backend == "textblob" and not TEXTBLOB_AVAILABLE:
+            print("Warning: TextBlob not available for sentiment analysis, using the lexicon scorer. Install with: pip install textblob")
+        elif isinstance(sentiment_backend, str) and sentiment_backend not in ("lexicon", "textblob"):
+            raise ValueError(f"Unknown sentiment backend '{sentiment_backend}'. Choose from: auto, lexicon, textblob")
+        
+        # Initialize spaCy and TextBlob if available.
+        # In lazy mode they are loaded by a background warm-up thread; until it finishes
+        # self.nlp stays None and requests use the regex path.
+        if spacy_pipeline not in SPACY_PIPELINE_PRESETS:
+            raise ValueError(f"Unknown spaCy pipeline '{spacy_pipeline}'. Choose from: {', '.join(SPACY_PIPELINE_PRESETS)}")
+        self.spacy_model = "en_core_web_sm"
+        self.spacy_pipeline = spacy_pipeline
+        self.spacy_exclude = sorted(set(SPACY_PIPELINE_PRESETS[spacy_pipeline]) | set(spacy_exclude or []))
+        self.spacy_disable = list(spacy_disable or [])
         self.nlp = None
-        if SPACY_AVAILABLE:
-            try:
-                self.nlp = spacy.load("en_core_web_sm")
-                print("✅ spaCy NLP model loaded successfully")
-            except OSError:
-                print("⚠️  spaCy model not found. Install with: python -m spacy download en_core_web_sm")
+        self._model_ready = threading.Event()
+        if lazy_load:
+            self._warm_up_thread = threading.Thread(target=self._warm_up, name="nlp-warm-up", daemon=True)
+            self._warm_up_thread.start()
+        else:
+            self.nlp, textblob = self._load_nlp_models()
+            if textblob is not None:
+                self.sentiment_scorer = TextBlobSentimentScorer(textblob)
+            self._model_ready.set()
         
         # Define medical condition mappings with expanded coverage
         self.condition_codes = {
@@ -98,12 +548,90 @@ class FHIRQueryService:
             "follow-up": 2,
             "check-up": 1
         }
+        
+        # Single-pass matcher over all lexicons
+        self.rebuild_lexicon_matcher()
+    
+    def _load_nlp_models(self) -> Tuple[Optional[object], Optional[type]]:
+        """Import and load the spaCy model and, if selected, TextBlob. Returns (nlp, TextBlob class)."""
+        nlp = None
+        if SPACY_AVAILABLE:
+            try:
+                import spacy
+                nlp = spacy.load(self.spacy_model, exclude=self.spacy_exclude, disable=self.spacy_disable)
+                print(f"✅ spaCy NLP model loaded successfully (pipeline: {', '.join(nlp.pipe_names)})")
+            except OSError:
+                print(f"⚠️  spaCy model not found. Install with: python -m spacy download {self.spacy_model}")
+            except ImportError as e:
+                print(f"⚠️  spaCy could not be imported: {e}")
+        
+        textblob = None
+        if self.sentiment_backend == "textblob" and TEXTBLOB_AVAILABLE:
+            try:
+                from textblob import TextBlob
+                textblob = TextBlob
+            except ImportError as e:
+                print(f"⚠️  TextBlob could not be imported: {e}")
+        
+        return nlp, textblob
+    
+    def _warm_up(self):
+        """Background warm-up: load models, run one throwaway query through each, then publish them."""
+        try:
+            nlp, textblob = self._load_nlp_models()
+            if nlp is not None:
+                nlp("show me all diabetic patients over 50")
+            if textblob is not None:
+                scorer = TextBlobSentimentScorer(textblob)
+                scorer.score("warm up")
+                self.sentiment_scorer = scorer
+            self.nlp = nlp
+        except Exception as e:
+            print(f"⚠️  NLP warm-up failed, continuing with regex patterns: {e}")
+        finally:
+            self._model_ready.set()
+    
+    @property
+    def model_ready(self) -> bool:
+        """Whether model loading (eager or background warm-up) has finished."""
+        return self._model_ready.is_set()
+    
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until model loading has finished. Returns model_ready."""
+        return self._model_ready.wait(timeout)
+    
+    def rebuild_lexicon_matcher(self):
+        """
+        (Re)build the compiled lexicon matcher.
+        Call after modifying condition_codes, observation_codes, medication_categories or urgency_keywords.
+        """
+        self.lexicon_matcher = LexiconMatcher({
+            "conditions": self.condition_codes.keys(),
+            "observations": self.observation_codes.keys(),
+            "medications": self.medication_categories.keys(),
+            "urgency": self.urgency_keywords.keys()
+        })
+    
+    def normalize_query(self, query: Union[str, NormalizedQuery], doc=None) -> NormalizedQuery:
+        """
+        Normalize a query once per request: lower-case it and run the lexicon scan.
+        Already normalized queries are returned as-is.
+        """
+        if isinstance(query, NormalizedQuery):
+            if doc is not None and query.doc is None:
+                query.doc = doc
+            return query
+        
+        normalized = NormalizedQuery(query, doc)
+        normalized.lexicon_terms = self.lexicon_matcher.group_terms(self.lexicon_matcher.find_all(normalized.lower))
+        return normalized
     
-    def analyze_sentiment(self, query: str) -> Dict:
+    def analyze_sentiment(self, query: Union[str, NormalizedQuery]) -> Dict:
         """
         Analyze sentiment and urgency level of the query.
         Returns sentiment polarity, urgency score, and emotional indicators.
         """
+        query = self.normalize_query(query)
         sentiment_data = {
             "polarity": 0.0,
             "urgency_score": 1,
@@ -111,22 +639,17 @@ class FHIRQueryService:
             "priority_level": "routine"
         }
         
-        # Use TextBlob for sentiment analysis if available
-        if TEXTBLOB_AVAILABLE:
-            try:
-                blob = TextBlob(query)
-                sentiment_data["polarity"] = blob.sentiment.polarity
-            except:
-                pass
+        # Polarity from the configured sentiment backend (precomputed for batches)
+        if query.polarity is None:
+            query.polarity = self.sentiment_scorer.score(query.text)
+        sentiment_data["polarity"] = query.polarity
         
         # Analyze urgency based on keywords
-        query_lower = query.lower()
         max_urgency = 1
         
-        for keyword, urgency_level in self.urgency_keywords.items():
-            if keyword in query_lower:
-                sentiment_data["emotional_indicators"].append(keyword)
-                max_urgency = max(max_urgency, urgency_level)
+        for keyword in query.lexicon_terms.get("urgency", []):
+            sentiment_data["emotional_indicators"].append(keyword)
+            max_urgency = max(max_urgency, self.urgency_keywords[keyword])
         
         sentiment_data["urgency_score"] = max_urgency
         
@@ -142,11 +665,18 @@ class FHIRQueryService:
         
         return sentiment_data
 
-    def extract_entities_and_intent(self, query: str) -> Dict:
+    def extract_entities_and_intent(self, query: Union[str, NormalizedQuery], doc=None,
+                                    timer: Optional[StageTimer] = None) -> Dict:
         """
         Enhanced entity extraction and intent determination using advanced NLP.
         Includes sentiment analysis, confidence scoring, and comprehensive entity recognition.
+        An already parsed spaCy ``doc`` (e.g. from ``nlp.pipe``) can be passed to skip parsing.
+        Pass a StageTimer to record per-stage wall and CPU time.
         """
+        timer = timer or NULL_TIMER
+        with timer.stage("normalize"):
+            query = self.normalize_query(query, doc)
+        
         entities = {
             "conditions": [],
             "ages": [],
@@ -162,159 +692,168 @@ class FHIRQueryService:
             "severity_indicators": []
         }
         
-        # Use spaCy for advanced entity extraction if available
-        if self.nlp:
-            doc = self.nlp(query.lower())
-            
-            # Extract named entities
-            for ent in doc.ents:
-                if ent.label_ == "PERSON":
-                    entities["names"].append(ent.text.title())
-                elif ent.label_ == "DATE":
-                    entities["time_periods"].append(ent.text)
-                elif ent.label_ == "CARDINAL":
-                    if ent.text.isdigit():
-                        entities["numbers"].append(int(ent.text))
-                elif ent.label_ in ["ORG", "GPE"]:  # Organizations or locations
-                    entities["body_parts"].append(ent.text)
-            
-            # Extract symptoms and body parts using dependency parsing
-            for token in doc:
-                # Look for symptoms (nouns that might indicate medical issues)
-                if token.pos_ == "NOUN" and token.dep_ in ["dobj", "nsubj"]:
-                    if any(symptom_word in token.text for symptom_word in ["pain", "ache", "swelling", "rash", "fever"]):
-                        entities["symptoms"].append(token.text)
-                
-                # Extract body parts
-                if token.text in ["head", "chest", "back", "leg", "arm", "stomach", "heart", "lung", "kidney", "liver"]:
-                    entities["body_parts"].append(token.text)
-        
-        # Extract medical conditions with enhanced pattern matching
-        for condition in self.condition_codes.keys():
-            if condition.lower() in query.lower():
-                entities["conditions"].append(condition)
-        
-        # Extract observation types
-        for obs_type in self.observation_codes.keys():
-            if obs_type.lower() in query.lower():
-                entities["observations"].append(obs_type)
-        
-        # Extract medications
-        for medication in self.medication_categories.keys():
-            if medication.lower() in query.lower():
-                entities["medications"].append(medication)
-        
-        # Enhanced symptom extraction
-        symptom_patterns = [
-            r'\b(pain|ache|hurt|sore|tender)\b',
-            r'\b(fever|temperature|hot|cold)\b',
-            r'\b(nausea|dizzy|tired|fatigue)\b',
-            r'\b(cough|sneeze|runny nose)\b',
-            r'\b(headache|migraine|head pain)\b',
-            r'\b(shortness of breath|difficulty breathing)\b'
-        ]
-        
-        for pattern in symptom_patterns:
-            matches = re.findall(pattern, query.lower())
-            entities["symptoms"].extend(matches)
-        
-        # Extract severity indicators
-        severity_patterns = [
-            r'\b(severe|mild|moderate|chronic|acute)\b',
-            r'\b(intense|sharp|dull|throbbing)\b',
-            r'\b(persistent|occasional|frequent)\b'
-        ]
-        
-        for pattern in severity_patterns:
-            matches = re.findall(pattern, query.lower())
-            entities["severity_indicators"].extend(matches)
-        
-        # Extract age information using regex
-        age_patterns = [
-            r'over\s+(\d+)',
-            r'above\s+(\d+)',
-            r'(\d+)\s+years?\s*old',
-            r'age\s+(\d+)',
-            r'aged\s+(\d+)'
-        ]
-        
-        for pattern in age_patterns:
-            matches = re.findall(pattern, query.lower())
-            entities["ages"].extend([int(match) for match in matches])
+        # Regex entity matches are computed once and shared with the tier check below
+        with timer.stage("regex"):
+            pattern_matches = query.pattern_matches
         
-        # Extract gender
-        if re.search(r'\bmale\b', query.lower()) and not re.search(r'\bfemale\b', query.lower()):
-            entities["genders"].append("male")
-        elif re.search(r'\bfemale\b', query.lower()):
-            entities["genders"].append("female")
+        # Use spaCy for advanced entity extraction if available (and, in tiered mode, useful)
+        use_spacy = self._uses_spacy(query)
+        if use_spacy and query.doc is None:
+            with timer.stage("spacy"):
+                query.doc = self.nlp(query.lower)
         
-        # Extract patient IDs
-        patient_id_matches = re.findall(r'patient\s+([a-zA-Z0-9-]+)', query.lower())
-        entities["patient_ids"].extend(patient_id_matches)
-        
-        # Extract names using regex if spaCy didn't find any
-        if not entities["names"]:
-            name_match = re.search(r'named?\s+([a-zA-Z\s]+)', query, re.IGNORECASE)
-            if name_match:
-                entities["names"].append(name_match.group(1).strip().title())
+        with timer.stage("entities"):
+            if use_spacy:
+                doc = query.doc
+                
+                # Extract named entities
+                for ent in doc.ents:
+                    if ent.label_ == "PERSON":
+                        entities["names"].append(ent.text.title())
+                    elif ent.label_ == "DATE":
+                        entities["time_periods"].append(ent.text)
+                    elif ent.label_ == "CARDINAL":
+                        if ent.text.isdigit():
+                            entities["numbers"].append(int(ent.text))
+                    elif ent.label_ in ["ORG", "GPE"]:  # Organizations or locations
+                        entities["body_parts"].append(ent.text)
+                
+                # Extract symptoms and body parts using dependency parsing.
+                # Without a parser in the pipeline, fall back to a POS-only rule.
+                use_dependencies = doc.has_annotation("DEP")
+                for token in doc:
+                    # Look for symptoms (nouns that might indicate medical issues)
+                    if token.pos_ == "NOUN" and (not use_dependencies or token.dep_ in ["dobj", "nsubj"]):
+                        if any(symptom_word in token.text for symptom_word in ["pain", "ache", "swelling", "rash", "fever"]):
+                            entities["symptoms"].append(token.text)
+                
+                    # Extract body parts
+                    if token.text in BODY_PART_TERMS:
+                        entities["body_parts"].append(token.text)
+            elif self.tiered:
+                # Rules tier: body parts come straight from the token spans
+                for start, end in query.token_spans:
+                    if query.lower[start:end] in BODY_PART_TERMS:
+                        entities["body_parts"].append(query.lower[start:end])
+            
+            # Extract conditions, observation types and medications in one lexicon pass
+            lexicon_terms = query.lexicon_terms
+            entities["conditions"].extend(lexicon_terms.get("conditions", []))
+            entities["observations"].extend(lexicon_terms.get("observations", []))
+            entities["medications"].extend(lexicon_terms.get("medications", []))
+            
+            # Symptoms, severity, ages, gender, patient IDs and names in one regex pass
+            entities["symptoms"].extend(pattern_matches.get("symptoms", []))
+            entities["severity_indicators"].extend(pattern_matches.get("severity_indicators", []))
+            entities["ages"].extend(int(age) for age in pattern_matches.get("ages", []))
+            
+            # Extract gender
+            genders = pattern_matches.get("genders", [])
+            if "female" in genders:
+                entities["genders"].append("female")
+            elif "male" in genders:
+                entities["genders"].append("male")
+            
+            # Extract patient IDs
+            entities["patient_ids"].extend(pattern_matches.get("patient_ids", []))
+            
+            # Extract names using regex if spaCy didn't find any
+            if not entities["names"] and pattern_matches.get("names"):
+                entities["names"].append(pattern_matches["names"][0].strip().title())
         
         # Determine intent with enhanced classification
-        intent = self._determine_intent_advanced(query)
+        with timer.stage("intent"):
+            intent = self._determine_intent_advanced(query)
         
         # Get sentiment analysis
-        sentiment = self.analyze_sentiment(query)
-        
-        return {
-            "intent": intent,
-            "entities": entities,
-            "sentiment": sentiment,
-            "confidence": self._calculate_confidence_advanced(intent, entities, sentiment),
-            "nlp_method": "spaCy Enhanced" if self.nlp else "regex",
-            "query_complexity": self._assess_query_complexity(entities),
-            "medical_specialty": self._identify_medical_specialty(entities)
-        }
+        with timer.stage("sentiment"):
+            sentiment = self.analyze_sentiment(query)
+        
+        with timer.stage("scoring"):
+            return {
+                "intent": intent,
+                "entities": entities,
+                "sentiment": sentiment,
+                "confidence": self._calculate_confidence_advanced(intent, entities, sentiment),
+                "nlp_method": "spaCy Enhanced" if use_spacy else "regex",
+                "nlp_tier": "spacy" if use_spacy else "rules",
+                "query_complexity": self._assess_query_complexity(entities),
+                "medical_specialty": self._identify_medical_specialty(entities)
+            }
+    
+    def _uses_spacy(self, query: NormalizedQuery) -> bool:
+        """Whether entity extraction for a query goes through spaCy (always, unless tiered)."""
+        return self.nlp is not None and (not self.tiered or query.doc is not None or self._needs_spacy(query))
+    
+    def result_cache_key(self, query: NormalizedQuery) -> str:
+        """
+        Result cache key of a query: its case-insensitive text, plus the tier that answers it in
+        tiered mode, where "show Smith's labs" goes to spaCy and "show smith's labs" does not.
+        """
+        if self.tiered:
+            return f"{query.cache_key}\x00{'spacy' if self._uses_spacy(query) else 'rules'}"
+        return query.cache_key
+    
+    def _needs_spacy(self, query: NormalizedQuery) -> bool:
+        """
+        Decide whether spaCy could change the outcome of a query in tiered mode.
+        True when the query may hold DATE, PERSON, CARDINAL, ORG or GPE entities, or symptom
+        words the regexes missed.
+        """
+        if DATE_CUE_PATTERN.search(query.lower) or PERSON_CUE_PATTERN.search(query.lower):
+            return True
+        if NUMBER_CUE_PATTERN.search(query.lower):
+            return True
+        if CAPITALIZED_WORD_PATTERN.search(query.text):
+            return True
+        
+        regex_symptoms = query.pattern_matches.get("symptoms", [])
+        return any(match.group() not in regex_symptoms for match in SYMPTOM_STEM_PATTERN.finditer(query.lower))
     
-    def _determine_intent_advanced(self, query: str) -> str:
+    def _determine_intent_advanced(self, query: Union[str, NormalizedQuery]) -> str:
         """Enhanced intent determination with better accuracy."""
-        query_lower = query.lower()
+        query = self.normalize_query(query)
+        query_lower = query.lower
+        has_conditions = bool(query.lexicon_terms.get("conditions"))
+        has_observations = bool(query.lexicon_terms.get("observations"))
         
         # Emergency/urgent intents
-        if any(word in query_lower for word in ["emergency", "urgent", "critical", "severe pain", "difficulty breathing"]):
+        if query.contains_any(["emergency", "urgent", "critical", "severe pain", "difficulty breathing"]):
             return "emergency_query"
         
         # Symptom reporting intents
-        if any(word in query_lower for word in ["feel", "experiencing", "having", "suffering"]) and \
-           any(word in query_lower for word in ["pain", "ache", "symptom", "problem"]):
+        if query.contains_any(["feel", "experiencing", "having", "suffering"]) and \
+           query.contains_any(["pain", "ache", "symptom", "problem"]):
             return "symptom_reporting"
         
         # Medication intents
-        if any(word in query_lower for word in ["medication", "prescription", "drug", "pill", "dosage"]):
-            if any(word in query_lower for word in ["find", "show", "get", "list"]):
+        if query.contains_any(["medication", "prescription", "drug", "pill", "dosage"]):
+            if query.contains_any(["find", "show", "get", "list"]):
                 return "find_medications"
             else:
                 return "medication_inquiry"
         
         # Check for specific resource types and action words
-        if any(word in query_lower for word in ["find", "show", "get", "list", "search"]):
+        if query.contains_any(["find", "show", "get", "list", "search"]):
             if "patient" in query_lower:
                 return "find_patients"
-            elif any(word in query_lower for word in ["condition", "diagnosis", "disease"]) or any(cond in query_lower for cond in self.condition_codes.keys()):
+            elif query.contains_any(["condition", "diagnosis", "disease"]) or has_conditions:
                 return "find_conditions"
-            elif any(word in query_lower for word in ["observation", "vital", "measurement", "test", "result"]) or any(obs in query_lower for obs in self.observation_codes.keys()):
+            elif query.contains_any(["observation", "vital", "measurement", "test", "result"]) or has_observations:
                 return "find_observations"
             elif "appointment" in query_lower:
                 return "find_appointments"
         
         # Appointment scheduling intents
-        if any(word in query_lower for word in ["schedule", "book", "appointment", "visit"]):
+        if query.contains_any(["schedule", "book", "appointment", "visit"]):
             return "schedule_appointment"
         
         # General health information
-        if any(word in query_lower for word in ["what is", "tell me about", "explain", "information"]):
+        if query.contains_any(["what is", "tell me about", "explain", "information"]):
             return "health_information"
         
         # Check for implicit patient queries (e.g., "diabetic patients")
-        if any(cond in query_lower for cond in self.condition_codes.keys()) and "patient" in query_lower:
+        if has_conditions and "patient" in query_lower:
             return "find_patients"
         
         return "general_inquiry"
@@ -439,30 +978,116 @@ class FHIRQueryService:
                 score += entity_bonus[entity_type]
         
         return min(score, 1.0)
-    def process_patient_query(self, query: str) -> Dict:
+    def process_patient_query(self, query: Union[str, NormalizedQuery], doc=None, timings: bool = False) -> Dict:
         """
         Comprehensive patient query processing with advanced NLP analysis.
         Returns structured output with detailed medical understanding.
+        With ``timings=True`` the per-stage wall and CPU times are returned under
+        ``nlp_analysis["timings"]``.
         """
-        # Get comprehensive NLP analysis
-        nlp_analysis = self.extract_entities_and_intent(query)
-        
-        # Generate FHIR query
-        fhir_query = self._convert_nlp_to_fhir(query, nlp_analysis)
+        timer = StageTimer() if timings or self.stage_histograms else None
+        stage = (timer or NULL_TIMER).stage
+        
+        # Normalize once and share across all stages
+        with stage("normalize"):
+            query = self.normalize_query(query, doc)
+        
+        # Time-independent analysis can be served from the result cache
+        with stage("cache_lookup"):
+            cache_key = self.result_cache_key(query) if self.result_cache else None
+            analysis = self.result_cache.get(cache_key) if self.result_cache else None
+        cached = analysis is not None
+        if analysis is None:
+            # Read readiness before extracting: warm-up publishes the models before setting the
+            # event, so a result started while it was unset may come from the regex fallback
+            models_loaded = self.model_ready
+            
+            # Get comprehensive NLP analysis
+            nlp_analysis = self.extract_entities_and_intent(query, timer=timer)
+            with stage("clinical_interpretation"):
+                clinical_interpretation = self._generate_clinical_interpretation(nlp_analysis)
+            with stage("recommendations"):
+                recommendations = self._generate_recommendations(nlp_analysis)
+            with stage("data_requirements"):
+                data_requirements = self._identify_data_requirements(nlp_analysis)
+            analysis = {
+                "nlp_analysis": nlp_analysis,
+                "clinical_interpretation": clinical_interpretation,
+                "recommendations": recommendations,
+                "data_requirements": data_requirements
+            }
+            # Do not cache regex-only results produced while the models are still warming up
+            if self.result_cache and models_loaded:
+                with stage("cache_store"):
+                    self.result_cache.put(cache_key, analysis)
+        
+        # Generate FHIR query; always rebuilt since date bounds are relative to now
+        with stage("fhir_build"):
+            fhir_query = self._convert_nlp_to_fhir(query, analysis["nlp_analysis"])
         
         # Create comprehensive response
         response = {
-            "original_query": query,
+            "original_query": query.text,
             "processed_timestamp": datetime.now().isoformat(),
-            "nlp_analysis": nlp_analysis,
+            "nlp_analysis": analysis["nlp_analysis"],
             "fhir_query": fhir_query,
-            "clinical_interpretation": self._generate_clinical_interpretation(nlp_analysis),
-            "recommendations": self._generate_recommendations(nlp_analysis),
-            "data_requirements": self._identify_data_requirements(nlp_analysis)
+            "formatted_url": self.formatted_url(fhir_query),
+            "clinical_interpretation": analysis["clinical_interpretation"],
+            "recommendations": analysis["recommendations"],
+            "data_requirements": analysis["data_requirements"]
         }
         
+        if timer:
+            if self.stage_histograms:
+                self.stage_histograms.observe(timer)
+            if timings:
+                # Added after caching, so cached analyses never carry a request's timings
+                response["nlp_analysis"]["timings"] = dict(timer.report(), cached=cached)
+        
         return response
     
+    def cache_stats(self) -> Dict:
+        """Return result cache statistics."""
+        if not self.result_cache:
+            return {"enabled": False}
+        return self.result_cache.stats()
+    
+    def timing_stats(self) -> Dict:
+        """Return the aggregated per-stage timing histograms."""
+        if not self.stage_histograms:
+            return {"enabled": False}
+        return {"enabled": True, "stages": self.stage_histograms.stats()}
+    
+    def process_patient_queries(self, queries: List[str], batch_size: Optional[int] = None,
+                                n_process: Optional[int] = None) -> List[Dict]:
+        """
+        Process a batch of patient queries.
+        All texts go through spaCy in one ``nlp.pipe`` call; results are returned in input order.
+        """
+        batch_size = batch_size or self.batch_size
+        n_process = n_process or self.n_process
+        normalized_queries = [self.normalize_query(query) for query in queries]
+        
+        if self.nlp:
+            # Only parse queries that will not be answered from the result cache or the rules tier
+            to_parse = [query for query in normalized_queries
+                        if query.doc is None
+                        and not (self.result_cache and self.result_cache_key(query) in self.result_cache)
+                        and (not self.tiered or self._needs_spacy(query))]
+            docs = self.nlp.pipe((query.lower for query in to_parse),
+                                 batch_size=batch_size, n_process=n_process)
+            for query, doc in zip(to_parse, docs):
+                query.doc = doc
+        
+        # Score sentiment for the whole batch in one call
+        to_score = [query for query in normalized_queries
+                    if query.polarity is None
+                    and not (self.result_cache and self.result_cache_key(query) in self.result_cache)]
+        for query, polarity in zip(to_score, self.sentiment_scorer.score_batch([query.text for query in to_score])):
+            query.polarity = polarity
+        
+        return [self.process_patient_query(query) for query in normalized_queries]
+    
     def _generate_clinical_interpretation(self, nlp_analysis: Dict) -> Dict:
         """Generate clinical interpretation of the query."""
         entities = nlp_analysis["entities"]
@@ -616,14 +1241,52 @@ class FHIRQueryService:
         Parse natural language query and convert to FHIR API request.
         Uses NLP analysis for enhanced processing.
         """
+        query = self.normalize_query(query)
+        
         # First, get NLP analysis
         nlp_analysis = self.extract_entities_and_intent(query)
         
         # Convert based on intent and entities
         return self._convert_nlp_to_fhir(query, nlp_analysis)
     
-    def _convert_nlp_to_fhir(self, query: str, nlp_analysis: Dict) -> Dict:
+    def build_query_plan(self, query: Union[str, NormalizedQuery], nlp_analysis: Optional[Dict] = None) -> List[Dict]:
+        """
+        Build one FHIR search per resource type the query's entities refer to, e.g. Patient,
+        Condition and Observation for "diabetic patients over 50 with recent glucose observations".
+        The searches are independent, so they can run concurrently and be joined by patient.
+        Falls back to the single query from _convert_nlp_to_fhir when no entity applies.
+        """
+        query = self.normalize_query(query)
+        if nlp_analysis is None:
+            nlp_analysis = self.extract_entities_and_intent(query)
+        intent = nlp_analysis["intent"]
+        entities = nlp_analysis["entities"]
+        
+        plan = []
+        if entities["conditions"]:
+            plan.append(self._build_condition_query_from_nlp(entities, query))
+        if entities["observations"]:
+            plan.append(self._build_observation_query_from_nlp(entities, query))
+        if entities["medications"] or intent in ["find_medications", "medication_inquiry"]:
+            plan.append(self._build_medication_query_from_nlp(entities, query))
+        if intent in ["find_appointments", "schedule_appointment"]:
+            plan.append(self._build_appointment_query_from_nlp(entities, query))
+        
+        # The Patient search goes first; an unfiltered one is only worth sending on its own
+        if intent == "find_patients" or entities["names"] or entities["genders"] or entities["ages"]:
+            patient_query = self._build_patient_query_from_nlp(entities, query)
+            if entities["patient_ids"]:
+                patient_query["parameters"]["_id"] = entities["patient_ids"][0]
+            if patient_query["parameters"] or not plan:
+                plan.insert(0, patient_query)
+        
+        if not plan:
+            plan.append(self._convert_nlp_to_fhir(query, nlp_analysis))
+        return plan
+    
+    def _convert_nlp_to_fhir(self, query: Union[str, NormalizedQuery], nlp_analysis: Dict) -> Dict:
         """Convert NLP analysis to FHIR query."""
+        query = self.normalize_query(query)
         intent = nlp_analysis["intent"]
         entities = nlp_analysis["entities"]
         
@@ -639,7 +1302,7 @@ class FHIRQueryService:
             return self._build_appointment_query_from_nlp(entities, query)
         else:
             # Fallback to original parsing
-            query_lower = query.lower().strip()
+            query_lower = query.lower.strip()
             
             # Patient queries
             if "patient" in query_lower:
@@ -661,7 +1324,7 @@ class FHIRQueryService:
                     "error": "Unable to parse query. Supported resources: Patient, Observation, Condition, Medication, Appointment"
                 }
     
-    def _build_patient_query_from_nlp(self, entities: Dict, query: str) -> Dict:
+    def _build_patient_query_from_nlp(self, entities: Dict, query: NormalizedQuery) -> Dict:
         """Build patient query from NLP-extracted entities."""
         fhir_query = {
             "resource_type": "Patient",
@@ -680,7 +1343,7 @@ class FHIRQueryService:
             age = entities["ages"][0]
             birth_year = self._calculate_birth_year(age)
             # Handle "over X" queries
-            if "over" in query.lower() or "above" in query.lower():
+            if "over" in query.lower or "above" in query.lower:
                 fhir_query["parameters"]["birthdate"] = f"le{birth_year}"
             else:
                 fhir_query["parameters"]["birthdate"] = f"ap{birth_year}"
@@ -694,7 +1357,7 @@ class FHIRQueryService:
         
         return fhir_query
     
-    def _build_condition_query_from_nlp(self, entities: Dict, query: str) -> Dict:
+    def _build_condition_query_from_nlp(self, entities: Dict, query: NormalizedQuery) -> Dict:
         """Build condition query from NLP-extracted entities."""
         fhir_query = {
             "resource_type": "Condition",
@@ -712,14 +1375,14 @@ class FHIRQueryService:
                 fhir_query["parameters"]["code"] = self.condition_codes[condition]["code"]
         
         # Extract clinical status
-        if "active" in query.lower():
+        if "active" in query.lower:
             fhir_query["parameters"]["clinical-status"] = "active"
-        elif "resolved" in query.lower():
+        elif "resolved" in query.lower:
             fhir_query["parameters"]["clinical-status"] = "resolved"
         
         return fhir_query
     
-    def _build_observation_query_from_nlp(self, entities: Dict, query: str) -> Dict:
+    def _build_observation_query_from_nlp(self, entities: Dict, query: NormalizedQuery) -> Dict:
         """Build observation query from NLP-extracted entities."""
         fhir_query = {
             "resource_type": "Observation",
@@ -737,8 +1400,8 @@ class FHIRQueryService:
                 fhir_query["parameters"]["code"] = self.observation_codes[obs_type]["code"]
         
         # Extract date range
-        if "last" in query.lower():
-            days_match = re.search(r'last\s+(\d+)\s+days?', query.lower())
+        if "last" in query.lower:
+            days_match = REGEX_PATTERNS["last_days"].search(query.lower)
             if days_match:
                 days = int(days_match.group(1))
                 date_from = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
@@ -746,7 +1409,7 @@ class FHIRQueryService:
         
         return fhir_query
     
-    def _build_medication_query_from_nlp(self, entities: Dict, query: str) -> Dict:
+    def _build_medication_query_from_nlp(self, entities: Dict, query: NormalizedQuery) -> Dict:
         """Build medication query from NLP-extracted entities."""
         fhir_query = {
             "resource_type": "MedicationRequest",
@@ -759,12 +1422,12 @@ class FHIRQueryService:
             fhir_query["parameters"]["subject"] = f"Patient/{entities['patient_ids'][0]}"
         
         # Extract status
-        if "active" in query.lower():
+        if "active" in query.lower:
             fhir_query["parameters"]["status"] = "active"
         
         return fhir_query
     
-    def _build_appointment_query_from_nlp(self, entities: Dict, query: str) -> Dict:
+    def _build_appointment_query_from_nlp(self, entities: Dict, query: NormalizedQuery) -> Dict:
         """Build appointment query from NLP-extracted entities."""
         fhir_query = {
             "resource_type": "Appointment",
@@ -777,15 +1440,15 @@ class FHIRQueryService:
             fhir_query["parameters"]["actor"] = f"Patient/{entities['patient_ids'][0]}"
         
         # Extract date range
-        if "today" in query.lower():
+        if "today" in query.lower:
             today = datetime.now().strftime('%Y-%m-%d')
-            fhir_query["parameters"]["date"] = f"ge{today}&date=lt{today}T23:59:59"
-        elif "next week" in query.lower():
+            fhir_query["parameters"]["date"] = [f"ge{today}", f"lt{today}T23:59:59"]
+        elif "next week" in query.lower:
             next_week = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
             fhir_query["parameters"]["date"] = f"ge{next_week}"
         
         # Extract status
-        if "scheduled" in query.lower():
+        if "scheduled" in query.lower:
             fhir_query["parameters"]["status"] = "booked"
         
         return fhir_query
@@ -794,7 +1457,7 @@ class FHIRQueryService:
         """Parse patient-related queries."""
         
         # Extract name if present
-        name_match = re.search(r'named?\s+([a-zA-Z\s]+)', query)
+        name_match = REGEX_PATTERNS["name"].search(query)
         name = name_match.group(1).strip() if name_match else None
         
         # Extract gender
@@ -805,7 +1468,7 @@ class FHIRQueryService:
             gender = "female"
         
         # Extract age range
-        age_match = re.search(r'(\d+)\s*(?:to|-)?\s*(\d+)?\s*years?\s*old', query)
+        age_match = REGEX_PATTERNS["age_range"].search(query)
         
         # Build FHIR query
         fhir_query = {
@@ -821,7 +1484,8 @@ class FHIRQueryService:
             fhir_query["parameters"]["gender"] = gender
         if age_match:
             if age_match.group(2):  # Age range
-                fhir_query["parameters"]["birthdate"] = f"ge{self._calculate_birth_year(int(age_match.group(2)))}&birthdate=le{self._calculate_birth_year(int(age_match.group(1)))}"
+                fhir_query["parameters"]["birthdate"] = [f"ge{self._calculate_birth_year(int(age_match.group(2)))}",
+                                                         f"le{self._calculate_birth_year(int(age_match.group(1)))}"]
             else:  # Single age
                 birth_year = self._calculate_birth_year(int(age_match.group(1)))
                 fhir_query["parameters"]["birthdate"] = f"ap{birth_year}"
@@ -839,7 +1503,7 @@ class FHIRQueryService:
         }
         
         # Extract patient reference
-        patient_match = re.search(r'patient\s+([a-zA-Z0-9-]+)', query)
+        patient_match = REGEX_PATTERNS["patient_id"].search(query)
         if patient_match:
             fhir_query["parameters"]["subject"] = f"Patient/{patient_match.group(1)}"
         
@@ -855,7 +1519,7 @@ class FHIRQueryService:
         
         # Extract date range
         if "last" in query:
-            days_match = re.search(r'last\s+(\d+)\s+days?', query)
+            days_match = REGEX_PATTERNS["last_days"].search(query)
             if days_match:
                 days = int(days_match.group(1))
                 date_from = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
@@ -874,7 +1538,7 @@ class FHIRQueryService:
         }
         
         # Extract patient reference
-        patient_match = re.search(r'patient\s+([a-zA-Z0-9-]+)', query)
+        patient_match = REGEX_PATTERNS["patient_id"].search(query)
         if patient_match:
             fhir_query["parameters"]["subject"] = f"Patient/{patient_match.group(1)}"
         
@@ -905,12 +1569,12 @@ class FHIRQueryService:
         }
         
         # Extract patient reference
-        patient_match = re.search(r'patient\s+([a-zA-Z0-9-]+)', query)
+        patient_match = REGEX_PATTERNS["patient_id"].search(query)
         if patient_match:
             fhir_query["parameters"]["subject"] = f"Patient/{patient_match.group(1)}"
         
         # Extract medication name
-        med_match = re.search(r'(?:medication|drug)\s+([a-zA-Z]+)', query)
+        med_match = REGEX_PATTERNS["medication_name"].search(query)
         if med_match:
             fhir_query["parameters"]["code"] = med_match.group(1)
         
@@ -931,14 +1595,14 @@ class FHIRQueryService:
         }
         
         # Extract patient reference
-        patient_match = re.search(r'patient\s+([a-zA-Z0-9-]+)', query)
+        patient_match = REGEX_PATTERNS["patient_id"].search(query)
         if patient_match:
             fhir_query["parameters"]["actor"] = f"Patient/{patient_match.group(1)}"
         
         # Extract date range
         if "today" in query:
             today = datetime.now().strftime('%Y-%m-%d')
-            fhir_query["parameters"]["date"] = f"ge{today}&date=lt{today}T23:59:59"
+            fhir_query["parameters"]["date"] = [f"ge{today}", f"lt{today}T23:59:59"]
         elif "next week" in query:
             next_week = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
             fhir_query["parameters"]["date"] = f"ge{next_week}"
@@ -953,26 +1617,25 @@ class FHIRQueryService:
         """Calculate birth year from age."""
         return str(datetime.now().year - age)
     
+    def formatted_url(self, fhir_query: Dict) -> str:
+        """Canonical, encoded URL of a FHIR query ('' for error queries)."""
+        if "resource_type" not in fhir_query:
+            return ""
+        return FHIRRequest.from_query(fhir_query).url
+    
     def format_fhir_request(self, parsed_query: Dict) -> str:
         """Format the parsed query into a readable FHIR API request."""
         
         if "error" in parsed_query:
             return f"Error: {parsed_query['error']}"
         
-        url = parsed_query["url"]
-        params = parsed_query.get("parameters", {})
-        
-        if params:
-            param_string = "&".join([f"{k}={v}" for k, v in params.items()])
-            full_url = f"{url}?{param_string}"
-        else:
-            full_url = url
+        request = FHIRRequest.from_query(parsed_query)
         
         return f"""
 FHIR API Request:
-Method: {parsed_query['method']}
-Resource: {parsed_query['resource_type']}
-URL: {full_url}
+Method: {request.method}
+Resource: {request.resource_type}
+URL: {request.url}
 """
 
 def demonstrate_enhanced_fhir_service():
@@ -0,0 +1,100 @@
+"""
+Canonical FHIR search requests.
+Builds the URL for a query dict produced by FHIRQueryService: parameters may repeat
+(a list value sends the parameter once per item, e.g. a date range), are sorted into a
+deterministic order and are percent-encoded exactly once. The resulting URL is both
+ready to send and a stable key for caching and de-duplicating upstream calls.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl, quote, urlsplit, urlunsplit
+
+# Left unencoded in names and values: FHIR uses ':' in modifiers and chains
+# (_has:Condition:patient:code), '/' in references and ',' to separate alternatives
+SAFE_CHARS = ":/,"
+
+Parameters = Union[Dict[str, Union[str, int, float, List, Tuple]], Iterable[Tuple[str, str]]]
+
+
+def canonical_params(parameters: Optional[Parameters]) -> List[Tuple[str, str]]:
+    """
+    Flatten parameters into sorted (name, value) pairs. Dict values that are lists or
+    tuples become one pair per item; pairs with the same name are sorted by value, which
+    is safe since repeated FHIR search parameters are combined with AND.
+    """
+    if not parameters:
+        return []
+    items = parameters.items() if isinstance(parameters, dict) else parameters
+    pairs = []
+    for name, value in items:
+        values = value if isinstance(value, (list, tuple)) else [value]
+        pairs.extend((str(name), str(item)) for item in values)
+    return sorted(pairs)
+
+
+def encode_params(pairs: Iterable[Tuple[str, str]]) -> str:
+    """Percent-encode (name, value) pairs into a query string, in the given order."""
+    return "&".join(f"{quote(name, safe=SAFE_CHARS)}={quote(value, safe=SAFE_CHARS)}"
+                    for name, value in pairs)
+
+
+def canonical_url(url: str, parameters: Optional[Parameters] = None) -> str:
+    """
+    Canonical form of a GET URL: parameters already in the URL (e.g. a Bundle's next link)
+    are decoded and merged with ``parameters``, then sorted and encoded once. Two URLs
+    requesting the same search therefore map to the same string.
+    """
+    parts = urlsplit(url)
+    pairs = parse_qsl(parts.query, keep_blank_values=True) + canonical_params(parameters)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, encode_params(sorted(pairs)), ""))
+
+
+class FHIRRequest:
+    """A FHIR search: method, resource type, base URL and canonical parameters."""
+
+    def __init__(self, base_url: str, resource_type: str, parameters: Optional[Parameters] = None,
+                 method: str = "GET"):
+        self.base_url = base_url.rstrip("/")
+        self.resource_type = resource_type
+        self.method = method
+        self.params = canonical_params(parameters)
+
+    @classmethod
+    def from_query(cls, fhir_query: Dict, base_url: Optional[str] = None) -> "FHIRRequest":
+        """
+        Build the request for a query dict from FHIRQueryService. ``base_url`` overrides the
+        server the query was built for. Raises ValueError for error queries.
+        """
+        if "resource_type" not in fhir_query:
+            raise ValueError(fhir_query.get("error", "Query has no FHIR resource type"))
+        if base_url is None:
+            base_url = fhir_query["url"].rsplit("/", 1)[0]
+        return cls(base_url, fhir_query["resource_type"], fhir_query.get("parameters"),
+                   fhir_query.get("method", "GET"))
+
+    def with_params(self, **extra) -> "FHIRRequest":
+        """A copy with extra parameters (e.g. _count) added."""
+        request = FHIRRequest(self.base_url, self.resource_type, None, self.method)
+        request.params = sorted(self.params + canonical_params(extra))
+        return request
+
+    @property
+    def query_string(self) -> str:
+        return encode_params(self.params)
+
+    @property
+    def url(self) -> str:
+        """Ready-to-send URL, also usable as a cache key."""
+        base = f"{self.base_url}/{self.resource_type}"
+        return f"{base}?{self.query_string}" if self.params else base
+
+    key = url
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FHIRRequest) and (self.method, self.url) == (other.method, other.url)
+
+    def __hash__(self) -> int:
+        return hash((self.method, self.url))
+
+    def __repr__(self) -> str:
+        return f"FHIRRequest({self.method} {self.url})"
@@ -0,0 +1,116 @@
+"""
+Sentiment backends for the FHIR Query Service.
+Scores query polarity in [-1.0, 1.0]. The built-in lexicon scorer needs no extra packages;
+TextBlob is available as an optional backend.
+"""
+
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+# Polarity lexicon, loaded into a dict once at import, on TextBlob's scale (-1.0 very negative
+# to 1.0 very positive). General words take the value of TextBlob's pattern lexicon, and
+# neutral (0.0) entries still count towards the average, as they do in TextBlob. Words TextBlob
+# lacks (scared, worried, urgent, ...) and clinical terms whose everyday sense misleads
+# (acute, critical, intense) are set by hand. No value is fitted to a query corpus.
+SENTIMENT_LEXICON: Dict[str, float] = {
+    # Positive
+    "excellent": 1.0, "best": 1.0, "great": 0.8, "happy": 0.8, "successful": 0.75,
+    "good": 0.7, "nice": 0.6, "better": 0.5, "glad": 0.5, "healthy": 0.5, "safe": 0.5,
+    "strong": 0.4333, "fine": 0.4167, "comfortable": 0.4, "helpful": 0.4, "improved": 0.4,
+    "improving": 0.4, "full": 0.35, "mild": 0.3333, "quick": 0.3333, "well": 0.3,
+    "relieved": 0.3, "recovered": 0.3, "positive": 0.2273, "stable": 0.2, "thanks": 0.2,
+    "thank": 0.2, "high": 0.16, "normal": 0.15, "new": 0.1364, "please": 0.1, "clear": 0.1,
+    "complete": 0.1, "frequent": 0.1, "old": 0.1, "young": 0.1,
+    # Neutral
+    "low": 0.0, "medical": 0.0, "moderate": 0.0, "occasional": 0.0, "recent": 0.0, "regular": 0.0,
+    # Negative
+    "acute": -0.1, "chronic": -0.1, "elevated": -0.1, "intense": -0.1, "persistent": -0.1,
+    "urgent": -0.1, "sharp": -0.125, "active": -0.1333, "critical": -0.2, "emergency": -0.2,
+    "lost": -0.2, "problem": -0.2, "problems": -0.2, "trouble": -0.2, "anxious": -0.25,
+    "dull": -0.2917, "hard": -0.2917, "abnormal": -0.3, "dizzy": -0.3, "negative": -0.3,
+    "slow": -0.3, "unstable": -0.3, "serious": -0.3333, "weak": -0.375, "exhausted": -0.4,
+    "poor": -0.4, "severe": -0.4, "tired": -0.4, "unhealthy": -0.4, "worried": -0.4,
+    "worse": -0.4, "difficult": -0.5, "failed": -0.5, "hurt": -0.5, "hurting": -0.5,
+    "ill": -0.5, "sad": -0.5, "scared": -0.5, "wrong": -0.5, "afraid": -0.6, "crazy": -0.6,
+    "dangerous": -0.6, "unhappy": -0.6, "bad": -0.7, "painful": -0.7, "sick": -0.7143,
+    "awful": -1.0, "horrible": -1.0, "miserable": -1.0, "terrible": -1.0, "unbearable": -1.0,
+    "worst": -1.0
+}
+
+# Words that flip the polarity of the following sentiment word (TextBlob halves and flips)
+NEGATIONS = {"not", "no", "never", "n't", "without", "nothing", "hardly"}
+NEGATION_FACTOR = -0.5
+
+# Words that strengthen or weaken the following sentiment word
+INTENSIFIERS: Dict[str, float] = {
+    "very": 1.3, "really": 1.3, "extremely": 1.5, "so": 1.3, "too": 1.2, "incredibly": 1.5,
+    "quite": 1.1, "super": 1.4, "most": 1.3, "slightly": 0.6, "somewhat": 0.7
+}
+
+WORD_PATTERN = re.compile(r"n't|[a-z]+(?:'[a-z]+)?")
+
+
+class LexiconSentimentScorer:
+    """
+    Lightweight polarity scorer.
+    Averages the polarity of lexicon words in the text, applying the preceding negation or
+    intensifier, in the same spirit as TextBlob's pattern analyzer but without NLTK.
+    """
+
+    name = "lexicon"
+
+    def __init__(self, lexicon: Optional[Dict[str, float]] = None):
+        self.lexicon = SENTIMENT_LEXICON if lexicon is None else lexicon
+
+    def score(self, text: str) -> float:
+        """Return the polarity of one text."""
+        lexicon = self.lexicon
+        words = WORD_PATTERN.findall(text.lower())
+        total = 0.0
+        hits = 0
+        for index, word in enumerate(words):
+            polarity = lexicon.get(word)
+            if polarity is None:
+                continue
+            if index:
+                previous = words[index - 1]
+                if previous in NEGATIONS or (index > 1 and words[index - 2] in NEGATIONS and previous in INTENSIFIERS):
+                    polarity *= NEGATION_FACTOR
+                if previous in INTENSIFIERS:
+                    polarity = max(-1.0, min(1.0, polarity * INTENSIFIERS[previous]))
+            total += polarity
+            hits += 1
+        return total / hits if hits else 0.0
+
+    def score_batch(self, texts: Iterable[str]) -> List[float]:
+        """Return the polarity of each text, in order."""
+        score = self.score
+        return [score(text) for text in texts]
+
+
+class TextBlobSentimentScorer:
+    """
+    TextBlob polarity backend.
+    Results are memoized per text, since building a TextBlob is the expensive part.
+    """
+
+    name = "textblob"
+
+    def __init__(self, textblob_cls, cache_size: int = 4096):
+        self._textblob = textblob_cls
+        self._cached_score = lru_cache(maxsize=cache_size)(self._score_uncached)
+
+    def _score_uncached(self, text: str) -> float:
+        try:
+            return self._textblob(text).sentiment.polarity
+        except Exception:
+            return 0.0
+
+    def score(self, text: str) -> float:
+        """Return the polarity of one text."""
+        return self._cached_score(text)
+
+    def score_batch(self, texts: Iterable[str]) -> List[float]:
+        """Return the polarity of each text, in order."""
+        return [self._cached_score(text) for text in texts]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Stub FHIR server for local testing of the FHIR execution layer.
+Serves searchset Bundles of synthetic resources for any resource type, with paging
+(_count / _offset and link[rel=next]), read by id, ETags with If-None-Match (304), and
+optional injected latency and failures. Results are deterministic for a given seed.
+
+Run with:  python fhir_stub_server.py --port 8080 --total 250
+Then:      FHIR_SERVER_URL=http://localhost:8080/fhir FHIR_EXECUTE=1 python fhir_api_server.py
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+BASE_PATH = "/fhir"
+DEFAULT_PAGE_SIZE = 20
+
+FIRST_NAMES = ["John", "Sarah", "Michael", "Emily", "David", "Jessica", "Robert", "Ashley"]
+LAST_NAMES = ["Smith", "Johnson", "Brown", "Davis", "Wilson", "Garcia", "Miller", "Rodriguez"]
+
+
+def synthetic_resource(resource_type: str, index: int, seed: int, patients: int = 1000) -> Dict:
+    """Build one deterministic resource of the given type, referencing one of `patients` patients."""
+    rng = random.Random(f"{seed}:{resource_type}:{index}")
+    resource = {"resourceType": resource_type, "id": f"{resource_type.lower()}-{index}"}
+    patient = f"Patient/patient-{rng.randrange(patients)}"
+    if resource_type == "Patient":
+        resource.update({
+            "id": f"patient-{index}",
+            "name": [{"family": rng.choice(LAST_NAMES), "given": [rng.choice(FIRST_NAMES)]}],
+            "gender": rng.choice(["male", "female"]),
+            "birthDate": f"{rng.randint(1935, 2005)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        })
+    elif resource_type == "Condition":
+        resource.update({
+            "subject": {"reference": patient},
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": "73211009"}]},
+            "clinicalStatus": {"coding": [{"code": rng.choice(["active", "resolved"])}]}
+        })
+    elif resource_type == "Observation":
+        resource.update({
+            "status": "final",
+            "subject": {"reference": patient},
+            "code": {"coding": [{"system": "http://loinc.org", "code": "33747-0"}]},
+            "valueQuantity": {"value": round(rng.uniform(70, 200), 1), "unit": "mg/dL"},
+            "effectiveDateTime": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        })
+    else:
+        resource.update({"subject": {"reference": patient}, "status": "active"})
+    return resource
+
+
+class StubFHIRHandler(BaseHTTPRequestHandler):
+    server_version = "StubFHIR/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, body: Dict):
+        payload = json.dumps(body).encode()
+        etag = f'W/"{hashlib.sha1(payload).hexdigest()[:16]}"' if status == 200 else None
+        if etag and self.headers.get("If-None-Match") == etag:
+            with self.server.lock:
+                self.server.not_modified_count += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(payload)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            fail = server.rng.random() < server.fail_rate
+        if server.latency_ms:
+            time.sleep(server.latency_ms / 1000)
+        if fail:
+            self.send_json(503, {"resourceType": "OperationOutcome",
+                                 "issue": [{"severity": "error", "code": "transient"}]})
+            return
+
+        parts = urlsplit(self.path)
+        path = parts.path[len(BASE_PATH):] if parts.path.startswith(BASE_PATH) else parts.path
+        segments = [segment for segment in path.split("/") if segment]
+        params = parse_qsl(parts.query, keep_blank_values=True)
+
+        if len(segments) == 1:
+            self.send_json(200, self.search_bundle(segments[0], params))
+        elif len(segments) == 2:
+            index = segments[1].rsplit("-", 1)[-1]
+            if not index.isdigit() or int(index) >= server.total:
+                self.send_json(404, {"resourceType": "OperationOutcome",
+                                     "issue": [{"severity": "error", "code": "not-found"}]})
+            else:
+                self.send_json(200, synthetic_resource(segments[0], int(index), server.seed, server.total))
+        else:
+            self.send_json(404, {"resourceType": "OperationOutcome",
+                                 "issue": [{"severity": "error", "code": "not-supported"}]})
+
+    def search_bundle(self, resource_type: str, params: List) -> Dict:
+        server = self.server
+        query = dict(params)
+        count = int(query.get("_count", DEFAULT_PAGE_SIZE))
+        offset = int(query.get("_offset", 0))
+        entries = [synthetic_resource(resource_type, index, server.seed, server.total)
+                   for index in range(offset, min(offset + count, server.total))]
+
+        base = f"http://{self.headers.get('Host')}{BASE_PATH}/{resource_type}"
+        search_params = [(key, value) for key, value in params if key not in ("_count", "_offset")]
+        links = [{"relation": "self", "url": f"{base}?{urlencode(params)}"}]
+        if offset + count < server.total:
+            next_params = search_params + [("_count", count), ("_offset", offset + count)]
+            links.append({"relation": "next", "url": f"{base}?{urlencode(next_params)}"})
+
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": server.total,
+            "link": links,
+            "entry": [{"fullUrl": f"{base}/{resource['id']}", "resource": resource} for resource in entries]
+        }
+
+
+def create_stub_server(port: int = 0, total: int = 50, latency_ms: float = 0.0, fail_rate: float = 0.0,
+                       seed: int = 0, verbose: bool = False) -> ThreadingHTTPServer:
+    """Create (but do not start) a stub server; port 0 picks a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubFHIRHandler)
+    server.total = total
+    server.latency_ms = latency_ms
+    server.fail_rate = fail_rate
+    server.seed = seed
+    server.verbose = verbose
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.not_modified_count = 0
+    server.daemon_threads = True
+    return server
+
+
+def start_stub_server(**kwargs) -> ThreadingHTTPServer:
+    """Start a stub server in a background thread; its base URL is server.base_url."""
+    server = create_stub_server(**kwargs)
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}{BASE_PATH}"
+    threading.Thread(target=server.serve_forever, name="stub-fhir", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub FHIR server for local testing")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--total", type=int, default=50, help="Resources per search")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay added to every response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server = create_stub_server(args.port, args.total, args.latency_ms, args.fail_rate, args.seed, args.verbose)
+    print(f"🧪 Stub FHIR server at http://localhost:{args.port}{BASE_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
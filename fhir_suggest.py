@@ -0,0 +1,400 @@
+"""
+Autocomplete index for /api/suggestions.
+
+Suggestions are matched at word starts: "diab" and "diabetic pat" both find "Show me all
+diabetic patients over 50". Every word-start suffix of every suggestion is kept in one sorted
+array (as suggestion id + offset, so no suffix strings are stored), and a prefix selects a
+contiguous range of it by binary search. A max segment tree over the suggestions' weights
+returns the heaviest matches in a range without scanning it, so lookups stay O(k log n) no
+matter how many suggestions share a prefix.
+
+Fragments with no prefix match in the vocabulary are corrected word by word through a
+trigram index over the vocabulary and a bounded edit distance, so "diabtic" still finds
+"diabetic". Weights are frequencies: curated and lexicon suggestions start with a fixed
+weight and every time a query is asked adds one.
+"""
+
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Starting weights, so curated suggestions outrank lexicon ones until history says otherwise
+CURATED_WEIGHT = 5
+LEXICON_WEIGHT = 1
+
+# Longer texts are not indexed (offsets are stored as 16-bit integers)
+MAX_SUGGESTION_LENGTH = 200
+
+# Words shorter than this are never corrected; candidates verified per corrected word
+MIN_FUZZY_LENGTH = 3
+FUZZY_CANDIDATES = 16
+
+# Popular queries waiting for the next rebuild are matched by a linear scan up to this many
+MAX_PENDING = 64
+
+
+def normalize(text: str) -> str:
+    """Lower-case and collapse whitespace; suggestions with the same form are one entry."""
+    return " ".join(text.lower().split())
+
+
+def _trigrams(word: str) -> List[str]:
+    # The leading marker ties the first letters to the start of the word
+    padded = f"^{word}"
+    return [padded[i:i + 3] for i in range(max(1, len(padded) - 2))]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance between a and b, or limit + 1 once it is known to exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class SuggestionIndex:
+    """
+    Weighted suggestions indexed for prefix and typo-tolerant lookups. The set of suggestions
+    is fixed once built; weights can only grow, through add_weight().
+    """
+
+    def __init__(self, suggestions: Dict[str, int]):
+        """``suggestions`` maps display text to weight (frequency)."""
+        self.texts: List[str] = []
+        self.weights: List[int] = []
+        self._normalized: List[str] = []
+        self._ids: Dict[str, int] = {}
+        for text, weight in suggestions.items():
+            key = normalize(text)
+            if not key or len(key) > MAX_SUGGESTION_LENGTH or key in self._ids:
+                continue
+            self._ids[key] = len(self.texts)
+            self.texts.append(text)
+            self.weights.append(max(1, weight))
+            self._normalized.append(key)
+
+        # Sorted word-start suffixes, packed as suggestion id << 16 | offset
+        keys = self._normalized
+        packed = []
+        for suggestion, key in enumerate(keys):
+            packed.append(suggestion << 16)
+            offset = key.find(" ")
+            while offset != -1:
+                packed.append(suggestion << 16 | (offset + 1))
+                offset = key.find(" ", offset + 1)
+        packed.sort(key=lambda entry: (keys[entry >> 16][entry & 0xFFFF:], entry))
+        self._suffix_ids = array("I", (entry >> 16 for entry in packed))
+        self._suffix_offsets = array("H", (entry & 0xFFFF for entry in packed))
+        del packed
+
+        # Max segment tree over suffix weights: leaves at size + position, parents hold the max
+        self._size = 1 << max(0, len(self._suffix_ids) - 1).bit_length()
+        tree = [0] * (2 * self._size)
+        weights = self.weights
+        for position, suggestion in enumerate(self._suffix_ids, self._size):
+            tree[position] = weights[suggestion]
+        for node in range(self._size - 1, 0, -1):
+            left, right = tree[2 * node], tree[2 * node + 1]
+            tree[node] = left if left >= right else right
+        self._tree = array("Q", tree)
+        del tree
+
+        # Vocabulary: sorted words for prefix checks, trigram postings for corrections
+        word_weights = Counter()
+        for suggestion, key in enumerate(self._normalized):
+            for word in set(key.split()):
+                word_weights[word] += self.weights[suggestion]
+        self._words = sorted(word_weights)
+        self._word_weights = [word_weights[word] for word in self._words]
+        postings = defaultdict(list)
+        for word_id, word in enumerate(self._words):
+            for gram in set(_trigrams(word)):
+                postings[gram].append(word_id)
+        self._postings = dict(postings)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __contains__(self, text: str) -> bool:
+        return normalize(text) in self._ids
+
+    def weight(self, text: str) -> Optional[int]:
+        suggestion = self._ids.get(normalize(text))
+        return None if suggestion is None else self.weights[suggestion]
+
+    def add_weight(self, text: str, delta: int = 1) -> bool:
+        """Increase a suggestion's weight; returns False when the text is not indexed."""
+        suggestion = self._ids.get(normalize(text))
+        if suggestion is None:
+            return False
+        weight = self.weights[suggestion] = self.weights[suggestion] + delta
+        for position in self._suffix_positions(suggestion):
+            node = self._size + position
+            self._tree[node] = weight
+            node >>= 1
+            while node and self._tree[node] < weight:
+                self._tree[node] = weight
+                node >>= 1
+        return True
+
+    def _suffix_positions(self, suggestion: int) -> List[int]:
+        """Positions of a suggestion's word-start suffixes, by binary search on the sort key."""
+        ids, offsets, keys = self._suffix_ids, self._suffix_offsets, self._normalized
+
+        def sort_key(position: int) -> Tuple[str, int]:
+            offset = offsets[position]
+            return keys[ids[position]][offset:], ids[position] << 16 | offset
+
+        key = keys[suggestion]
+        starts = [0] + [i + 1 for i, char in enumerate(key) if char == " "]
+        positions = range(len(ids))
+        return [bisect_left(positions, (key[start:], suggestion << 16 | start), key=sort_key) for start in starts]
+
+    def _range(self, prefix: str) -> Tuple[int, int]:
+        """Positions of the suffixes that start with ``prefix``."""
+        length = len(prefix)
+        ids, offsets, keys = self._suffix_ids, self._suffix_offsets, self._normalized
+
+        def head(position: int) -> str:
+            offset = offsets[position]
+            return keys[ids[position]][offset:offset + length]
+
+        positions = range(len(ids))
+        return bisect_left(positions, prefix, key=head), bisect_right(positions, prefix, key=head)
+
+    def prefix_search(self, prefix: str, limit: int) -> List[int]:
+        """Ids of the heaviest ``limit`` suggestions with a word starting with ``prefix``."""
+        low, high = self._range(prefix)
+        tree, size = self._tree, self._size
+        heap = []
+        # Cover [low, high) with O(log n) tree nodes, then expand the heaviest node first
+        # (deepest first among equal weights, so ties reach a leaf without a broad search)
+        low, high = low + size, high + size
+        while low < high:
+            if low & 1:
+                heap.append((-tree[low], -low))
+                low += 1
+            if high & 1:
+                high -= 1
+                heap.append((-tree[high], -high))
+            low >>= 1
+            high >>= 1
+        heapq.heapify(heap)
+
+        found, seen = [], set()
+        while heap and len(found) < limit:
+            _, node = heapq.heappop(heap)
+            node = -node
+            if node >= size:
+                suggestion = self._suffix_ids[node - size]
+                if suggestion not in seen:
+                    seen.add(suggestion)
+                    found.append(suggestion)
+            else:
+                heapq.heappush(heap, (-tree[2 * node], -2 * node))
+                heapq.heappush(heap, (-tree[2 * node + 1], -2 * node - 1))
+        return found
+
+    def _is_word_prefix(self, fragment: str, whole: bool = False) -> bool:
+        """Whether a vocabulary word starts with (or, with ``whole``, equals) ``fragment``."""
+        position = bisect_left(self._words, fragment)
+        if position == len(self._words):
+            return False
+        word = self._words[position]
+        return word == fragment if whole else word.startswith(fragment)
+
+    def correct_word(self, word: str, partial: bool) -> Optional[str]:
+        """
+        Closest vocabulary word to ``word`` (within 1 edit, 2 for words of 6+ letters), or None.
+        A ``partial`` word (the one being typed) is compared with vocabulary word prefixes,
+        and the closest prefix is returned, so the word can still be completed.
+        """
+        limit = 1 if len(word) < 6 else 2
+        shared = Counter()
+        for gram in _trigrams(word):
+            shared.update(self._postings.get(gram, ()))
+        best, best_rank = None, None
+        for word_id, _ in shared.most_common(FUZZY_CANDIDATES):
+            candidate = self._words[word_id]
+            options = [candidate[:len(word) + extra] for extra in (-1, 0, 1)] if partial else [candidate]
+            for option in options:
+                rank = (edit_distance(word, option, limit), -self._word_weights[word_id], -len(option))
+                if rank[0] <= limit and (best_rank is None or rank < best_rank):
+                    best, best_rank = option, rank
+        return best
+
+    def correct(self, fragment: str) -> Optional[str]:
+        """``fragment`` with misspelled words replaced, or None when nothing was corrected."""
+        words = fragment.split(" ")
+        corrected = False
+        for i, word in enumerate(words):
+            partial = i == len(words) - 1
+            if len(word) < MIN_FUZZY_LENGTH or self._is_word_prefix(word, whole=not partial):
+                continue
+            replacement = self.correct_word(word, partial)
+            if replacement is not None:
+                words[i] = replacement
+                corrected = True
+        return " ".join(words) if corrected else None
+
+    def search_tiers(self, fragment: str, limit: int = 10) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+        """
+        (text, weight) matches for a typed fragment as two lists, heaviest first in each: exact
+        prefix matches, then matches of the typo-corrected fragment (only when the exact ones
+        are fewer than ``limit``).
+        """
+        fragment = normalize(fragment)
+        if not fragment or not self.texts:
+            return [], []
+        found = self.prefix_search(fragment, limit)
+        corrected_found = []
+        if len(found) < limit:
+            corrected = self.correct(fragment)
+            if corrected is not None:
+                corrected_found = [suggestion for suggestion in self.prefix_search(corrected, limit)
+                                   if suggestion not in found][:limit - len(found)]
+        return ([(self.texts[suggestion], self.weights[suggestion]) for suggestion in found],
+                [(self.texts[suggestion], self.weights[suggestion]) for suggestion in corrected_found])
+
+    def search(self, fragment: str, limit: int = 10) -> List[Tuple[str, int]]:
+        """(text, weight) of the best matches for a typed fragment: exact prefix matches first."""
+        exact, corrected = self.search_tiers(fragment, limit)
+        return exact + corrected
+
+
+class Autocomplete:
+    """
+    Thread-safe autocomplete over curated suggestions, lexicon phrases and popular queries.
+    A query becomes a suggestion once ``history_min_count`` distinct callers have asked it, so a
+    query only one caller sends, however often, is never shown to other users; queries that
+    name a patient should not be recorded at all. New popular queries are matched by a linear
+    scan until MAX_PENDING accumulate, then the index is rebuilt in the background and swapped in.
+    """
+
+    def __init__(self, suggestions: Iterable[str] = (), history_min_count: int = 3,
+                 history_size: int = 10000, limit: int = 10):
+        self.history_min_count = history_min_count
+        self.history_size = history_size
+        self.limit = limit
+        self._weights: Dict[str, int] = {}
+        self._history = Counter()
+        # Distinct callers per query until it becomes popular; then the key moves to _popular
+        self._callers: Dict[str, Set[Hashable]] = {}
+        self._popular: Set[str] = set()
+        self._pending: Dict[str, str] = {}
+        self._from_history = 0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        # Weight recorded while a new index is built, applied to it before it is swapped in
+        self._rebuild_delta: Optional[Counter] = None
+        self._rebuild_lock = threading.Lock()
+        for text in suggestions:
+            self._weights.setdefault(text, CURATED_WEIGHT)
+        self.index = SuggestionIndex(self._weights)
+
+    def add_suggestions(self, suggestions: Iterable[str], weight: int = LEXICON_WEIGHT):
+        """Add suggestions (e.g. lexicon phrases) and rebuild the index now."""
+        with self._lock:
+            for text in suggestions:
+                self._weights.setdefault(text, weight)
+        self._rebuild()
+
+    def record(self, query: str, caller: Hashable = None):
+        """
+        Count one occurrence of a query sent by ``caller`` (e.g. a client address). Queries asked
+        by enough distinct callers become suggestions; popular queries gain weight every time.
+        """
+        text = " ".join(query.split())
+        key = normalize(text)
+        if not key or len(key) > MAX_SUGGESTION_LENGTH or self.history_min_count <= 0:
+            return
+        rebuild = False
+        with self._lock:
+            count = self._history[key] = self._history[key] + 1
+            if key in self._popular:
+                delta = 1
+            else:
+                callers = self._callers.setdefault(key, set())
+                callers.add(caller)
+                if len(callers) < self.history_min_count or len(self._popular) >= self.history_size:
+                    if len(self._history) > self.history_size:
+                        # Forget queries that are not popular (yet) rather than growing without bound
+                        self._history = Counter({k: v for k, v in self._history.items() if k in self._popular})
+                        self._callers = {}
+                    return
+                del self._callers[key]
+                self._popular.add(key)
+                delta = count
+            if self._rebuild_delta is not None:
+                self._rebuild_delta[text] += delta
+            if self.index.add_weight(text, delta):
+                return
+            if key in self._pending or self._from_history >= self.history_size:
+                return
+            self._pending[key] = text
+            self._from_history += 1
+            rebuild = len(self._pending) >= MAX_PENDING and not self._rebuilding
+            self._rebuilding = self._rebuilding or rebuild
+        if rebuild:
+            threading.Thread(target=self._rebuild, name="suggestion-index", daemon=True).start()
+
+    def _rebuild(self):
+        # One rebuild at a time, so the weight delta covers exactly one build
+        with self._rebuild_lock:
+            with self._lock:
+                for key, text in self._pending.items():
+                    self._weights.setdefault(text, self._history[key])
+                pending = dict(self._pending)
+                self._rebuilding = True
+                # Carry over weights gained since the last build; weight recorded from now on
+                # is also collected in _rebuild_delta
+                for text in self._weights:
+                    self._weights[text] = self.index.weight(text) or self._weights[text]
+                weights = dict(self._weights)
+                self._rebuild_delta = Counter()
+            index = SuggestionIndex(weights)
+            with self._lock:
+                # Texts that are not in the new index are still pending and weighted by _history
+                for text, delta in self._rebuild_delta.items():
+                    index.add_weight(text, delta)
+                self._rebuild_delta = None
+                self.index = index
+                for key in pending:
+                    self._pending.pop(key, None)
+                self._rebuilding = False
+
+    def suggest(self, fragment: str, limit: Optional[int] = None) -> List[str]:
+        """
+        Best suggestions for a typed fragment: exact prefix matches, then typo-corrected ones,
+        most frequent first within each.
+        """
+        limit = limit or self.limit
+        exact, corrected = self.index.search_tiers(fragment, limit)
+        if self._pending:
+            prefix = " " + normalize(fragment)
+            with self._lock:
+                pending = [(text, self._history[key]) for key, text in self._pending.items()
+                           if (" " + key).find(prefix) != -1]
+            if pending:
+                # Pending queries are exact prefix matches: rank them with the index's exact
+                # matches, ahead of every typo-corrected one
+                exact = sorted(exact + pending, key=lambda match: -match[1])
+        return [text for text, _ in (exact + corrected)[:limit]]
+
+    def stats(self) -> Dict:
+        return {
+            "suggestions": len(self.index),
+            "pending": len(self._pending),
+            "tracked_queries": len(self._history),
+            "popular_queries": len(self._popular)
+        }
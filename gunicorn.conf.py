@@ -0,0 +1,80 @@
+"""
+Gunicorn configuration for the FHIR Query API (production launcher).
+
+The app is preloaded in the master process, so FHIRQueryService loads the spaCy model and
+lexicon tables once and every worker forked from it shares those pages copy-on-write.
+Garbage collection is paused while the model loads and the surviving objects are frozen
+before forking, so collections in the workers do not write to (and un-share) them; the
+master then collects again like any other process.
+
+Run with:  gunicorn -c gunicorn.conf.py fhir_api_server:app
+"""
+
+import gc
+import glob
+import os
+import tempfile
+
+# Load the model eagerly in the master; a lazy warm-up thread would not survive fork
+os.environ["NLP_LAZY_LOAD"] = "0"
+
+# Prometheus multi-process mode: every worker writes its metric values to files in this
+# directory and /metrics aggregates them. Must be set before the app imports prometheus_client.
+metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="fhir-metrics-"))
+for stale_file in glob.glob(os.path.join(metrics_dir, "*.db")):
+    os.remove(stale_file)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", str(os.cpu_count() or 1)))
+# One request at a time per worker by default; request coalescing needs more than one thread
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+preload_app = True
+
+# No collections while the app (and the model) is imported in the master; when_ready
+# turns the collector back on once the preloaded objects are frozen
+gc.disable()
+
+
+def process_memory_mb():
+    """RSS, PSS, shared and private memory of this process in MB, from /proc/self/smaps_rollup."""
+    fields = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared", "Shared_Dirty": "shared",
+              "Private_Clean": "private", "Private_Dirty": "private"}
+    memory = {"rss": 0.0, "pss": 0.0, "shared": 0.0, "private": 0.0}
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            for line in smaps:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    memory[fields[key]] += int(value.split()[0]) / 1024
+    except OSError:
+        return None
+    return memory
+
+
+def when_ready(server):
+    # The app is loaded and no worker is forked yet: freeze what it allocated and resume
+    # collections in the master (workers inherit the enabled collector)
+    gc.freeze()
+    gc.enable()
+    memory = process_memory_mb()
+    if memory:
+        server.log.info("Master ready: RSS %.1f MB", memory["rss"])
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far into the permanent generation, so it is never scanned
+    # (and its pages never dirtied) by the workers' collector
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    memory = process_memory_mb()
+    if memory:
+        worker.log.info("Worker %s memory: RSS %.1f MB, PSS %.1f MB, shared %.1f MB, private %.1f MB",
+                        worker.pid, memory["rss"], memory["pss"], memory["shared"], memory["private"])
+
+
+def child_exit(server, worker):
+    from fhir_metrics import mark_process_dead
+    mark_process_dead(worker.pid)
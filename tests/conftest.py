@@ -0,0 +1,28 @@
+"""
+Shared fixtures. The modules live at the repository root, so it is put on sys.path here.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fhir_stub_server import start_stub_server  # noqa: E402
+
+
+@pytest.fixture
+def stub_server():
+    """Factory for stub FHIR servers on free ports, shut down after the test."""
+    servers = []
+
+    def start(**kwargs):
+        server = start_stub_server(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,30 @@
+"""
+Response helpers shared by the Flask and ASGI servers.
+"""
+
+import pytest
+
+from fhir_api_common import coalesce_key, process_query_request, response_for_query
+from fhir_query_service import FHIRQueryService
+
+
+@pytest.fixture(scope="module")
+def service():
+    return FHIRQueryService(lazy_load=False)
+
+
+def test_coalesced_response_carries_the_followers_text(service):
+    leader, _ = process_query_request(service, "find diabetic patients")
+    follower = response_for_query(leader, "Find Diabetic Patients")
+
+    assert follower["query"] == "Find Diabetic Patients"
+    assert follower["clinical_interpretation"]["summary"] == "Query analysis for: Find Diabetic Patients"
+    assert follower["simulated_results"]["queryInfo"]["originalQuery"] == "Find Diabetic Patients"
+    # The shared response is left as the leader received it
+    assert leader["simulated_results"]["queryInfo"]["originalQuery"] == "find diabetic patients"
+    assert response_for_query(leader, "find diabetic patients") is leader
+
+
+def test_coalesce_key_ignores_case_and_surrounding_whitespace():
+    assert coalesce_key("Find Diabetic Patients ") == coalesce_key("find diabetic patients")
+    assert coalesce_key("find diabetic patients", plan=True) != coalesce_key("find diabetic patients")
@@ -0,0 +1,28 @@
+"""
+Flask server: jsonify() through the fast JSON provider.
+"""
+
+import json
+
+import pytest
+from flask import jsonify
+
+from fhir_api_server import app
+
+
+@pytest.mark.parametrize("args, kwargs, expected", [
+    ((), {}, None),
+    (({"a": 1},), {}, {"a": 1}),
+    ((1, 2), {}, [1, 2]),
+    ((), {"a": 1}, {"a": 1}),
+])
+def test_jsonify_matches_flask(args, kwargs, expected):
+    with app.app_context():
+        response = jsonify(*args, **kwargs)
+    assert response.mimetype == "application/json"
+    assert json.loads(response.get_data()) == expected
+
+
+def test_jsonify_rejects_args_and_kwargs():
+    with app.app_context(), pytest.raises(TypeError):
+        jsonify(1, a=2)
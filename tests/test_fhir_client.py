@@ -0,0 +1,131 @@
+"""
+FHIRClient and FHIRResponseCache against the stub FHIR server.
+"""
+
+import asyncio
+import threading
+import time
+from collections import defaultdict
+
+from fhir_client import FHIRClient, FHIRResponseCache, next_link
+from fhir_stub_server import synthetic_resource
+
+
+def resource_ids(bundle):
+    return [entry["resource"]["id"] for entry in bundle.get("entry", [])]
+
+
+def test_search_pages_with_count_and_offset(stub_server):
+    server = stub_server(total=45)
+    with FHIRClient(server.base_url) as client:
+        bundle = client.get("Patient", {"_count": 10, "_offset": 30})
+        assert bundle["total"] == 45
+        assert resource_ids(bundle) == [f"patient-{index}" for index in range(30, 40)]
+        assert "_offset=40" in next_link(bundle)
+
+        last = client.get("Patient", {"_count": 10, "_offset": 40})
+        assert resource_ids(last) == [f"patient-{index}" for index in range(40, 45)]
+        assert next_link(last) is None
+
+
+def test_iter_pages_follows_next_links(stub_server):
+    server = stub_server(total=45)
+    query = {"resource_type": "Patient", "parameters": {"gender": "female"}}
+    with FHIRClient(server.base_url) as client:
+        for prefetch in (True, False):
+            pages = list(client.iter_pages(query, page_size=20, prefetch=prefetch))
+            assert [len(page["entry"]) for page in pages] == [20, 20, 5]
+            # Search parameters are carried over to every next link
+            assert all("gender=female" in link["url"] for page in pages for link in page["link"])
+
+            resources = list(client.iter_resources(query, page_size=20, prefetch=prefetch))
+            assert [resource["id"] for resource in resources] == [f"patient-{index}" for index in range(45)]
+
+        assert len(list(client.iter_pages(query, page_size=20, max_pages=2))) == 2
+
+
+def test_cache_serves_fresh_entries_without_a_request(stub_server):
+    server = stub_server(total=5)
+    with FHIRClient(server.base_url, cache=FHIRResponseCache()) as client:
+        first = client.get("Patient")
+        requests_made = server.request_count
+        assert client.get("Patient") == first
+        assert server.request_count == requests_made
+        assert client.cache.stats()["hits"] == 1
+
+
+def test_cache_revalidates_stale_entries_with_etag(stub_server):
+    server = stub_server(total=5)
+    cache = FHIRResponseCache(ttls={"Patient": 0.0})
+    with FHIRClient(server.base_url, cache=cache) as client:
+        first = client.get("Patient")
+        time.sleep(0.01)
+        second = client.get("Patient")
+
+        assert second == first
+        assert server.not_modified_count == 1
+        stats = cache.stats()
+        assert stats["stale"] == 1
+        assert stats["revalidated"] == 1
+
+
+def test_disk_cache_is_shared_between_instances(stub_server, tmp_path):
+    server = stub_server(total=5)
+    disk_path = str(tmp_path / "responses.db")
+    with FHIRClient(server.base_url, cache=FHIRResponseCache(disk_path=disk_path)) as client:
+        first = client.get("Patient")
+    requests_made = server.request_count
+
+    with FHIRClient(server.base_url, cache=FHIRResponseCache(disk_path=disk_path)) as client:
+        assert client.get("Patient") == first
+        assert client.cache.stats()["disk_hits"] == 1
+    assert server.request_count == requests_made
+
+
+def test_execute_plan_async_joins_by_patient(stub_server):
+    server = stub_server(total=30, seed=7)
+    plan = [{"resource_type": "Patient", "parameters": {}},
+            {"resource_type": "Condition", "parameters": {}}]
+    with FHIRClient(server.base_url) as client:
+        inner = asyncio.run(client.execute_plan_async(plan, max_pages=2))
+        outer = asyncio.run(client.execute_plan_async(plan, max_pages=2, inner_join=False))
+
+    # Brute force: every Patient is returned, so the inner join holds the patients with a Condition
+    conditions = defaultdict(list)
+    for index in range(server.total):
+        condition = synthetic_resource("Condition", index, server.seed, server.total)
+        conditions[condition["subject"]["reference"]].append(condition["id"])
+
+    assert [request["status"] for request in inner["requests"]] == ["ok", "ok"]
+    assert [request["count"] for request in inner["requests"]] == [30, 30]
+    assert inner["join"] == "inner"
+    assert {row["reference"]: [condition["id"] for condition in row["Condition"]]
+            for row in inner["patients"]} == dict(conditions)
+    assert all(row["Patient"]["id"] == row["reference"].split("/")[1] for row in inner["patients"])
+    assert len(outer["patients"]) == server.total
+
+
+def test_concurrent_identical_gets_share_one_request(stub_server):
+    server = stub_server(total=5, latency_ms=300)
+    callers = 8
+    barrier = threading.Barrier(callers)
+    results = [None] * callers
+
+    with FHIRClient(server.base_url) as client:
+        def fetch(slot):
+            barrier.wait()
+            results[slot] = client.get("Patient")
+
+        threads = [threading.Thread(target=fetch, args=(slot,)) for slot in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert server.request_count == 1
+        stats = client.coalescing_stats()
+        assert (stats["executed"], stats["coalesced"]) == (1, callers - 1)
+
+    # Every caller gets an equal result but its own copy
+    assert all(result == results[0] for result in results)
+    assert len({id(result) for result in results}) == callers
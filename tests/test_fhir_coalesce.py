@@ -0,0 +1,101 @@
+"""
+SingleFlight and AsyncSingleFlight: fan-out, errors and cancellation.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from fhir_coalesce import AsyncSingleFlight, SingleFlight
+
+
+def test_single_flight_fans_out_one_result():
+    flight = SingleFlight()
+    callers = 6
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return {"value": 42}
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("key", work)))
+               for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    # Release the leader only once every other caller is waiting on it
+    deadline = time.monotonic() + 5
+    while flight.stats()["coalesced"] < callers - 1 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * (callers - 1)
+    assert all(result is results[0][0] for result, _ in results)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    # Nothing is remembered once the call has completed
+    assert flight.do("key", lambda: 1) == (1, False)
+
+
+def test_async_single_flight_survives_leader_cancellation():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        leader = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        return calls, leader, results, flight.stats()
+
+    calls, leader, results, stats = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert leader.cancelled()
+    assert results == [(42, True)] * 3
+    assert stats["in_flight"] == 0
+
+
+def test_async_single_flight_cancels_call_without_callers():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.ensure_future(flight.do("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return flight.stats()
+
+    assert asyncio.run(scenario())["in_flight"] == 0
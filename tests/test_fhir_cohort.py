@@ -0,0 +1,43 @@
+"""
+Seeded simulated cohorts: reproducible pages and aggregates consistent with the patients.
+"""
+
+from collections import Counter
+
+from fhir_cohort import AGE_GROUP_LIMITS, AGE_GROUPS, AGGREGATE_CHUNK, simulate_cohort, simulate_page
+
+ENTITIES = {"conditions": ["diabetes"], "genders": ["female", "male"]}
+
+
+def age_group(age):
+    for group, limit in zip(AGE_GROUPS, AGE_GROUP_LIMITS):
+        if age <= limit:
+            return group
+    return AGE_GROUPS[-1]
+
+
+def test_pages_are_reproducible_for_a_seed():
+    assert simulate_page(ENTITIES, 11, 0, 50) == simulate_page(ENTITIES, 11, 0, 50)
+    assert simulate_page(ENTITIES, 11, 0, 50) != simulate_page(ENTITIES, 12, 0, 50)
+
+
+def test_pages_do_not_depend_on_page_boundaries():
+    whole = simulate_page(ENTITIES, 3, 0, 150)
+    pages = [simulate_cohort(ENTITIES, 150, 3, page, 50)["patients"] for page in (1, 2, 3)]
+    assert [patient for page in pages for patient in page] == whole
+    assert simulate_cohort(ENTITIES, 150, 3, 4, 50)["patients"] == []
+
+
+def test_aggregates_match_the_generated_patients():
+    # More than one chunk, so the chunked sums are checked too
+    count = AGGREGATE_CHUNK + 123
+    cohort = simulate_cohort(ENTITIES, count, 5, page=1, page_size=10)
+    patients = simulate_page(ENTITIES, 5, 0, count)
+
+    assert cohort["age_groups"] == {group: Counter(age_group(patient["age"]) for patient in patients)[group]
+                                    for group in AGE_GROUPS}
+    assert cohort["gender_counts"] == dict(Counter(patient["gender"] for patient in patients))
+    assert cohort["active"] == sum(patient["status"] == "active" for patient in patients)
+    assert cohort["avg_age"] == sum(patient["age"] for patient in patients) / count
+    assert cohort["condition_counts"] == {"diabetes": count}
+    assert cohort["patients"] == patients[:10]
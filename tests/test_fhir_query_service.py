@@ -0,0 +1,123 @@
+"""
+FHIRQueryService on the regex fallback (no spaCy model): entity patterns, lexicon matching,
+tiered routing, the result cache and lexicon sentiment.
+"""
+
+import time
+
+import pytest
+
+from fhir_query_service import FHIRQueryService, LexiconMatcher, QueryResultCache, scan_entity_patterns
+from fhir_sentiment import LexiconSentimentScorer
+
+
+@pytest.fixture(scope="module")
+def service():
+    service = FHIRQueryService(sentiment_backend="lexicon")
+    # Force the regex fallback even where en_core_web_sm is installed
+    service.nlp = None
+    return service
+
+
+def test_entity_patterns_fill_every_bucket():
+    found = scan_entity_patterns("female patient abc-12 aged 70 with severe head pain over 65 named john doe")
+    assert found == {"genders": ["female"], "patient_ids": ["abc-12"], "ages": ["65", "70"],
+                     "severity_indicators": ["severe"], "symptoms": ["pain", "head pain"],
+                     "names": ["john doe"]}
+    assert scan_entity_patterns("show all observations") == {}
+
+
+def test_entity_patterns_report_overlapping_rules_once_each():
+    # "headache" and "ache" come from different rules; "pain" twice from one rule
+    assert scan_entity_patterns("headache and pain, more pain")["symptoms"] == ["pain", "pain", "headache"]
+
+
+def test_lexicon_matcher_finds_overlapping_terms():
+    matcher = LexiconMatcher({"conditions": ["heart disease", "disease"], "urgency": ["chest pain", "pain"]})
+    text = "heart disease with chest pain"
+    hits = matcher.find_all(text)
+    assert [(text[start:end], category) for start, end, category, _ in hits] == [
+        ("heart disease", "conditions"), ("disease", "conditions"),
+        ("chest pain", "urgency"), ("pain", "urgency")]
+    assert matcher.group_terms(hits + hits) == {"conditions": ["heart disease", "disease"],
+                                               "urgency": ["chest pain", "pain"]}
+    assert matcher.find_all("hear diseas") == []
+
+
+def test_regex_fallback_extracts_entities(service):
+    result = service.process_patient_query("Find female patients with severe diabetes over 65")
+    entities = result["nlp_analysis"]["entities"]
+    assert entities["conditions"] == ["diabetes"]
+    assert entities["genders"] == ["female"]
+    assert entities["ages"] == [65]
+    assert entities["severity_indicators"] == ["severe"]
+    assert result["fhir_query"]["resource_type"] == "Patient"
+    assert result["fhir_query"]["parameters"]["_has:Condition:patient:code"] == "73211009"
+
+
+@pytest.mark.parametrize("query, needs_spacy", [
+    ("find patients with severe head pain", False),
+    ("list unhappy patients", False),
+    ("find diabetic patients over 65", True),
+    ("glucose results from last week", True),
+    ("patients named john smith", True),
+    ("show Smith labs", True),
+    ("patient with swelling", True),
+])
+def test_needs_spacy_routing(service, query, needs_spacy):
+    assert service._needs_spacy(service.normalize_query(query)) is needs_spacy
+
+
+def test_result_cache_hits_expiry_and_lru():
+    cache = QueryResultCache(max_entries=2, ttl_seconds=60.0)
+    cache.put("a", {"intent": "find_patients"})
+    cache.put("b", {"intent": "find_observations"})
+    assert cache.get("a") == {"intent": "find_patients"}
+    # "b" is now the least recently used entry
+    cache.put("c", {"intent": "find_conditions"})
+    assert "b" not in cache and "a" in cache and "c" in cache
+    assert cache.get("b") is None
+
+    # Callers get their own copy
+    cache.get("a")["intent"] = "changed"
+    assert cache.get("a") == {"intent": "find_patients"}
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["size"]) == (3, 1, 1, 2)
+
+    cache.ttl_seconds = 0.0
+    time.sleep(0.01)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_result_cache_ignores_case():
+    service = FHIRQueryService(sentiment_backend="lexicon", cache_size=8)
+    service.nlp = None
+    first = service.process_patient_query("Find Diabetic Patients ")
+    second = service.process_patient_query("find diabetic patients")
+    assert service.cache_stats()["hits"] == 1
+    assert service.cache_stats()["size"] == 1
+    assert second["nlp_analysis"] == first["nlp_analysis"]
+    # The original text is kept per request
+    assert second["original_query"] == "find diabetic patients"
+
+
+@pytest.mark.parametrize("text, polarity", [
+    ("list unhappy patients", -0.6),
+    ("patients who are not happy", -0.4),
+    ("patients feeling very bad and sad", (-0.91 - 0.5) / 2),
+    ("great results", 0.8),
+    ("find patients with diabetes", 0.0),
+])
+def test_lexicon_sentiment(text, polarity):
+    assert LexiconSentimentScorer().score(text) == pytest.approx(polarity)
+
+
+def test_sentiment_output(service):
+    sentiment = service.analyze_sentiment("Urgent: unhappy patient with chest pain")
+    assert sentiment["polarity"] == pytest.approx((-0.1 - 0.6) / 2)
+    assert sorted(sentiment["emotional_indicators"]) == ["chest pain", "pain", "urgent"]
+    assert sentiment["urgency_score"] == 5
+    assert sentiment["priority_level"] == "emergency"
+    assert LexiconSentimentScorer().score_batch(["great results", "bad results"]) == [0.8, -0.7]
@@ -0,0 +1,52 @@
+"""
+FHIRRequest: canonical parameter order and single percent-encoding.
+"""
+
+import pytest
+
+from fhir_request import FHIRRequest, canonical_url
+
+BASE_URL = "https://fhir.example.org/baseR4"
+
+
+def test_parameters_are_sorted_and_repeated():
+    request = FHIRRequest(BASE_URL + "/", "Observation",
+                          {"date": ["le2024-01-31", "ge2024-01-01"], "code": "8310-5", "_count": 10})
+    assert request.params == [("_count", "10"), ("code", "8310-5"),
+                              ("date", "ge2024-01-01"), ("date", "le2024-01-31")]
+    assert request.url == f"{BASE_URL}/Observation?_count=10&code=8310-5&date=ge2024-01-01&date=le2024-01-31"
+
+
+def test_equal_searches_share_one_key():
+    first = FHIRRequest(BASE_URL, "Patient", {"gender": "female", "birthdate": "le1960"})
+    second = FHIRRequest(BASE_URL, "Patient", [("birthdate", "le1960"), ("gender", "female")])
+    assert first == second and hash(first) == hash(second)
+    assert first.key == first.url
+    assert first != FHIRRequest(BASE_URL, "Patient", {"gender": "female", "birthdate": "le1960"}, method="POST")
+    assert FHIRRequest(BASE_URL, "Patient").url == f"{BASE_URL}/Patient"
+
+
+def test_values_are_encoded_once():
+    request = FHIRRequest(BASE_URL, "Patient", {"name": "John Smith", "_has:Condition:patient:code": "73211009",
+                                                "general-practitioner": "Practitioner/7", "family": "O'Neil&Co"})
+    # FHIR's ':' modifiers, '/' references and ',' alternatives stay readable
+    assert request.query_string == ("_has:Condition:patient:code=73211009&family=O%27Neil%26Co"
+                                    "&general-practitioner=Practitioner/7&name=John%20Smith")
+
+    # A URL that already carries encoded parameters (a Bundle next link) is decoded first
+    next_link = f"{BASE_URL}/Patient?name=John%20Smith&_offset=20"
+    assert canonical_url(next_link, {"_count": 20}) == f"{BASE_URL}/Patient?_count=20&_offset=20&name=John%20Smith"
+    assert canonical_url(canonical_url(next_link)) == canonical_url(next_link)
+
+
+def test_from_query_and_extra_parameters():
+    query = {"resource_type": "Condition", "method": "GET", "url": f"{BASE_URL}/Condition",
+             "parameters": {"code": "73211009"}}
+    request = FHIRRequest.from_query(query)
+    assert request.url == f"{BASE_URL}/Condition?code=73211009"
+    assert request.with_params(_count=50).url == f"{BASE_URL}/Condition?_count=50&code=73211009"
+    assert request.url == f"{BASE_URL}/Condition?code=73211009"
+    assert FHIRRequest.from_query(query, "http://localhost:8080/fhir").base_url == "http://localhost:8080/fhir"
+
+    with pytest.raises(ValueError):
+        FHIRRequest.from_query({"error": "Could not determine FHIR resource type"})
@@ -0,0 +1,132 @@
+"""
+SuggestionIndex against a brute-force scan, and Autocomplete ranking.
+"""
+
+import random
+
+import pytest
+
+import fhir_api_common
+import fhir_suggest
+from fhir_suggest import Autocomplete, SuggestionIndex, normalize
+
+WORDS = ["find", "show", "patients", "with", "diabetes", "diabetic", "asthma", "copd", "recent",
+         "glucose", "observations", "over", "active", "conditions", "heart", "hypertension"]
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = random.Random(2024)
+    suggestions = {}
+    while len(suggestions) < 2000:
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6)))
+        suggestions[text.capitalize()] = rng.randint(1, 40)
+    return suggestions
+
+
+def brute_force(suggestions, fragment):
+    """Weights of every suggestion with a word starting with ``fragment``, heaviest first."""
+    needle = " " + normalize(fragment)
+    return sorted((weight for text, weight in suggestions.items()
+                   if (" " + normalize(text)).find(needle) != -1), reverse=True)
+
+
+def fragments(rng, count):
+    for _ in range(count):
+        first, second = rng.choice(WORDS), rng.choice(WORDS)
+        yield rng.choice([first[:rng.randint(1, len(first))],
+                          f"{first} {second[:rng.randint(1, len(second))]}"])
+
+
+def check_against_brute_force(index, suggestions, fragment, limit):
+    found = index.prefix_search(normalize(fragment), limit)
+    assert len(found) == len(set(found))
+    assert all((" " + normalize(index.texts[suggestion])).find(" " + normalize(fragment)) != -1
+               for suggestion in found)
+    assert [index.weights[suggestion] for suggestion in found] == brute_force(suggestions, fragment)[:limit]
+
+
+def test_prefix_search_matches_brute_force(corpus):
+    index = SuggestionIndex(corpus)
+    rng = random.Random(1)
+    for fragment in fragments(rng, 200):
+        check_against_brute_force(index, corpus, fragment, rng.choice([1, 5, 10, 50]))
+
+
+def test_prefix_search_follows_weight_updates(corpus):
+    suggestions = dict(corpus)
+    index = SuggestionIndex(suggestions)
+    rng = random.Random(2)
+    for text in rng.sample(sorted(suggestions), 100):
+        delta = rng.randint(1, 30)
+        assert index.add_weight(text, delta)
+        suggestions[text] += delta
+    for fragment in fragments(rng, 200):
+        check_against_brute_force(index, suggestions, fragment, 10)
+
+
+def test_misspelled_fragments_are_corrected(corpus):
+    index = SuggestionIndex(corpus)
+    exact, corrected = index.search_tiers("diabtic pat", 10)
+    assert exact == []
+    assert corrected and all("diabetic pat" in normalize(text) for text, _ in corrected)
+
+
+def test_pending_queries_rank_ahead_of_corrected_matches():
+    autocomplete = Autocomplete(["Get active diabetes conditions", "Show recent asthma observations"],
+                                history_min_count=2)
+    # "copd" is not in the vocabulary yet, so it is corrected to a prefix of "conditions"
+    assert autocomplete.suggest("copd") == ["Get active diabetes conditions"]
+
+    for caller in ("10.0.0.1", "10.0.0.2"):
+        autocomplete.record("Find patients with asthma and copd", caller)
+    # The popular query waits for the next rebuild, but still ranks as an exact match,
+    # ahead of the heavier typo-corrected suggestion
+    assert autocomplete.stats()["pending"] == 1
+    assert autocomplete.suggest("copd") == ["Find patients with asthma and copd",
+                                            "Get active diabetes conditions"]
+    assert autocomplete.suggest("copd", limit=1) == ["Find patients with asthma and copd"]
+
+
+def test_queries_from_one_caller_never_become_suggestions():
+    autocomplete = Autocomplete(["Get active diabetes conditions"], history_min_count=2)
+    for _ in range(5):
+        autocomplete.record("Show labs for patient 12345", "10.0.0.1")
+    assert autocomplete.suggest("show labs") == []
+    assert autocomplete.stats()["popular_queries"] == 0
+
+    autocomplete.record("Show labs for patient 12345", "10.0.0.2")
+    assert autocomplete.suggest("show labs") == ["Show labs for patient 12345"]
+
+
+def test_queries_naming_patients_are_not_recorded(monkeypatch):
+    autocomplete = Autocomplete([], history_min_count=1)
+    monkeypatch.setattr(fhir_api_common, "autocomplete", autocomplete)
+    parsed = {"fhir_query": {"resource_type": "Patient"}}
+    for entities in ({"names": ["John Smith"]}, {"patient_ids": ["12345"]}):
+        fhir_api_common.remember_query("Find patient John Smith 12345",
+                                       dict(parsed, nlp_analysis={"entities": entities}), "10.0.0.1")
+    assert autocomplete.stats()["tracked_queries"] == 0
+
+    fhir_api_common.remember_query("Find diabetic patients", dict(parsed, nlp_analysis={"entities": {}}), "10.0.0.1")
+    assert autocomplete.suggest("diab") == ["Find diabetic patients"]
+
+
+def test_weight_recorded_during_a_rebuild_is_kept(monkeypatch):
+    autocomplete = Autocomplete(["Get active diabetes conditions"], history_min_count=1)
+    autocomplete.record("Find patients with asthma")
+    assert autocomplete.stats()["pending"] == 1
+
+    def build_while_recording(suggestions):
+        # Queries recorded while the new index is built reach the old index only
+        for _ in range(4):
+            autocomplete.record("Get active diabetes conditions")
+            autocomplete.record("Find patients with asthma")
+        return SuggestionIndex(suggestions)
+
+    monkeypatch.setattr(fhir_suggest, "SuggestionIndex", build_while_recording)
+    autocomplete.add_suggestions([])
+
+    assert autocomplete.stats()["pending"] == 0
+    assert autocomplete.index.weight("Get active diabetes conditions") == fhir_suggest.CURATED_WEIGHT + 4
+    assert autocomplete.index.weight("Find patients with asthma") == 5